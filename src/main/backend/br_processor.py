@@ -14,33 +14,143 @@ https://www.gnu.org/licenses/gpl-3.0.en.html
 """
 
 from sqlalchemy import create_engine, func, Column, ForeignKey, Integer, String, Boolean
+from sqlalchemy import bindparam, event, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy.orm.exc import NoResultFound
 from datetime import datetime
 import argparse
+import array
+import atexit
 import bisect
 import bulk_extractor_reader
+import collections
+import concurrent.futures
 import fiwalk
+import hashlib
+import io
+import itertools
 import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
 import sqlite3
+import struct
 import subprocess
 import sys
-import tempfile
 import time
+import xml.etree.ElementTree as ET
 import Objects
 
-from export import FileExport
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from export import DEFAULT_COPY_THREADS, LINK_MODES, FileExport, link_file
+from server import SessionServer
 from utils import print_to_stderr_and_exit
 
 
 Base = declarative_base()
 xor_re = re.compile(b"^(\\d+)\\-XOR\\-(\\d+)")
 
+# Number of rows buffered before each batched insert
+DEFAULT_BATCH_SIZE = 10000
+
+# Approximate size in bytes of feature file chunks parsed at once
+FEATURE_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Number of feature lines attributed to files at once
+FEATURE_BLOCK_SIZE = 65536
+
+# Pragmas set on database connections to speed up bulk ingest of files
+# and features. Durability against power loss is traded for speed
+# only while ingesting: with WAL, a killed process still leaves the
+# database intact for --resume, and databases kept after a run or
+# served for review are returned to SQLite's default rollback journal
+# by restore_database_settings.
+INGEST_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA cache_size=-262144",
+    "PRAGMA mmap_size=1073741824",
+    "PRAGMA temp_store=MEMORY",
+)
+# Indexes created once ingest is complete rather than maintained
+# during bulk inserts
+INGEST_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_file_filepath ON file (filepath)",
+    "CREATE INDEX IF NOT EXISTS ix_file_session ON file (session)",
+    "CREATE INDEX IF NOT EXISTS ix_feature_file ON feature (file)",
+    # Covers query for files with undismissed features in exports
+    "CREATE INDEX IF NOT EXISTS ix_feature_dismissed "
+    "ON feature (dismissed, file, id)",
+)
+# Seconds between checks for new lines in feature files being written
+TAIL_POLL_INTERVAL = 5.0
+# Queries for files and features in JSON output
+FILES_SQL_QUERY = """\
+    SELECT fl.*, COALESCE(c.feature_count, 0) as feature_count \
+    from file fl
+    LEFT JOIN (SELECT file, COUNT(*) as feature_count \
+        from feature GROUP BY file) c ON c.file = fl.id
+    WHERE fl.session = ?
+    ORDER BY fl.id;
+    """
+FEATURES_SQL_QUERY = """\
+    SELECT f.id, f.feature_type, f.forensic_path, \
+        f.offset, f.feature, f.context, f.note, \
+        f.dismissed, f.file, fl.filepath
+    from feature f, file fl
+    WHERE f.file = fl.id"""
+SESSION_BOOLEAN_COLUMNS = (
+    "disk_image",
+    "named_entity_extraction",
+    "include_exif",
+    "include_network",
+)
+FILE_BOOLEAN_COLUMNS = ("allocated", "verified")
+FEATURE_BOOLEAN_COLUMNS = ("dismissed",)
+# Columns of session table with settings that determine the features
+# found, which must match for features to be carried over by a rescan
+SCAN_SETTING_COLUMNS = (
+    "named_entity_extraction",
+    "regex_file",
+    "ssn_mode",
+    "include_exif",
+    "include_network",
+    "stoplists",
+)
+# Directory in bulk-reviewer directory holding cached bulk_extractor reports
+REPORT_CACHE_DIRNAME = "bulk_extractor_cache"
+# Tags of DFXML fileobjects read by dfxml.fileobject.allocated()
+ALLOCATION_TAGS = ("alloc", "ALLOC", "unalloc")
+# Directory in bulk-reviewer directory holding cached file tables and
+# byte run indexes of disk images, and format of cache files
+DFXML_CACHE_DIRNAME = "dfxml_cache"
+DFXML_CACHE_MAGIC = b"BRDFXML\x01"
+# Columns of File table stored as strings in DFXML cache
+DFXML_CACHE_STRING_COLUMNS = (
+    "filepath",
+    "date_modified",
+    "date_created",
+    "inode",
+    "fs_offset",
+)
+# Options of bulk_extractor command followed by a path
+BULK_EXTRACTOR_PATH_OPTIONS = ("-o", "-F", "-w")
+# Names of files in sharded session output and default features per page
+SESSION_MANIFEST_FILENAME = "session.json"
+SESSION_FILES_FILENAME = "files.json"
+SESSION_PAGES_DIR = "pages"
+DEFAULT_PAGE_SIZE = 50000
+# Encoder for values in JSON output, which keeps non-ASCII characters
+_json_encoder = json.JSONEncoder(ensure_ascii=False)
+# Filepath of File that features outside of known files are matched to
+UNALLOCATED_PLACEHOLDER = "<unallocated space>"
+
 FEATURE_LABELS = {
     "pii.txt": "Social Security Number (USA)",
     "sin.txt": "Social Insurance Number (Canada)",
@@ -68,6 +178,9 @@ class BRSession(Base):
     named_entity_extraction = Column(Boolean)
     regex_file = Column(String, nullable=True)
     ssn_mode = Column(Integer)
+    include_exif = Column(Boolean)
+    include_network = Column(Boolean)
+    stoplists = Column(String(64), nullable=True)
 
 
 class File(Base):
@@ -82,6 +195,8 @@ class File(Base):
     verified = Column(Boolean)
     inode = Column(String, nullable=True)
     fs_offset = Column(String, nullable=True)
+    size = Column(Integer, nullable=True)
+    sha256 = Column(String(64), nullable=True)
     session = Column(Integer, ForeignKey("session.id"))
 
 
@@ -98,6 +213,399 @@ class Feature(Base):
     file = Column(Integer, ForeignKey("file.id"))
 
 
+class BatchWriter:
+    """
+    Buffers rows for a single table and writes them to the
+    database in large batched transactions.
+
+    Each batch is written with one executemany insert. If a batch
+    fails, its rows are retried one at a time so that a bad row is
+    logged and skipped without losing the rest of the batch.
+
+    If on_insert is provided, it is called with the key passed to
+    add() and the new row id for each row written.
+    """
+
+    def __init__(self, session, table, batch_size=DEFAULT_BATCH_SIZE, on_insert=None):
+        self.session = session
+        self.table = table
+        self.batch_size = max(1, batch_size)
+        self.on_insert = on_insert
+        self.rows = []
+        self.keys = []
+        self.written = 0
+        self.failed = 0
+        self.start_time = time.time()
+
+    def add(self, row, key=None):
+        """Buffer row (dict of column values), flushing if batch is full"""
+        self.rows.append(row)
+        self.keys.append(key)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Write buffered rows to database"""
+        if not self.rows:
+            return
+        try:
+            first_id = self._max_id() + 1
+            self.session.execute(self.table.insert(), self.rows)
+            self.session.commit()
+        except Exception as e:
+            self.session.rollback()
+            logging.warning(
+                "Batch insert of %d rows into %s failed, retrying row by row: %s",
+                len(self.rows),
+                self.table.name,
+                e,
+            )
+            for (row, key) in zip(self.rows, self.keys):
+                self._write_row(row, key)
+        else:
+            self.written += len(self.rows)
+            # SQLite assigns rows inserted in one statement consecutive ids
+            if self.on_insert is not None:
+                for (i, key) in enumerate(self.keys):
+                    self.on_insert(key, first_id + i)
+        self.rows = []
+        self.keys = []
+
+    def _max_id(self):
+        if self.on_insert is None:
+            return 0
+        return self.session.query(func.max(self.table.c.id)).scalar() or 0
+
+    def _write_row(self, row, key):
+        try:
+            result = self.session.execute(self.table.insert(), row)
+            self.session.commit()
+            self.written += 1
+            if self.on_insert is not None:
+                self.on_insert(key, result.inserted_primary_key[0])
+        except Exception as e:
+            self.session.rollback()
+            self.failed += 1
+            logging.error(
+                "Row not written to %s table: %s. Row: %s", self.table.name, e, row
+            )
+
+    def close(self):
+        """Flush remaining rows and log throughput"""
+        self.flush()
+        elapsed = time.time() - self.start_time
+        rate = self.written / elapsed if elapsed > 0 else float(self.written)
+        logging.info(
+            "Wrote %d rows to %s table in %.2f seconds (%.0f rows/second). %d rows failed.",
+            self.written,
+            self.table.name,
+            elapsed,
+            rate,
+            self.failed,
+        )
+
+
+class FileIndex:
+    """
+    Session-scoped lookup of File ids by relative filepath.
+
+    Built once after file metadata is loaded so that feature ingest
+    resolves each feature's file with a dict lookup instead of a
+    query. Also caches the source path prefix used to make feature
+    filepaths relative and the id of the unallocated space placeholder.
+    """
+
+    def __init__(self, session, br_session_id):
+        self.session = session
+        self.br_session_id = br_session_id
+        self.source_path = session.query(BRSession).get(br_session_id).source_path
+        self.parent_dir = os.path.split(self.source_path)[1] + "/"
+        self.ids = dict()
+        files = (
+            session.query(File.filepath, File.id)
+            .filter_by(session=br_session_id)
+            .order_by(File.id)
+        )
+        for (filepath, file_id) in files:
+            self.ids.setdefault(filepath, file_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, filepath):
+        """Return id of File with filepath, or None if not found"""
+        return self.ids.get(filepath)
+
+    def placeholder_id(self):
+        """Return id of unallocated space placeholder, creating it if needed"""
+        placeholder_id = self.ids.get(UNALLOCATED_PLACEHOLDER)
+        if placeholder_id is None:
+            placeholder = File(
+                filepath=UNALLOCATED_PLACEHOLDER,
+                filename=UNALLOCATED_PLACEHOLDER,
+                allocated=False,
+                session=self.br_session_id,
+            )
+            self.session.add(placeholder)
+            self.session.commit()
+            placeholder_id = placeholder.id
+            self.ids[UNALLOCATED_PLACEHOLDER] = placeholder_id
+        return placeholder_id
+
+
+class RunManifest:
+    """
+    Persistent record of a processing run, saved as JSON so that an
+    interrupted run can be resumed with --resume.
+
+    Records fingerprints of the inputs the run was started with, the
+    stages (see STAGES) that have completed, and for feature ingest
+    the byte offset up to which each feature file has been committed
+    to the database along with the highest feature id at that point.
+    """
+
+    STAGES = ("dfxml", "files", "bulk_extractor", "features", "json")
+
+    def __init__(self, path, inputs):
+        self.path = path
+        self.inputs = inputs
+        self.resumed = False
+        self.stages = dict()
+        self.feature_offsets = dict()
+        self.feature_id = 0
+
+    def load(self):
+        """
+        Load manifest of previous run from path. Return True if it was
+        loaded, False if it does not exist or was for different inputs.
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if manifest.get("inputs") != self.inputs:
+            logging.warning("Inputs have changed since run recorded in %s", self.path)
+            return False
+        self.stages = manifest["stages"]
+        self.feature_offsets = manifest["feature_offsets"]
+        self.feature_id = manifest["feature_id"]
+        self.resumed = True
+        return True
+
+    def save(self):
+        """Write manifest to path, replacing previous version atomically"""
+        manifest = dict(
+            inputs=self.inputs,
+            stages=self.stages,
+            feature_offsets=self.feature_offsets,
+            feature_id=self.feature_id,
+        )
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def is_complete(self, stage):
+        return stage in self.stages
+
+    def complete(self, stage):
+        """Record stage as completed"""
+        self.stages[stage] = datetime.now().isoformat()
+        self.save()
+        logging.info("Completed stage %s", stage)
+
+    def reset(self, stage):
+        """Record stage as not completed"""
+        self.stages.pop(stage, None)
+        if stage in ("files", "bulk_extractor", "features"):
+            self.feature_offsets = dict()
+            self.feature_id = 0
+        self.save()
+
+    def feature_offset(self, feature_file):
+        """Return byte offset feature_file has been committed up to"""
+        return self.feature_offsets.get(os.path.basename(feature_file), 0)
+
+    def commit_features(self, feature_file, offset, feature_id):
+        """
+        Record features in feature_file up to byte offset as committed,
+        with feature_id the highest feature id in the database.
+        """
+        self.feature_offsets[os.path.basename(feature_file)] = offset
+        self.feature_id = feature_id
+        self.save()
+
+
+class ReportCache:
+    """
+    Cache of bulk_extractor output directories shared by processing
+    runs, kept in the bulk-reviewer directory.
+
+    Each entry is stored under a digest of report_cache_key, which
+    identifies the source and the options bulk_extractor was run
+    with, so runs that only change how features are read into the
+    session (e.g. --include_exif or --include_network) reuse the
+    reports of an earlier scan.
+
+    Reports are only ever hardlinked into the cache, never copied, so
+    entries share their data with the reports of the session that
+    stored them and the cache takes no space of its own. Reports on
+    another filesystem than the cache aren't cached.
+    """
+
+    KEY_FILENAME = "cache_key.json"
+
+    def __init__(self, cache_dir, key):
+        self.key = key
+        self.cache_dir = cache_dir
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8"))
+        self.entry_path = os.path.join(cache_dir, digest.hexdigest())
+
+    def restore(self, bulk_extractor_path):
+        """
+        Link cached reports into bulk_extractor_path. Return True if
+        reports were found in cache, False if not.
+        """
+        if not os.path.isfile(os.path.join(self.entry_path, self.KEY_FILENAME)):
+            return False
+        _link_tree(self.entry_path, bulk_extractor_path, skip=self.KEY_FILENAME)
+        return True
+
+    def store(self, bulk_extractor_path):
+        """
+        Hardlink reports in bulk_extractor_path into cache. Return True
+        if reports were cached, False if they are already cached or
+        on another filesystem than the cache.
+        """
+        if os.path.exists(self.entry_path):
+            return False
+        if not _same_filesystem(bulk_extractor_path, self.cache_dir):
+            return False
+        tmp_path = "{}.tmp{}".format(self.entry_path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        try:
+            _link_tree(bulk_extractor_path, tmp_path, copy=False)
+            with open(
+                os.path.join(tmp_path, self.KEY_FILENAME), "w", encoding="utf-8"
+            ) as f:
+                json.dump(self.key, f, indent=2)
+            os.rename(tmp_path, self.entry_path)
+        finally:
+            # Left over if another run stored the same reports first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return True
+
+
+def _link_tree(src, dst, skip=None, copy=True):
+    """Hardlink files in directory src into dst. Files that can't be
+    linked are copied if copy, otherwise OSError is raised.
+    """
+    for (root, dirs, files) in os.walk(src):
+        out_dir = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(out_dir, exist_ok=True)
+        for f in files:
+            if root == src and f == skip:
+                continue
+            if copy:
+                link_file(os.path.join(root, f), os.path.join(out_dir, f), "hardlink")
+            else:
+                os.link(os.path.join(root, f), os.path.join(out_dir, f))
+
+
+def _same_filesystem(path, cache_dir):
+    """Return True if path is on the same filesystem as cache_dir,
+    creating cache_dir if necessary.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.stat(path).st_dev == os.stat(cache_dir).st_dev
+
+
+def report_cache_key(src, args, ssn_mode, stoplist_dir):
+    """
+    Return dict identifying bulk_extractor reports for a scan of src:
+    the identity of the source, digests of the regex file and
+    stoplists, and the options and version of bulk_extractor.
+    """
+    regex_digest = None
+    if args.regex:
+        regex_digest = file_digest(args.regex)
+    cmd = bulk_extractor_command(src, "", stoplist_dir, ssn_mode, args)
+    return dict(
+        source=src,
+        source_identity=source_identity(src, args.report_cache_hash),
+        ssn_mode=ssn_mode,
+        regex=regex_digest,
+        stoplists=stoplist_digests(args.stoplists),
+        options=bulk_extractor_options(cmd),
+        version=bulk_extractor_version(),
+    )
+
+
+def source_identity(src, hash_contents=False):
+    """
+    Return dict identifying contents of disk image or directory src
+    by size and modification time, and SHA-256 digest if hash_contents.
+
+    Directories are identified by a digest of the relative path, size
+    and modification time (and digest) of each file in them.
+    """
+    if not os.path.isdir(src):
+        source_stat = os.stat(src)
+        identity = dict(size=source_stat.st_size, mtime=source_stat.st_mtime_ns)
+        if hash_contents:
+            identity["sha256"] = file_digest(src)
+        return identity
+    tree = hashlib.sha256()
+    num_files = 0
+    for (root, dirs, files) in os.walk(src):
+        dirs.sort()
+        for f in sorted(files):
+            fpath = os.path.join(root, f)
+            file_stat = os.stat(fpath)
+            entry = [
+                os.path.relpath(fpath, src),
+                str(file_stat.st_size),
+                str(file_stat.st_mtime_ns),
+            ]
+            if hash_contents:
+                entry.append(file_digest(fpath))
+            tree.update("\0".join(entry).encode("utf-8", "surrogateescape"))
+            tree.update(b"\n")
+            num_files += 1
+    return dict(files=num_files, tree=tree.hexdigest(), hashed=hash_contents)
+
+
+def bulk_extractor_options(cmd):
+    """
+    Return options of bulk_extractor command cmd that affect its
+    output (scanners and their settings), without paths.
+    """
+    options = []
+    args = iter(cmd[1:-1])
+    for arg in args:
+        if arg in BULK_EXTRACTOR_PATH_OPTIONS:
+            next(args, None)
+        else:
+            options.append(arg)
+    return options
+
+
+def bulk_extractor_version():
+    """Return version reported by bulk_extractor, or None if unknown"""
+    try:
+        result = subprocess.run(
+            ["bulk_extractor", "-V"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode("utf-8", "replace").strip()
+
+
 class byterundb:
     """
     The byte run database holds a set of byte runs, sorted by the
@@ -233,20 +741,22 @@ class byterundb2:
         return r
 
     def path_to_offset(self, offset):
-        """If the path has an XOR transformation, add the offset within
-        the XOR to the initial offset. Otherwise don't. Return the integer
-        value of the offset."""
-        m = xor_re.search(offset)
-        if m:
-            return int(m.group(1)) + int(m.group(2))
-        negloc = offset.find(b"-")
-        if negloc == -1:
-            return int(offset)
-        return int(offset[0:negloc])
+        return path_to_offset(offset)
 
     def search_path(self, path):
         return self.search_offset(self.path_to_offset(path))
 
+    def search_paths(self, paths):
+        """
+        Return list of (fileinfo, file_id) for each path, or None if
+        not found. File ids are not known, so file_id is always None.
+        """
+        ret = []
+        for path in paths:
+            tpl = self.search_path(path)
+            ret.append((tpl[2], None) if tpl else None)
+        return ret
+
     def dump(self):
         # print("Allocated:")
         self.allocated.dump()
@@ -254,6 +764,217 @@ class byterundb2:
         self.unallocated.dump()
 
 
+class ByteRunIndex:
+    """
+    Interval index of DFXML byte runs backed by NumPy arrays.
+
+    Alternative to byterundb2 for large disk images. Extents are
+    stored as contiguous int64 start and end arrays plus an int32
+    array of file numbers into self.fileinfo, kept separately for
+    allocated and unallocated files. A whole block of feature offsets
+    is resolved at once with a vectorized sorted search, searching
+    allocated files first and falling back to unallocated files like
+    byterundb2.search_offset.
+    """
+
+    def __init__(self):
+        self.fileinfo = []  # (fname, md5) for each file number
+        self.file_ids = array.array("i")  # File id for each file number
+        self._building = {
+            True: (array.array("q"), array.array("q"), array.array("i")),
+            False: (array.array("q"), array.array("q"), array.array("i")),
+        }
+        self.allocated = None
+        self.unallocated = None
+
+    def __len__(self):
+        if self._building is None:
+            return len(self.allocated[0]) + len(self.unallocated[0])
+        return sum(len(starts) for (starts, ends, filenos) in self._building.values())
+
+    def add_file(self, fileinfo):
+        """Add file info and return its file number"""
+        self.fileinfo.append(fileinfo)
+        self.file_ids.append(-1)
+        return len(self.fileinfo) - 1
+
+    def set_file_id(self, fileno, file_id):
+        """Link file number to id of its row in the File table"""
+        if fileno is not None:
+            self.file_ids[fileno] = file_id
+
+    def add_extent(self, offset, length, fileno, allocated=True):
+        """Add the extent to the index, ignoring invalid arguments"""
+        if type(offset) != int or type(length) != int:
+            return
+        (starts, ends, filenos) = self._building[allocated]
+        starts.append(offset)
+        ends.append(offset + length)
+        filenos.append(fileno)
+
+    def process(self, fi):
+        """Add file info and byte runs for DFXML fileobject"""
+
+        def gval(x):
+            """Always return X as bytes"""
+            if x is None:
+                return b""
+            if type(x) == bytes:
+                return x
+            if type(x) != str:
+                x = str(x)
+            return x.encode("utf-8")
+
+        allocated = fi.allocated()
+        fileno = None
+        for run in fi.byte_runs():
+            try:
+                if fileno is None:
+                    fname = gval(fi.filename())
+                    if not allocated:
+                        fname = b"*" + fname
+                    fileno = self.add_file((fname, gval(fi.md5())))
+                self.add_extent(run.img_offset, run.len, fileno, allocated)
+            except TypeError:
+                pass
+
+    def process_object(self, obj, alloc_tags):
+        """
+        Add file info and byte runs for Objects.FileObject, returning
+        its file number or None if it has no byte runs. alloc_tags is
+        a dict of the text of the fileobject's allocation tags (see
+        iter_dfxml_fileobjects).
+
+        Equivalent to process() for the same DFXML fileobject, so that
+        the index can be built while parsing DFXML with Objects.
+        """
+        allocated = dfxml_object_allocated(obj, alloc_tags)
+        fileno = None
+        for byte_runs in (obj.data_brs, obj.inode_brs, obj.name_brs):
+            for run in byte_runs or []:
+                if fileno is None:
+                    fname = (obj.filename or "").encode("utf-8")
+                    if not allocated:
+                        fname = b"*" + fname
+                    md5val = (obj.md5 or "").encode("utf-8")
+                    fileno = self.add_file((fname, md5val))
+                self.add_extent(run.img_offset, run.len, fileno, allocated)
+        return fileno
+
+    def read_xmlfile(self, fname):
+        fiwalk.fiwalk_using_sax(xmlfile=open(fname, "rb"), callback=self.process)
+        self.finalize()
+
+    def finalize(self):
+        """Convert extents to sorted NumPy arrays"""
+        if self._building is None:
+            return
+        # Rank file info so that extents sort exactly like byterundb tuples
+        ranks = numpy.empty(len(self.fileinfo), dtype=numpy.int32)
+        order = sorted(range(len(self.fileinfo)), key=self.fileinfo.__getitem__)
+        ranks[order] = numpy.arange(len(order), dtype=numpy.int32)
+        for allocated, (starts, ends, filenos) in self._building.items():
+            starts = numpy.frombuffer(starts, dtype=numpy.int64)
+            ends = numpy.frombuffer(ends, dtype=numpy.int64)
+            filenos = numpy.frombuffer(filenos, dtype=numpy.int32)
+            sort_order = numpy.lexsort((ranks[filenos], ends, starts))
+            arrays = (starts[sort_order], ends[sort_order], filenos[sort_order])
+            if allocated:
+                self.allocated = arrays
+            else:
+                self.unallocated = arrays
+        self._building = None
+
+    @staticmethod
+    def _search(arrays, offsets):
+        """Return file number for each offset in arrays, or -1 if not found"""
+        (starts, ends, filenos) = arrays
+        result = numpy.full(len(offsets), -1, dtype=numpy.int32)
+        n = len(starts)
+        if n == 0:
+            return result
+        # Index of first extent starting at or after each offset
+        p = numpy.searchsorted(starts, offsets, side="left")
+        exact = p < n
+        exact[exact] = starts[p[exact]] == offsets[exact]
+        result[exact] = filenos[p[exact]]
+        # Otherwise, check extent starting to the left of each offset
+        left = ~exact & (p > 0)
+        left[left] = offsets[left] < ends[p[left] - 1]
+        result[left] = filenos[p[left] - 1]
+        return result
+
+    def search_offsets(self, offsets):
+        """
+        Return array of file numbers for array of offsets, or -1 where
+        no extent matches. First search the allocated. If there is
+        nothing, search unallocated.
+        """
+        self.finalize()
+        offsets = numpy.asarray(offsets, dtype=numpy.int64)
+        result = self._search(self.allocated, offsets)
+        missing = result == -1
+        if missing.any():
+            result[missing] = self._search(self.unallocated, offsets[missing])
+        return result
+
+    def search_paths(self, paths):
+        """
+        Return list of (fileinfo, file_id) for each path, or None if
+        not found. file_id is None if the file has no linked File row.
+        """
+        filenos = self.search_offsets([path_to_offset(path) for path in paths])
+        ret = []
+        for n in filenos.tolist():
+            if n < 0:
+                ret.append(None)
+                continue
+            file_id = self.file_ids[n]
+            ret.append((self.fileinfo[n], file_id if file_id >= 0 else None))
+        return ret
+
+
+def dfxml_object_allocated(obj, alloc_tags):
+    """
+    Return True if Objects.FileObject is allocated, matching
+    dfxml.fileobject.allocated() for the same fileobject.
+
+    Objects sets alloc and unalloc from each other, so the text of the
+    fileobject's alloc, ALLOC and unalloc tags is taken from alloc_tags
+    to apply the same precedence as dfxml.
+    """
+    if obj.filename == "$OrphanFiles":
+        return False
+    if obj.alloc_inode and obj.alloc_name:
+        return True
+    return (
+        _isone(alloc_tags.get("alloc"))
+        or _isone(alloc_tags.get("ALLOC"))
+        or not _isone(alloc_tags.get("unalloc"))
+    )
+
+
+def _isone(value):
+    """Return True if value is text of the number 1, as dfxml.isone()"""
+    try:
+        return int(value) == 1
+    except (TypeError, ValueError):
+        return False
+
+
+def path_to_offset(offset):
+    """If the path has an XOR transformation, add the offset within
+    the XOR to the initial offset. Otherwise don't. Return the integer
+    value of the offset."""
+    m = xor_re.search(offset)
+    if m:
+        return int(m.group(1)) + int(m.group(2))
+    negloc = offset.find(b"-")
+    if negloc == -1:
+        return int(offset)
+    return int(offset[0:negloc])
+
+
 def create_dfxml(src, dfxml_path):
     """
     Create DFXML representation of source disk image using fiwalk
@@ -269,9 +990,50 @@ def create_dfxml(src, dfxml_path):
         return False
 
 
-def run_bulk_extractor(src, bulk_extractor_path, stoplist_dir, ssn_mode, args):
+class FiwalkStream:
     """
-    Create and run bulk_extractor subprocess command.
+    Context manager running fiwalk on a source disk image and
+    exposing its DFXML output as a readable binary stream, so that
+    it can be parsed while fiwalk is still running.
+
+    If tee_path is provided, the DFXML read from the stream is also
+    written to that file. On exit, raises CalledProcessError if
+    fiwalk did not finish successfully.
+    """
+
+    def __init__(self, src, tee_path=None):
+        self.cmd = ["fiwalk", "-x", src]
+        self.tee_path = tee_path
+        self.proc = None
+        self.tee = None
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE)
+        if self.tee_path:
+            self.tee = open(self.tee_path, "wb")
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.tee is not None:
+            self.tee.close()
+        if exc_type is not None:
+            _terminate_process(self.proc)
+        self.proc.stdout.close()
+        returncode = self.proc.wait()
+        if exc_type is None and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.cmd)
+        return False
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if self.tee is not None:
+            self.tee.write(data)
+        return data
+
+
+def bulk_extractor_command(src, bulk_extractor_path, stoplist_dir, ssn_mode, args):
+    """
+    Return bulk_extractor subprocess command.
     """
     cmd = [
         "bulk_extractor",
@@ -303,7 +1065,14 @@ def run_bulk_extractor(src, bulk_extractor_path, stoplist_dir, ssn_mode, args):
             if f.endswith(".txt"):
                 cmd.insert(5, "-w")
                 cmd.insert(6, os.path.join(stoplist_dir, f))
+    return cmd
 
+
+def run_bulk_extractor(src, bulk_extractor_path, stoplist_dir, ssn_mode, args):
+    """
+    Create and run bulk_extractor subprocess command.
+    """
+    cmd = bulk_extractor_command(src, bulk_extractor_path, stoplist_dir, ssn_mode, args)
     try:
         subprocess.check_output(cmd)
         return True
@@ -312,18 +1081,109 @@ def run_bulk_extractor(src, bulk_extractor_path, stoplist_dir, ssn_mode, args):
         return False
 
 
-def parse_dfxml_to_db(session, br_session_id, dfxml_path):
+def start_bulk_extractor(src, bulk_extractor_path, stoplist_dir, ssn_mode, args):
+    """
+    Start bulk_extractor subprocess in the background and return
+    it, or None if it could not be started.
+
+    The subprocess is terminated if this script exits before it
+    finishes.
+    """
+    cmd = bulk_extractor_command(src, bulk_extractor_path, stoplist_dir, ssn_mode, args)
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    except OSError as e:
+        logging.error("Error starting bulk_extractor: %s", e)
+        return None
+    atexit.register(_terminate_process, proc)
+    return proc
+
+
+def wait_for_bulk_extractor(proc):
+    """
+    Wait for bulk_extractor subprocess started with
+    start_bulk_extractor to finish. Return True if successful,
+    False if unsuccessful.
+    """
+    if proc is None:
+        return False
+    returncode = proc.wait()
+    if returncode != 0:
+        logging.error(
+            "Error running bulk_extractor: %s",
+            subprocess.CalledProcessError(returncode, proc.args),
+        )
+        return False
+    return True
+
+
+def _terminate_process(proc):
+    if proc.poll() is None:
+        logging.warning("Terminating unfinished subprocess %s", proc.args[0])
+        proc.terminate()
+        proc.wait()
+
+
+def parse_dfxml_to_db(
+    session, br_session_id, dfxml_path, batch_size=DEFAULT_BATCH_SIZE, rundb=None
+):
     """
     Write database entry for each regular file
-    recorded in DFXML file.
+    recorded in DFXML file. dfxml_path may also be a readable
+    binary stream of DFXML, such as a FiwalkStream.
+
+    If rundb (a ByteRunIndex) is provided, the byte runs of every
+    fileobject are added to it in the same pass and linked to the ids
+    of the File rows written, so the DFXML file is only parsed once.
     """
+    on_insert = rundb.set_file_id if rundb is not None else None
+    writer = BatchWriter(session, File.__table__, batch_size, on_insert)
+    for (row, fileno) in dfxml_file_rows(dfxml_path, br_session_id, rundb):
+        writer.add(row, fileno)
+    writer.close()
+    if rundb is not None:
+        rundb.finalize()
+
 
-    # Gather info for each FileObject and save to db
-    for (event, obj) in Objects.iterparse(dfxml_path):
+def link_dfxml_to_db(session, br_session_id, dfxml_path, rundb):
+    """
+    Build rundb (a ByteRunIndex) from DFXML file previously written
+    to database by parse_dfxml_to_db, linking byte runs to the ids of
+    the existing File rows.
 
-        # Only work on FileObjects
-        if not isinstance(obj, Objects.FileObject):
+    File rows are matched to regular files in the DFXML file in order
+    and by filepath, so that rows that failed to be written are skipped.
+    """
+    files = iter(
+        session.query(File.id, File.filepath)
+        .filter_by(session=br_session_id)
+        .filter(File.filepath != UNALLOCATED_PLACEHOLDER)
+        .order_by(File.id)
+    )
+    next_file = next(files, None)
+    for (row, fileno) in dfxml_file_rows(dfxml_path, br_session_id, rundb):
+        if next_file is None or next_file[1] != row["filepath"]:
             continue
+        rundb.set_file_id(fileno, next_file[0])
+        next_file = next(files, None)
+    rundb.finalize()
+
+
+def dfxml_file_rows(dfxml_path, br_session_id, rundb=None):
+    """
+    Yield tuple of (row, fileno) for each regular file recorded in
+    DFXML file, where row is a dict of File column values.
+
+    If rundb is provided, the byte runs of every fileobject are added
+    to it and fileno is the file's number in rundb, otherwise None.
+    """
+    # Gather info for each FileObject
+    for (obj, partition_offset, alloc_tags) in iter_dfxml_fileobjects(dfxml_path):
+
+        # Add byte runs to index
+        fileno = None
+        if rundb is not None:
+            fileno = rundb.process_object(obj, alloc_tags)
 
         # Skip directories and links
         if obj.name_type:
@@ -347,13 +1207,12 @@ def parse_dfxml_to_db(session, br_session_id, dfxml_path):
         if obj.inode:
             inode = str(obj.inode)
         fs_offset = ""
-        if obj.volume_object:
-            fs_offset = obj.volume_object.partition_offset
+        if partition_offset is not None:
+            fs_offset = partition_offset
 
-        # Save file metadata to model
         filepath = obj.filename
         filename = os.path.basename(filepath)
-        new_file = File(
+        row = dict(
             filepath=filepath,
             filename=filename,
             session=br_session_id,
@@ -362,20 +1221,283 @@ def parse_dfxml_to_db(session, br_session_id, dfxml_path):
             allocated=allocated,
             inode=inode,
             fs_offset=fs_offset,
+            size=obj.filesize,
             verified=False,
         )
+        yield (row, fileno)
+
+
+def iter_dfxml_fileobjects(dfxml):
+    """
+    Yield tuple of (obj, partition_offset, alloc_tags) for each
+    fileobject in DFXML file at path or binary stream dfxml, where obj
+    is an Objects.FileObject, partition_offset is that of the volume
+    containing it or None, and alloc_tags is a dict of the text of its
+    ALLOCATION_TAGS.
+
+    Fileobjects are read with ElementTree and populated as
+    Objects.Parser does, keeping the allocation tags Objects merges.
+    """
+    path = []
+    partition_offsets = []
+    for (event, elem) in ET.iterparse(dfxml, ("start", "end")):
+        name = elem.tag.rsplit("}", 1)[-1]
+        if event == "start":
+            path.append(name)
+            if name == "volume":
+                partition_offsets.append(None)
+            continue
+        path.pop()
+        if name == "fileobject":
+            obj = Objects.FileObject()
+            obj.populate_from_Element(elem)
+            alloc_tags = {}
+            for child in elem:
+                child_name = child.tag.rsplit("}", 1)[-1]
+                if child_name in ALLOCATION_TAGS:
+                    alloc_tags[child_name] = child.text
+            partition_offset = None
+            if path and path[-1] == "volume":
+                partition_offset = partition_offsets[-1]
+            yield (obj, partition_offset, alloc_tags)
+            elem.clear()
+        elif name == "partition_offset" and path and path[-1] == "volume":
+            partition_offsets[-1] = int(elem.text)
+        elif name == "volume":
+            partition_offsets.pop()
+            elem.clear()
+
+
+class DfxmlCache:
+    """
+    Cache of the file table and byte run index read from the DFXML of
+    disk images, shared by processing runs and kept in the
+    bulk-reviewer directory.
+
+    Entries are stored under a digest of the image's path and identity
+    (see source_identity) and the installed fiwalk version, so new
+    sessions on an image processed before skip fiwalk and DFXML
+    parsing. Each entry holds a hardlink to the DFXML file, for exports
+    and resumed runs to read byte runs from, and a compact binary file
+    (see store) a fraction of its size.
+
+    As with ReportCache, the DFXML file is only ever hardlinked into
+    the cache, never copied, so images whose DFXML file wasn't written
+    to disk or is on another filesystem than the cache aren't cached.
+
+    Byte run indexes are ByteRunIndex objects, so the cache is only
+    used when NumPy is available.
+    """
+
+    KEY_FILENAME = "cache_key.json"
+    INDEX_FILENAME = "file_table.bin"
+    DFXML_FILENAME = "dfxml.xml"
+
+    def __init__(self, cache_dir, key):
+        self.key = key
+        self.cache_dir = cache_dir
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf-8"))
+        self.entry_path = os.path.join(cache_dir, digest.hexdigest())
+        self.index_path = os.path.join(self.entry_path, self.INDEX_FILENAME)
+
+    def load(self, session, br_session_id, dfxml_path, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Write cached file table to database and return its ByteRunIndex
+        linked to the File rows written, or None if not in cache. Link
+        cached DFXML file to dfxml_path.
+        """
+        cached_dfxml = os.path.join(self.entry_path, self.DFXML_FILENAME)
+        if not os.path.exists(cached_dfxml):
+            return None
         try:
-            session.add(new_file)
-            session.commit()
-        except Exception as e:
-            logging.error("File %s not written to database: %s", filepath, e)
+            sections = _read_cache_sections(self.index_path)
+        except FileNotFoundError:
+            return None
+        (num_rows, num_fileinfo) = struct.unpack("<QQ", sections[0])
+        string_columns = [
+            _split_cache_strings(column, num_rows) for column in sections[1:6]
+        ]
+        sizes = _cache_array("q", sections[6])
+        allocated = _cache_array("b", sections[7])
+        row_filenos = _cache_array("i", sections[8])
+
+        rundb = ByteRunIndex()
+        rundb.fileinfo = list(
+            zip(
+                _split_cache_bytes(sections[9], num_fileinfo),
+                _split_cache_bytes(sections[10], num_fileinfo),
+            )
+        )
+        rundb.file_ids = array.array("i", [-1]) * num_fileinfo
+        arrays = [
+            numpy.frombuffer(section, dtype=dtype).copy()
+            for (section, dtype) in zip(
+                sections[11:], (numpy.int64, numpy.int64, numpy.int32) * 2
+            )
+        ]
+        rundb.allocated = tuple(arrays[:3])
+        rundb.unallocated = tuple(arrays[3:])
+        rundb._building = None
+
+        writer = BatchWriter(session, File.__table__, batch_size, rundb.set_file_id)
+        for (i, values) in enumerate(zip(*string_columns)):
+            row = dict(zip(DFXML_CACHE_STRING_COLUMNS, values))
+            row.update(
+                filename=os.path.basename(row["filepath"]),
+                session=br_session_id,
+                allocated=bool(allocated[i]),
+                size=sizes[i] if sizes[i] >= 0 else None,
+                verified=False,
+            )
+            writer.add(row, row_filenos[i] if row_filenos[i] >= 0 else None)
+        writer.close()
+
+        if not os.path.exists(dfxml_path):
+            link_file(cached_dfxml, dfxml_path, "hardlink")
+        return rundb
+
+    def store(self, session, br_session_id, rundb, dfxml_path):
+        """
+        Add file table of session in database and rundb (a finalized
+        ByteRunIndex linked to its rows) to cache with a hardlink to
+        DFXML file dfxml_path. Return True if they were cached, False
+        if they are already cached or dfxml_path doesn't exist or is on
+        another filesystem than the cache.
+
+        The file is made of DFXML_CACHE_MAGIC followed by sections of
+        a little-endian 64-bit length and data: the number of rows and
+        of rundb files, the string columns of the File table,
+        NUL-separated, arrays (in native byte order) of sizes,
+        allocated flags and rundb file numbers of rows, rundb file
+        names and MD5s, NUL-separated, and the extent arrays of
+        allocated and unallocated files.
+        """
+        if os.path.exists(self.entry_path) or not os.path.exists(dfxml_path):
+            return False
+        if not _same_filesystem(dfxml_path, self.cache_dir):
+            return False
+        fileno_by_id = {
+            file_id: fileno
+            for (fileno, file_id) in enumerate(rundb.file_ids)
+            if file_id >= 0
+        }
+        string_columns = [[] for column in DFXML_CACHE_STRING_COLUMNS]
+        sizes = array.array("q")
+        allocated = array.array("b")
+        row_filenos = array.array("i")
+        rows = (
+            session.query(
+                File.id,
+                File.size,
+                File.allocated,
+                *(getattr(File, column) for column in DFXML_CACHE_STRING_COLUMNS)
+            )
+            .filter_by(session=br_session_id)
+            .order_by(File.id)
+        )
+        for (file_id, size, file_allocated, *values) in rows:
+            for (column, value) in zip(string_columns, values):
+                column.append("" if value is None else str(value))
+            sizes.append(-1 if size is None else size)
+            allocated.append(bool(file_allocated))
+            row_filenos.append(fileno_by_id.get(file_id, -1))
+        sections = [struct.pack("<QQ", len(sizes), len(rundb.fileinfo))]
+        sections += [
+            "\0".join(column).encode("utf-8", "surrogatepass")
+            for column in string_columns
+        ]
+        sections += [sizes.tobytes(), allocated.tobytes(), row_filenos.tobytes()]
+        sections.append(b"\0".join(fname for (fname, md5) in rundb.fileinfo))
+        sections.append(b"\0".join(md5 for (fname, md5) in rundb.fileinfo))
+        for arrays in (rundb.allocated, rundb.unallocated):
+            sections += [a.tobytes() for a in arrays]
+
+        tmp_path = "{}.tmp{}".format(self.entry_path, os.getpid())
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        try:
+            os.makedirs(tmp_path)
+            os.link(dfxml_path, os.path.join(tmp_path, self.DFXML_FILENAME))
+            _write_cache_sections(os.path.join(tmp_path, self.INDEX_FILENAME), sections)
+            with open(
+                os.path.join(tmp_path, self.KEY_FILENAME), "w", encoding="utf-8"
+            ) as f:
+                json.dump(self.key, f, indent=2)
+            os.rename(tmp_path, self.entry_path)
+        finally:
+            # Left over if another run stored the same image first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        return True
+
+
+def _write_cache_sections(path, sections):
+    with open(path, "wb") as f:
+        f.write(DFXML_CACHE_MAGIC)
+        for data in sections:
+            f.write(struct.pack("<Q", len(data)))
+            f.write(data)
 
 
-def write_filesystem_metadata_to_db(session, br_session_id, src):
+def _read_cache_sections(path):
+    """Return list of sections of cache file written by _write_cache_sections"""
+    with open(path, "rb") as f:
+        data = memoryview(f.read())
+    if bytes(data[: len(DFXML_CACHE_MAGIC)]) != DFXML_CACHE_MAGIC:
+        raise ValueError("Not a DFXML cache file: {}".format(path))
+    sections = []
+    pos = len(DFXML_CACHE_MAGIC)
+    while pos < len(data):
+        (length,) = struct.unpack_from("<Q", data, pos)
+        pos += 8
+        if pos + length > len(data):
+            raise ValueError("Truncated DFXML cache file: {}".format(path))
+        sections.append(data[pos : pos + length])
+        pos += length
+    return sections
+
+
+def _cache_array(typecode, data):
+    values = array.array(typecode)
+    values.frombytes(data)
+    return values
+
+
+def _split_cache_strings(data, count):
+    if count == 0:
+        return []
+    return bytes(data).decode("utf-8", "surrogatepass").split("\0")
+
+
+def _split_cache_bytes(data, count):
+    if count == 0:
+        return []
+    return bytes(data).split(b"\0")
+
+
+def dfxml_cache_key(src, args):
+    """
+    Return dict identifying the file table and byte runs fiwalk
+    reports for disk image src.
+    """
+    try:
+        fiwalk_version = fiwalk.fiwalk_installed_version()
+    except OSError:
+        fiwalk_version = None
+    return dict(
+        source=src,
+        source_identity=source_identity(src, args.report_cache_hash),
+        fiwalk_version=fiwalk_version,
+    )
+
+
+def write_filesystem_metadata_to_db(
+    session, br_session_id, src, batch_size=DEFAULT_BATCH_SIZE, hash_files=False
+):
     """
     Recursively walk filesystem of src and write
-    metadata for each file to database.
+    metadata for each file to database, including
+    its SHA-256 digest if hash_files is True.
     """
+    writer = BatchWriter(session, File.__table__, batch_size)
     for root, dirs, files in os.walk(src):
         for f in files:
             # Filepath
@@ -391,33 +1513,173 @@ def write_filesystem_metadata_to_db(session, br_session_id, src):
                     file_info.st_mtime
                 ).isoformat()
 
-            # Save file metadata to model
-            new_file = File(
-                filepath=rel_fpath,
-                filename=f,
-                session=br_session_id,
-                date_modified=date_modified,
-                date_created="",
-                allocated=True,
-                inode="",
-                fs_offset="",
-                verified=False,
+            # Checksum
+            sha256 = None
+            if hash_files:
+                sha256 = file_digest(abs_fpath)
+
+            # Buffer file metadata for batched write
+            writer.add(
+                dict(
+                    filepath=rel_fpath,
+                    filename=f,
+                    session=br_session_id,
+                    date_modified=date_modified,
+                    date_created="",
+                    allocated=True,
+                    inode="",
+                    fs_offset="",
+                    size=file_info.st_size,
+                    sha256=sha256,
+                    verified=False,
+                )
             )
-            try:
-                session.add(new_file)
-                session.commit()
-            except Exception as e:
-                logging.error("File %s not written to database: %s", rel_fpath, e)
 
+    writer.close()
 
-def process_featurefile2(rundb, infile, outfile):
+
+def rescan_unchanged_files(
+    session, br_session_id, previous_session, compare_hashes=False
+):
+    """
+    Return set of filepaths of files in database that are unchanged
+    since previous_session, a session loaded from Bulk Reviewer JSON.
+
+    Files are unchanged if they have the same relative path, size
+    and modified date, and if compare_hashes is True the same SHA-256
+    digest. Files without a recorded size are treated as changed, as
+    are all files if previous_session was scanned with different
+    settings.
     """
-    Returns features from infile, determines the file for each,
-    writes results to outfile.
+    br_session = session.query(BRSession).filter_by(id=br_session_id).one()
+    changed_settings = [
+        column
+        for column in SCAN_SETTING_COLUMNS
+        if previous_session.get(column) != getattr(br_session, column)
+    ]
+    if changed_settings:
+        logging.warning(
+            "Previous session was scanned with different settings (%s). "
+            "Rescanning all files.",
+            ", ".join(changed_settings),
+        )
+        return set()
+    previous_files = {f["filepath"]: f for f in previous_session["files"]}
+    unchanged = set()
+    files = session.query(
+        File.filepath, File.size, File.date_modified, File.sha256
+    ).filter_by(session=br_session_id)
+    for (filepath, size, date_modified, sha256) in files:
+        previous = previous_files.get(filepath)
+        if previous is None or size is None:
+            continue
+        if previous.get("size") != size:
+            continue
+        if previous.get("date_modified") != date_modified:
+            continue
+        if compare_hashes:
+            if sha256 is None or previous.get("sha256") != sha256:
+                continue
+        unchanged.add(filepath)
+    return unchanged
 
-    Slightly modified from:
-    https://github.com/simsong/bulk_extractor/blob/
-    master/python/identify_filenames.py
+
+def carry_over_file_notes(session, br_session_id, previous_session, unchanged):
+    """
+    Copy reviewer notes and verified status of unchanged files from
+    previous_session to database.
+    """
+    file_index = FileIndex(session, br_session_id)
+    rows = []
+    for f in previous_session["files"]:
+        if f["filepath"] not in unchanged:
+            continue
+        if not (f.get("note") or f.get("verified")):
+            continue
+        rows.append(
+            dict(
+                file_id=file_index.get(f["filepath"]),
+                note=f.get("note"),
+                verified=bool(f.get("verified")),
+            )
+        )
+    if rows:
+        table = File.__table__
+        update = (
+            table.update()
+            .where(table.c.id == bindparam("file_id"))
+            .values(note=bindparam("note"), verified=bindparam("verified"))
+        )
+        session.execute(update, rows)
+        session.commit()
+
+
+def carry_over_features(
+    session, br_session_id, previous_session, unchanged, batch_size=DEFAULT_BATCH_SIZE
+):
+    """
+    Write features of unchanged files from previous_session to
+    database, keeping reviewer notes and dismissals.
+    """
+    file_index = FileIndex(session, br_session_id)
+    writer = BatchWriter(session, Feature.__table__, batch_size)
+    for feature in previous_session["features"]:
+        if feature["filepath"] not in unchanged:
+            continue
+        writer.add(
+            dict(
+                feature_type=feature["feature_type"],
+                forensic_path=feature.get("forensic_path"),
+                offset=feature.get("offset"),
+                feature=feature["feature"],
+                context=feature.get("context"),
+                note=feature.get("note"),
+                dismissed=bool(feature.get("dismissed")),
+                file=file_index.get(feature["filepath"]),
+            )
+        )
+    writer.close()
+
+
+def stage_changed_files(src, staging_dir, filepaths):
+    """
+    Hard link, or copy if linking is not possible, files at relative
+    filepaths in directory src into a directory with the same name
+    as src in staging_dir, so that bulk_extractor can scan only those
+    files. Return path to staged directory.
+    """
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir)
+    staged_src = os.path.join(staging_dir, os.path.basename(src))
+    os.makedirs(staged_src)
+    for filepath in filepaths:
+        staged_path = os.path.join(staged_src, filepath)
+        os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+        try:
+            os.link(os.path.join(src, filepath), staged_path)
+        except OSError:
+            shutil.copy2(os.path.join(src, filepath), staged_path)
+    return staged_src
+
+
+def process_featurefile2(
+    rundb, infile, outfile=None, feature_sink=None, block_size=FEATURE_BLOCK_SIZE
+):
+    """
+    Returns features from infile (a file or other iterable of lines),
+    determines the file for each, writes results to outfile.
+
+    If feature_sink is provided, it is called with (path, feature,
+    context, fileinfo, file_id) for each feature, where fileinfo and
+    file_id are None if the feature could not be located to a file.
+    Either outfile or feature_sink may be None.
+
+    Features are looked up in blocks of block_size lines so that a
+    ByteRunIndex can resolve each block with one vectorized search.
+
+    Slightly modified from:
+    https://github.com/simsong/bulk_extractor/blob/
+    master/python/identify_filenames.py
     """
     # Stats
     unallocated_count = 0
@@ -425,96 +1687,304 @@ def process_featurefile2(rundb, infile, outfile):
     features_encoded = 0
     located_count = 0
 
-    outfile.write(b"# Position\tFeature")
-    outfile.write(b"\tContext")
-    outfile.write(b"\tFilename\tMD5")
-    outfile.write(b"\n")
+    if outfile is not None:
+        outfile.write(b"# Position\tFeature")
+        outfile.write(b"\tContext")
+        outfile.write(b"\tFilename\tMD5")
+        outfile.write(b"\n")
     t0 = time.time()
     linenumber = 0
-    for line in infile:
-        linenumber += 1
-        if bulk_extractor_reader.is_comment_line(line):
-            outfile.write(line)
-            continue
-        try:
-            (path, feature, context) = line[:-1].split(b"\t")
-        except ValueError as e:
-            logging.error("Error annotating feature file: %s", e)
-            logging.error("Offending line %s: %s", linenumber, line[:-1])
-            continue
-        feature_count += 1
+    lines = iter(infile)
+    for block in iter(lambda: list(itertools.islice(lines, block_size)), []):
+        # Parse lines in block, keeping comments in place
+        entries = []
+        for line in block:
+            linenumber += 1
+            if bulk_extractor_reader.is_comment_line(line):
+                entries.append(line)
+                continue
+            try:
+                (path, feature, context) = line[:-1].split(b"\t")
+            except ValueError as e:
+                logging.error("Error annotating feature file: %s", e)
+                logging.error("Offending line %s: %s", linenumber, line[:-1])
+                continue
+            feature_count += 1
 
-        # Increment counter if this feature was encoded
-        if b"-" in path:
-            features_encoded += 1
+            # Increment counter if this feature was encoded
+            if b"-" in path:
+                features_encoded += 1
+            entries.append((path, feature, context))
 
-        # Search for feature in database
-        tpl = rundb.search_path(path)
+        # Search for features in database
+        results = iter(
+            rundb.search_paths([e[0] for e in entries if isinstance(e, tuple)])
+        )
 
-        # Output to annotated feature file
-        outfile.write(path)
-        outfile.write(b"\t")
-        outfile.write(feature)
-        outfile.write(b"\t")
-        outfile.write(context)
+        for entry in entries:
+            if not isinstance(entry, tuple):
+                if outfile is not None:
+                    outfile.write(entry)
+                continue
+            (path, feature, context) = entry
+            result = next(results)
+            (fileinfo, file_id) = result if result else (None, None)
+            if fileinfo:
+                located_count += 1
+            else:
+                unallocated_count += 1
+
+            if feature_sink is not None:
+                feature_sink(path, feature, context, fileinfo, file_id)
+
+            if outfile is None:
+                continue
 
-        # If we found the data, output that
-        if tpl:
-            located_count += 1
+            # Output to annotated feature file
+            outfile.write(path)
             outfile.write(b"\t")
-            outfile.write(b"\t".join(tpl[2]))  # just the file info
-        else:
-            unallocated_count += 1
-        outfile.write(b"\n")
+            outfile.write(feature)
+            outfile.write(b"\t")
+            outfile.write(context)
+
+            # If we found the data, output that
+            if fileinfo:
+                outfile.write(b"\t")
+                outfile.write(b"\t".join(fileinfo))  # just the file info
+            outfile.write(b"\n")
 
     t1 = time.time()
-    for (title, value) in [
-        ["# Total features input: {}", feature_count],
-        ["# Total features located to files: {}", located_count],
-        ["# Total features in unallocated space: {}", unallocated_count],
-        ["# Total features in encoded regions: {}", features_encoded],
-        ["# Total processing time: {:.2} seconds", t1 - t0],
-    ]:
-        outfile.write((title + "\n").format(value).encode("utf-8"))
+    if outfile is not None:
+        for (title, value) in [
+            ["# Total features input: {}", feature_count],
+            ["# Total features located to files: {}", located_count],
+            ["# Total features in unallocated space: {}", unallocated_count],
+            ["# Total features in encoded regions: {}", features_encoded],
+            ["# Total processing time: {:.2} seconds", t1 - t0],
+        ]:
+            outfile.write((title + "\n").format(value).encode("utf-8"))
     return (feature_count, located_count)
 
 
-def annotate_feature_files(feature_files_dir, annotated_feature_path, dfxml_path):
+def ingest_disk_image_features(
+    feature_files_dir,
+    rundb,
+    br_session_id,
+    session,
+    args,
+    annotated_feature_path=None,
+    bulk_extractor_proc=None,
+    manifest=None,
+):
     """
-    Annotate bulk_extractor feature files for disk images
-    to associate features to files in the image.
+    Associate features in bulk_extractor feature files for disk
+    images to files in the image and write them to the database.
+
+    Each feature is matched to the id of its file from rundb where
+    known, otherwise to a file with the same path, otherwise to the
+    unallocated space placeholder.
+
+    If annotated_feature_path is provided, annotated feature files
+    are also written there in the same pass.
+
+    If bulk_extractor_proc is provided, feature files are instead
+    followed while that bulk_extractor subprocess writes them (see
+    tail_feature_files). Annotated feature files are not written in
+    this case.
+
+    If manifest (a RunManifest) is provided, features are committed
+    and checkpointed in chunks of each feature file, and reading
+    starts from the last checkpoint of a resumed run. Feature files
+    are checkpointed whole when annotated feature files are written.
 
     Based on:
     https://github.com/simsong/bulk_extractor/blob/
     master/python/identify_filenames.py
     """
+    if len(rundb) == 0:
+        raise RuntimeError("\nERROR: No files detected in DFXML\n")
+
+    file_index = FileIndex(session, br_session_id)
+    writer = BatchWriter(session, Feature.__table__, args.batch_size)
+
+    def decode(value):
+        return value.decode("utf-8", errors="surrogateescape")
+
+    def make_feature_sink(feature_file):
+        feature_type = feature_type_for_file(feature_file)
+
+        def feature_sink(path, feature, context, fileinfo, file_id):
+            # Fall back to matching by path, then to placeholder
+            if file_id is None and fileinfo:
+                file_id = file_index.get(decode(fileinfo[0]))
+            if file_id is None:
+                file_id = file_index.placeholder_id()
+            writer.add(
+                dict(
+                    feature_type=feature_type,
+                    offset=decode(path),
+                    feature=decode(feature),
+                    context=decode(context).rstrip(),
+                    dismissed=False,
+                    file=file_id,
+                )
+            )
+
+        return feature_sink
+
+    # Follow feature files while bulk_extractor is running
+    if bulk_extractor_proc is not None:
+
+        def ingest_lines(feature_file, lines):
+            if feature_file == "tcp.txt":  # not needed
+                return
+            process_featurefile2(
+                rundb, lines, feature_sink=make_feature_sink(feature_file)
+            )
+
+        tail_feature_files(
+            bulk_extractor_proc, feature_files_dir, ingest_lines, args, writer.flush
+        )
+        writer.close()
+        return
+
     # Make directory for annotated feature files
-    if not os.path.exists(annotated_feature_path):
+    if annotated_feature_path and not os.path.exists(annotated_feature_path):
         os.makedirs(annotated_feature_path)
 
-    # Read bulk_extractor report and DFXML file
-    rundb = byterundb2()
+    # Read bulk_extractor report
     report = bulk_extractor_reader.BulkReport(feature_files_dir)
-    rundb.read_xmlfile(dfxml_path)
-    if len(rundb) == 0:
-        raise RuntimeError(
-            "\nERROR: No files detected in XML file {}\n".format(dfxml_path)
-        )
-
-    # Process each feature file
     feature_file_list = report.feature_files()
     try:
         feature_file_list.remove("tcp.txt")  # not needed
     except ValueError:
         pass
+    selected = set(select_feature_files(feature_file_list, args))
+
+    # Process each feature file
     for feature_file in feature_file_list:
-        output_fn = os.path.join(annotated_feature_path, ("annotated_" + feature_file))
-        if os.path.exists(output_fn):
-            raise RuntimeError(output_fn + " exists")
-        # print("feature_file:", feature_file)
-        (feature_count, located_count) = process_featurefile2(
-            rundb, report.open(feature_file, mode="rb"), open(output_fn, "wb")
-        )
+        feature_sink = None
+        if feature_file in selected:
+            feature_sink = make_feature_sink(feature_file)
+        elif not annotated_feature_path:
+            continue
+
+        # Skip feature files completed before resumed run was interrupted
+        ff_abspath = os.path.join(feature_files_dir, feature_file)
+        size = os.path.getsize(ff_abspath)
+        start = 0
+        if manifest is not None:
+            start = manifest.feature_offset(feature_file)
+            if start > 0 and start >= size:
+                continue
+
+        # Commit and checkpoint features in chunks of feature file
+        if manifest is not None and not annotated_feature_path:
+            for (start, end) in feature_file_chunks(ff_abspath, start=start):
+                with open(ff_abspath, "rb") as f:
+                    f.seek(start)
+                    data = f.read(end - start)
+                process_featurefile2(rundb, io.BytesIO(data), None, feature_sink)
+                checkpoint_features(manifest, session, writer, feature_file, end)
+            continue
+
+        outfile = None
+        if annotated_feature_path:
+            output_fn = os.path.join(
+                annotated_feature_path, ("annotated_" + feature_file)
+            )
+            if os.path.exists(output_fn) and not (manifest and manifest.resumed):
+                raise RuntimeError(output_fn + " exists")
+            outfile = open(output_fn, "wb")
+
+        try:
+            process_featurefile2(
+                rundb, report.open(feature_file, mode="rb"), outfile, feature_sink
+            )
+        finally:
+            if outfile is not None:
+                outfile.close()
+        if manifest is not None:
+            checkpoint_features(manifest, session, writer, feature_file, size)
+    writer.close()
+
+
+def checkpoint_features(manifest, session, writer, feature_file, offset):
+    """
+    Commit buffered features and record in manifest that feature_file
+    has been read up to byte offset.
+    """
+    writer.flush()
+    feature_id = session.query(func.max(Feature.id)).scalar() or 0
+    manifest.commit_features(feature_file, offset, feature_id)
+
+
+class FeatureFileTail:
+    """
+    Follow a feature file that is being appended to by
+    bulk_extractor, tracking the byte offset read up to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def read_lines(self, final=False, max_bytes=FEATURE_CHUNK_SIZE):
+        """
+        Return list of up to about max_bytes of lines appended since
+        the last read. A line longer than max_bytes is read until it
+        ends. Unless final is True, a partial last line is left to be
+        read once it is complete.
+        """
+        with open(self.path, "rb") as f:
+            f.seek(self.offset)
+            chunks = [f.read(max_bytes)]
+            while len(chunks[-1]) == max_bytes and b"\n" not in chunks[-1]:
+                chunks.append(f.read(max_bytes))
+        data = b"".join(chunks)
+        if not (final and len(chunks[-1]) < max_bytes):
+            data = data[: data.rfind(b"\n") + 1]
+        self.offset += len(data)
+        return list(io.BytesIO(data))
+
+
+def tail_feature_files(
+    proc,
+    feature_files_dir,
+    ingest_lines,
+    args,
+    on_poll=None,
+    poll_interval=TAIL_POLL_INTERVAL,
+):
+    """
+    Read feature files in feature_files_dir while they are written
+    by bulk_extractor subprocess proc, returning once proc exits.
+
+    Every poll_interval seconds, complete lines appended to each
+    selected feature file since the last poll are passed to
+    ingest_lines(feature_file, lines), then on_poll is called if
+    provided. Once proc has exited, a final catch-up pass reads all
+    remaining lines.
+    """
+    tails = {}
+    while True:
+        finished = proc.poll() is not None
+        be_files = sorted(os.listdir(feature_files_dir))
+        for feature_file in select_feature_files(be_files, args):
+            ff_abspath = os.path.join(feature_files_dir, feature_file)
+            # Skip directories
+            if not os.path.isfile(ff_abspath):
+                continue
+            if feature_file not in tails:
+                tails[feature_file] = FeatureFileTail(ff_abspath)
+            tail = tails[feature_file]
+            for lines in iter(lambda: tail.read_lines(finished), []):
+                ingest_lines(feature_file, lines)
+        if on_poll is not None:
+            on_poll()
+        if finished:
+            return
+        time.sleep(poll_interval)
 
 
 def check_for_lightgrep(be_files):
@@ -526,21 +1996,14 @@ def check_for_lightgrep(be_files):
     return False
 
 
-def read_features_to_db(feature_files_dir, br_session_id, session, args):
+def select_feature_files(be_files, args):
     """
-    Read information from appropriate feature files
-    into database, adding feature type.
+    Return list of bulk_extractor output files in be_files
+    to read into the database, in order.
     """
-    be_files = os.listdir(feature_files_dir)
+    lightgrep = check_for_lightgrep(be_files)
+    feature_files = []
     for feature_file in be_files:
-        # Absolute path for file
-        ff_abspath = os.path.join(feature_files_dir, feature_file)
-        # Skip empty files
-        if not os.path.getsize(ff_abspath) > 0:
-            continue
-        # Skip directories
-        if os.path.isdir(ff_abspath):
-            continue
         # Skip bulk_extractor report
         if "report.xml" in feature_file:
             continue
@@ -562,7 +2025,6 @@ def read_features_to_db(feature_files_dir, br_session_id, session, args):
         if "_stopped" in feature_file:
             continue
         # Skip find if lightgrep enabled
-        lightgrep = check_for_lightgrep(be_files)
         if lightgrep:
             if "find" in feature_file:
                 continue
@@ -578,189 +2040,245 @@ def read_features_to_db(feature_files_dir, br_session_id, session, args):
         if not args.include_exif:
             if "exif" in feature_file:
                 continue
-        # Parse file and write features into db
-        if args.diskimage:
-            parse_annotated_feature_file(ff_abspath, br_session_id, session)
-        else:
-            parse_feature_file(ff_abspath, br_session_id, session)
+        feature_files.append(feature_file)
+    return feature_files
+
+
+def read_features_to_db(
+    feature_files_dir,
+    br_session_id,
+    session,
+    args,
+    bulk_extractor_proc=None,
+    manifest=None,
+    staged_src=None,
+    chunk_size=FEATURE_CHUNK_SIZE,
+):
+    """
+    Read information from appropriate feature files
+    into database, adding feature type.
 
+    If bulk_extractor_proc is provided, feature files are followed
+    while that bulk_extractor subprocess writes them (see
+    tail_feature_files).
 
-def parse_feature_file(feature_file, br_session_id, session):
-    """Write features from bulk_extractor feature file to the database
+    If manifest (a RunManifest) is provided, features are committed
+    and checkpointed after each chunk, and reading starts from the
+    last checkpoint of a resumed run.
 
-    Feature files can be encoded in one of several character encodings.
-    We read the input file as bytes and get valid Unicode for each line
-    wihout UnicodeDecodeErrors with the help bulk_extractor_reader's
-    decode_feature helper.
+    If staged_src is provided, bulk_extractor scanned a copy of the
+    source directory at that path (see stage_changed_files), and
+    forensic paths are rewritten to refer to the source directory.
+
+    With args.jobs greater than 1, feature files are parsed and
+    decoded in a pool of worker processes while this process remains
+    the only writer to the database. Feature files are split into
+    chunks of whole lines of about chunk_size bytes and results are
+    written in the same order as the serial path, so feature ordering
+    and counts are identical.
     """
-    with open(feature_file, "rb") as f:
-        for line in f:
-            line = bulk_extractor_reader.decode_feature(line)
+    file_index = FileIndex(session, br_session_id)
+    writer = BatchWriter(session, Feature.__table__, args.batch_size)
+    path_map = None
+    if staged_src is not None:
+        path_map = (staged_src, file_index.source_path)
+
+    # Follow feature files while bulk_extractor is running
+    if bulk_extractor_proc is not None:
+
+        def ingest_lines(feature_file, lines):
+            (rows, unread_lines) = parse_feature_lines(
+                lines, file_index.parent_dir, path_map
+            )
+            write_feature_rows(feature_file, rows, unread_lines, file_index, writer)
 
-            # Ignore commented lines
-            if line.startswith("#"):
-                continue
-            # Ignore blank lines
-            if not line.strip():
-                continue
+        tail_feature_files(
+            bulk_extractor_proc, feature_files_dir, ingest_lines, args, writer.flush
+        )
+        writer.close()
+        return
 
-            # Parse and clean up tab-separated lines
-            DELIMITER = "\U0010001c"
-            forensic_path = ""
-            filepath = ""
-            feature = ""
-            context = ""
-            try:
-                (forensic_path, feature, context) = line.split("\t")
-                filepath = forensic_path
-                if DELIMITER in forensic_path:
-                    filepath = forensic_path.split(DELIMITER)[0]
-                context = context.rstrip()  # strip trailing newline
-
-                # Make filepath relative to match DFXML filename
-                source_path = session.query(BRSession).get(br_session_id).source_path
-                parent_dir = os.path.split(source_path)[1] + "/"
-                filepath = filepath.replace("//", "/").split(parent_dir)[1]
-
-                # Find matching file
-                try:
-                    matching_file = (
-                        session.query(File)
-                        .filter_by(filepath=filepath, session=br_session_id)
-                        .first()
-                    )
-                except NoResultFound:
-                    logging.error(
-                        """
-                        Matching file not found for file %s.
-                        """,
-                        filepath,
-                    )
-                    continue
+    be_files = os.listdir(feature_files_dir)
+    feature_files = []
+    for feature_file in select_feature_files(be_files, args):
+        # Absolute path for file
+        ff_abspath = os.path.join(feature_files_dir, feature_file)
+        # Skip directories
+        if os.path.isdir(ff_abspath):
+            continue
+        # Skip empty files
+        if not os.path.getsize(ff_abspath) > 0:
+            continue
+        feature_files.append(ff_abspath)
+
+    # Split feature files into chunks of whole lines, starting from
+    # the last checkpoint if resuming
+    tasks = []
+    for ff_abspath in feature_files:
+        offset = 0
+        if manifest is not None:
+            offset = manifest.feature_offset(ff_abspath)
+        for (start, end) in feature_file_chunks(ff_abspath, chunk_size, offset):
+            tasks.append((ff_abspath, file_index.parent_dir, start, end, path_map))
+
+    # Parse chunks in order, in this process or in worker processes
+    if args.jobs > 1 and len(tasks) > 1:
+        logging.info("Parsing feature files with %d worker processes", args.jobs)
+        results = _parse_chunks_in_pool(tasks, args.jobs)
+    else:
+        results = (parse_feature_chunk(task) for task in tasks)
 
-                # Set feature type
-                ff_basename = os.path.basename(feature_file)
-                try:
-                    feature_type = FEATURE_LABELS[ff_basename]
-                except KeyError:
-                    feature_type = ff_basename
+    # Write features into db
+    for (task, (rows, unread_lines)) in zip(tasks, results):
+        write_feature_rows(task[0], rows, unread_lines, file_index, writer)
+        if manifest is not None:
+            checkpoint_features(manifest, session, writer, task[0], task[3])
+    writer.close()
 
-                # Write feature to database
-                postprocessed_feature = Feature(
-                    feature_type=feature_type,
-                    forensic_path=forensic_path,
-                    feature=feature,
-                    context=context,
-                    dismissed=False,
-                    file=matching_file.id,
-                )
-                session.add(postprocessed_feature)
-                session.commit()
-            except Exception:
-                logging.warning(
-                    """Error processing line in feature file %s. Unread line: %s.\
-                    """,
-                    feature_file,
-                    line,
-                )
 
+def _parse_chunks_in_pool(tasks, jobs):
+    """
+    Yield results of parse_feature_chunk for each task in order,
+    parsing up to jobs chunks at a time in worker processes.
 
-def parse_annotated_feature_file(feature_file, br_session_id, session):
-    """Write features from annotated feature file to the database
+    Only a bounded number of chunks are in flight at once so that
+    memory use does not grow if the database writer falls behind.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        task_iter = iter(tasks)
+        for task in itertools.islice(task_iter, jobs * 2):
+            pending.append(executor.submit(parse_feature_chunk, task))
+        while pending:
+            result = pending.popleft().result()
+            for task in itertools.islice(task_iter, 1):
+                pending.append(executor.submit(parse_feature_chunk, task))
+            yield result
+
+
+def feature_file_chunks(feature_file, chunk_size=FEATURE_CHUNK_SIZE, start=0):
+    """
+    Return list of (start, end) byte offsets splitting feature_file
+    from offset start into chunks of roughly chunk_size bytes that
+    end on line boundaries.
+    """
+    chunks = []
+    size = os.path.getsize(feature_file)
+    with open(feature_file, "rb") as f:
+        while start < size:
+            end = start + chunk_size
+            if end >= size:
+                end = size
+            else:
+                f.seek(end)
+                end += len(f.readline())
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+
+def parse_feature_chunk(task):
+    """
+    Parse lines in byte range of feature file.
 
-    Annotated feature files contain information about filepaths that is
-    otherwise missing from feature files describing disk images.
+    task is a tuple of (feature_file, parent_dir, start, end, path_map).
+    Return tuple of (rows, unread_lines), where each row is a tuple of
+    (forensic_path, feature, context, filepath).
 
-    Annotated feature files are written as UTF-8 so we shouldn't get
-    UnicodeDecodeErrors, but handle errors with surrogateescape just to
-    be safe.
+    Does not touch the database so that it can run in worker processes.
     """
-    with open(feature_file, "r", encoding="utf-8", errors="surrogateescape") as f:
-        for line in f:
-            # Ignore commented lines
-            if line.startswith(("#")):
-                continue
-            # Ignore blank lines
-            if not line.strip():
-                continue
+    (feature_file, parent_dir, start, end, path_map) = task
+    with open(feature_file, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    return parse_feature_lines(io.BytesIO(data), parent_dir, path_map)
 
-            # Parse tab-separated lines
-            try:
 
-                # Assume 5 values in annotated line
-                try:
-                    (offset, feature, context, filepath, blockhash) = line.split("\t")
+def parse_feature_lines(lines, parent_dir, path_map=None):
+    """Parse lines from bulk_extractor feature file
 
-                # Catch ValueError when line only has 3
-                except ValueError:
-                    (offset, feature, context) = line.split("\t")
-                    filepath = "<unallocated space>"
+    Feature files can be encoded in one of several character encodings.
+    We read the input file as bytes and get valid Unicode for each line
+    wihout UnicodeDecodeErrors with the help bulk_extractor_reader's
+    decode_feature helper.
 
-                # Try to find matching file
-                try:
-                    matching_file = (
-                        session.query(File)
-                        .filter_by(filepath=filepath, session=br_session_id)
-                        .one()
-                    )
+    If path_map is provided, it is a tuple of (scanned_path, source_path)
+    and forensic paths starting with scanned_path are rewritten to start
+    with source_path instead.
+    """
+    rows = []
+    unread_lines = []
+    for line in lines:
+        line = bulk_extractor_reader.decode_feature(line)
 
-                # If matching file doesn't exist, match to placeholder
-                except NoResultFound:
-
-                    # Use placeholder if it already exists
-                    try:
-                        matching_file = (
-                            session.query(File)
-                            .filter_by(
-                                filepath="<unallocated space>", session=br_session_id
-                            )
-                            .one()
-                        )
-
-                    # Create and use placeholder if it doesn't already exist
-                    except NoResultFound:
-                        unallocated_placeholder = File(
-                            filepath="<unallocated space>",
-                            filename="<unallocated space>",
-                            allocated=False,
-                            session=br_session_id,
-                        )
-                        session.add(unallocated_placeholder)
-                        session.commit()
-                        matching_file = (
-                            session.query(File)
-                            .filter_by(
-                                filepath="<unallocated space>", session=br_session_id
-                            )
-                            .one()
-                        )
-
-                # Set feature type
-                ff_basename = os.path.basename(feature_file).replace("annotated_", "")
-                try:
-                    feature_type = FEATURE_LABELS[ff_basename]
-                except KeyError:
-                    feature_type = ff_basename
+        # Ignore commented lines
+        if line.startswith("#"):
+            continue
+        # Ignore blank lines
+        if not line.strip():
+            continue
 
-                # Write feature to database
-                postprocessed_feature = Feature(
-                    feature_type=feature_type,
-                    offset=offset,
-                    feature=feature,
-                    context=context.rstrip(),
-                    dismissed=False,
-                    file=matching_file.id,
-                )
-                session.add(postprocessed_feature)
-                session.commit()
+        # Parse and clean up tab-separated lines
+        DELIMITER = "\U0010001c"
+        try:
+            (forensic_path, feature, context) = line.split("\t")
+            if path_map and forensic_path.startswith(path_map[0]):
+                forensic_path = path_map[1] + forensic_path[len(path_map[0]) :]
+            filepath = forensic_path
+            if DELIMITER in forensic_path:
+                filepath = forensic_path.split(DELIMITER)[0]
+            context = context.rstrip()  # strip trailing newline
 
-            except Exception:
-                logging.warning(
-                    """Error processing line in feature file %s. Unread line: %s.\
-                    """,
-                    feature_file,
-                    line,
-                )
+            # Make filepath relative to match DFXML filename
+            filepath = filepath.replace("//", "/").split(parent_dir)[1]
+
+            rows.append((forensic_path, feature, context, filepath))
+        except Exception:
+            unread_lines.append(line)
+    return (rows, unread_lines)
+
+
+def write_feature_rows(feature_file, rows, unread_lines, file_index, writer):
+    """
+    Match parsed feature rows to files and write them to the database.
+    """
+    feature_type = feature_type_for_file(feature_file)
+    for line in unread_lines:
+        logging.warning(
+            """Error processing line in feature file %s. Unread line: %s.\
+            """,
+            feature_file,
+            line,
+        )
+    for (forensic_path, feature, context, filepath) in rows:
+        # Find matching file
+        file_id = file_index.get(filepath)
+        if file_id is None:
+            logging.error("Matching file not found for file %s.", filepath)
+            continue
+
+        # Write feature to database
+        writer.add(
+            dict(
+                feature_type=feature_type,
+                forensic_path=forensic_path,
+                feature=feature,
+                context=context,
+                dismissed=False,
+                file=file_id,
+            )
+        )
+
+
+def feature_type_for_file(feature_file):
+    """
+    Return human-readable feature type for feature file.
+    """
+    ff_basename = os.path.basename(feature_file)
+    try:
+        return FEATURE_LABELS[ff_basename]
+    except KeyError:
+        return ff_basename
 
 
 def dict_factory(cursor, row):
@@ -770,89 +2288,526 @@ def dict_factory(cursor, row):
     return d
 
 
-def brv_to_json(brv_path, json_path):
+def brv_to_json(brv_path, json_path, chunk_size=DEFAULT_BATCH_SIZE):
     """
     Write output file containing JSON representation
     of information in input .brv Bulk Reviewer database.
+
+    Files and features are serialized straight from the database
+    cursor chunk_size rows at a time, so memory use does not grow
+    with the size of the session. Output is identical to dumping the
+    whole session with json.dump(..., indent=2).
     """
 
     # Open db connection and get cursor
     conn = sqlite3.connect(brv_path)
     conn.row_factory = dict_factory
     cursor = conn.cursor()
+    rows_cursor = conn.cursor()
+    rows_cursor.row_factory = None
 
-    # SessionInfo
-    session_info = dict()
-    files = []
-    features = []
-
-    # Fetch session data from sqlite db and save to dictionary
+    try:
+        # Fetch session data from sqlite db
+        session_info = _read_session_info(cursor)
+
+        # Write JSON to file, replacing sqlite integer boolean values
+        # with Python booleans
+        with open(json_path, "w", encoding="utf-8", errors="ignore") as outfile:
+            outfile.write("{")
+            for (key, value) in session_info.items():
+                outfile.write("\n  {}: {},".format(_to_json(key), _to_json(value)))
+
+            rows_cursor.execute(FILES_SQL_QUERY, (session_info["id"],))
+            outfile.write('\n  "files": ')
+            _write_json_rows(
+                outfile,
+                _cursor_columns(rows_cursor),
+                rows_cursor,
+                FILE_BOOLEAN_COLUMNS,
+                chunk_size,
+            )
+            outfile.write(",")
+
+            rows_cursor.execute(FEATURES_SQL_QUERY + " ORDER BY f.id;")
+            outfile.write('\n  "features": ')
+            _write_json_rows(
+                outfile,
+                _cursor_columns(rows_cursor),
+                rows_cursor,
+                FEATURE_BOOLEAN_COLUMNS,
+                chunk_size,
+            )
+            outfile.write("\n}")
+    finally:
+        # Close sqlite connection
+        rows_cursor.close()
+        cursor.close()
+        conn.close()
+
+
+def _to_json(value):
+    # Fast paths for the types stored in the database
+    if isinstance(value, str):
+        return json.encoder.encode_basestring(value)
+    if value is None:
+        return "null"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if type(value) is int:
+        return int.__repr__(value)
+    return _json_encoder.encode(value)
+
+
+def _read_session_info(cursor):
     cursor.execute("SELECT * from session;")
     session_info = cursor.fetchone()
+    for column in SESSION_BOOLEAN_COLUMNS:
+        if column in session_info:
+            session_info[column] = session_info[column] == 1
+    return session_info
 
-    # Add files to dictionary
-    files_sql_query = """\
-        SELECT fl.*, \
-        (SELECT COUNT(*) from feature f where f.file = fl.id) \
-            as feature_count \
-        from file fl
-        WHERE session='{}';
-        """.format(
-        session_info["id"]
-    )
-    cursor.execute(files_sql_query)
-    files = cursor.fetchall()
-    session_info["files"] = files
-
-    # Add features to dictionary with filepaths
-    features_sql_query = """\
-        SELECT f.id, f.feature_type, f.forensic_path, \
-            f.offset, f.feature, f.context, f.note, \
-            f.dismissed, f.file, fl.filepath
-        from feature f, file fl
-        WHERE f.file = fl.id
-        """.format(
-        session_info["id"]
-    )
-    cursor.execute(features_sql_query)
-    features = cursor.fetchall()
-    session_info["features"] = features
 
-    # Replace sqlite integer boolean values in dict with Python booleans
-    if session_info["disk_image"] == 1:
-        session_info["disk_image"] = True
-    else:
-        session_info["disk_image"] = False
+def _cursor_columns(cursor):
+    return [column[0] for column in cursor.description]
 
-    if session_info["named_entity_extraction"] == 1:
-        session_info["named_entity_extraction"] = True
-    else:
-        session_info["named_entity_extraction"] = False
 
-    for index, file_dict in enumerate(session_info["files"]):
-        if file_dict["allocated"] == 1:
-            session_info["files"][index]["allocated"] = True
-        else:
-            session_info["files"][index]["allocated"] = False
+def _write_json_rows(
+    outfile, columns, rows, boolean_columns=(), chunk_size=DEFAULT_BATCH_SIZE
+):
+    """
+    Write rows (tuples of values for columns) to outfile as JSON array
+    of objects nested one level deep in an object, converting
+    boolean_columns to booleans.
+    """
+    prefixes = ["{}: ".format(_to_json(column)) for column in columns]
+    booleans = [column in boolean_columns for column in columns]
+    rows = iter(rows)
+    first = True
+    for block in iter(lambda: list(itertools.islice(rows, chunk_size)), []):
+        chunk = []
+        for row in block:
+            values = []
+            for (prefix, is_boolean, value) in zip(prefixes, booleans, row):
+                if is_boolean:
+                    value = value == 1
+                values.append(prefix + _to_json(value))
+            chunk.append("{\n      " + ",\n      ".join(values) + "\n    }")
+        outfile.write("[\n    " if first else ",\n    ")
+        outfile.write(",\n    ".join(chunk))
+        first = False
+    outfile.write("[]" if first else "\n  ]")
+
+
+def brv_to_pages(brv_path, session_dir, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Write sharded JSON representation of information in input .brv
+    Bulk Reviewer database to session_dir, for sessions too large to
+    load from a single JSON file.
+
+    session_dir contains:
+    - session.json: session info, count of features of each type and
+      index of feature pages
+    - files.json: list of files, as in the "files" of brv_to_json
+    - pages/: feature pages, each holding up to page_size features of
+      one type in order of id, as in the "features" of brv_to_json
+
+    Pages can be rewritten individually with write_session_page and
+    update_session_pages. Return path to session.json.
+    """
+    if os.path.exists(session_dir):
+        shutil.rmtree(session_dir)
+    os.makedirs(os.path.join(session_dir, SESSION_PAGES_DIR))
+
+    conn = sqlite3.connect(brv_path)
+    conn.row_factory = dict_factory
+    cursor = conn.cursor()
+    rows_cursor = conn.cursor()
+    rows_cursor.row_factory = None
+
+    try:
+        session_info = _read_session_info(cursor)
+
+        _write_session_files_file(session_dir, rows_cursor, session_info["id"])
+
+        # Feature pages for each feature type
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS ix_feature_type ON feature (feature_type)"
+        )
+        cursor.execute(
+            """\
+            SELECT feature_type, COUNT(*) as feature_count from feature
+            GROUP BY feature_type ORDER BY MIN(id);
+            """
+        )
+        feature_counts = collections.OrderedDict(
+            (row["feature_type"], row["feature_count"]) for row in cursor.fetchall()
+        )
+        pages = []
+        for feature_type in feature_counts:
+            rows_cursor.execute(
+                FEATURES_SQL_QUERY + " AND f.feature_type = ? ORDER BY f.id;",
+                (feature_type,),
+            )
+            columns = _cursor_columns(rows_cursor)
+            for block in iter(
+                lambda: list(itertools.islice(rows_cursor, page_size)), []
+            ):
+                page_info = collections.OrderedDict(
+                    page=len(pages) + 1,
+                    feature_type=feature_type,
+                    count=len(block),
+                    first_id=block[0][0],
+                    last_id=block[-1][0],
+                )
+                page_info["path"] = _session_page_path(page_info["page"])
+                _write_session_page_file(session_dir, page_info, columns, block)
+                pages.append(page_info)
+    finally:
+        rows_cursor.close()
+        cursor.close()
+        conn.close()
+
+    # Session manifest
+    manifest = collections.OrderedDict(session_info)
+    manifest["files_path"] = SESSION_FILES_FILENAME
+    manifest["page_size"] = page_size
+    manifest["feature_counts"] = feature_counts
+    manifest["pages"] = pages
+    manifest_path = os.path.join(session_dir, SESSION_MANIFEST_FILENAME)
+    _write_json_file(manifest_path, manifest)
+    return manifest_path
+
+
+def write_session_page(brv_path, session_dir, page_number):
+    """
+    Rewrite page page_number of sharded output in session_dir from
+    the features in .brv database at brv_path.
+    """
+    manifest = load_session_manifest(session_dir)
+    page_info = manifest["pages"][page_number - 1]
+    conn = sqlite3.connect(brv_path)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            FEATURES_SQL_QUERY
+            + " AND f.feature_type = ? AND f.id BETWEEN ? AND ? ORDER BY f.id;",
+            (page_info["feature_type"], page_info["first_id"], page_info["last_id"]),
+        )
+        _write_session_page_file(
+            session_dir, page_info, _cursor_columns(cursor), cursor
+        )
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def update_session_pages(session_dir, feature_updates):
+    """
+    Apply reviewer changes to features in sharded output in
+    session_dir, rewriting only the pages that hold them.
+
+    feature_updates maps feature ids to dicts of new values for
+    "dismissed" and/or "note". Return list of numbers of pages updated.
+    """
+    for update in feature_updates.values():
+        unknown = set(update) - {"dismissed", "note"}
+        if unknown:
+            raise ValueError("Cannot update feature fields: {}".format(unknown))
+    pending = dict(feature_updates)
+    updated_pages = []
+    for page_info in load_session_manifest(session_dir)["pages"]:
+        if not pending:
+            break
+        if not any(
+            page_info["first_id"] <= feature_id <= page_info["last_id"]
+            for feature_id in pending
+        ):
+            continue
+        page_path = os.path.join(session_dir, page_info["path"])
+        with open(page_path, "r", encoding="utf-8") as f:
+            page = json.load(f, object_pairs_hook=collections.OrderedDict)
+        changed = False
+        for feature in page["features"]:
+            update = pending.pop(feature["id"], None)
+            if update is not None:
+                feature.update(update)
+                changed = True
+        if changed:
+            _write_json_file(page_path, page)
+            updated_pages.append(page_info["page"])
+    return updated_pages
+
+
+def load_session_manifest(session_dir):
+    """Return session manifest of sharded output in session_dir"""
+    manifest_path = os.path.join(session_dir, SESSION_MANIFEST_FILENAME)
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f, object_pairs_hook=collections.OrderedDict)
+
+
+def _write_session_files_file(session_dir, cursor, br_session_id):
+    files_path = os.path.join(session_dir, SESSION_FILES_FILENAME)
+    tmp_path = files_path + ".tmp"
+    cursor.execute(FILES_SQL_QUERY, (br_session_id,))
+    with open(tmp_path, "w", encoding="utf-8", errors="ignore") as outfile:
+        outfile.write('{\n  "files": ')
+        _write_json_rows(
+            outfile, _cursor_columns(cursor), cursor, FILE_BOOLEAN_COLUMNS
+        )
+        outfile.write("\n}")
+    os.replace(tmp_path, files_path)
+
+
+def _session_page_path(page_number):
+    return "{}/{:06d}.json".format(SESSION_PAGES_DIR, page_number)
+
+
+def _write_session_page_file(session_dir, page_info, columns, rows):
+    page_path = os.path.join(session_dir, page_info["path"])
+    tmp_path = page_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", errors="ignore") as outfile:
+        outfile.write("{")
+        for key in ("page", "feature_type"):
+            outfile.write("\n  {}: {},".format(_to_json(key), _to_json(page_info[key])))
+        outfile.write('\n  "features": ')
+        _write_json_rows(outfile, columns, rows, FEATURE_BOOLEAN_COLUMNS)
+        outfile.write("\n}")
+    os.replace(tmp_path, page_path)
 
-        if file_dict["verified"] == 1:
-            session_info["files"][index]["verified"] = True
-        else:
-            session_info["files"][index]["verified"] = False
 
-    for index, feature_dict in enumerate(session_info["features"]):
-        if feature_dict["dismissed"] == 1:
-            session_info["features"][index]["dismissed"] = True
+def _write_json_file(path, data):
+    """Write data to JSON file at path, replacing it atomically"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", errors="ignore") as outfile:
+        json.dump(data, outfile, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def json_to_brv(json_path, db_path, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Write .brv Bulk Reviewer database at db_path from session output
+    at json_path, either a JSON file written by brv_to_json or the
+    session.json manifest of sharded output. Ids of files and features
+    are kept.
+    """
+    remove_database(db_path)
+    engine = create_database_engine(db_path)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            session_dict = json.load(f)
+        if "pages" in session_dict:
+            session_dir = os.path.dirname(json_path)
+            with open(
+                os.path.join(session_dir, session_dict["files_path"]),
+                "r",
+                encoding="utf-8",
+            ) as f:
+                files = json.load(f)["files"]
+            features = _session_page_features(session_dir, session_dict["pages"])
         else:
-            session_info["features"][index]["dismissed"] = False
+            files = session_dict["files"]
+            features = session_dict["features"]
+
+        for (table, rows) in (
+            (BRSession.__table__, [session_dict]),
+            (File.__table__, files),
+            (Feature.__table__, features),
+        ):
+            columns = [column.name for column in table.columns]
+            writer = BatchWriter(session, table, batch_size)
+            for row in rows:
+                writer.add({column: row.get(column) for column in columns})
+            writer.close()
+        create_indexes(session)
+    finally:
+        session.close()
+        engine.dispose()
+    restore_database_settings(db_path)
+
+
+def _session_page_features(session_dir, pages):
+    for page_info in pages:
+        with open(
+            os.path.join(session_dir, page_info["path"]), "r", encoding="utf-8"
+        ) as f:
+            for feature in json.load(f)["features"]:
+                yield feature
+
+
+def save_session_output(db_path, json_path, changed_features, changed_files):
+    """
+    Write reviewer changes in .brv database at db_path to session
+    output at json_path it was loaded from. Sharded output is updated
+    in place, rewriting only the pages holding changed_features and
+    the files list if changed_files is not empty. Return json_path.
+    """
+    session_dir = os.path.dirname(json_path)
+    if os.path.basename(json_path) != SESSION_MANIFEST_FILENAME:
+        brv_to_json(db_path, json_path)
+        return json_path
+
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    try:
+        if changed_files:
+            session_id = cursor.execute("SELECT id from session;").fetchone()[0]
+            _write_session_files_file(session_dir, cursor, session_id)
+        updates = {}
+        feature_ids = sorted(changed_features)
+        for i in range(0, len(feature_ids), DEFAULT_BATCH_SIZE):
+            block = feature_ids[i : i + DEFAULT_BATCH_SIZE]
+            cursor.execute(
+                "SELECT id, dismissed, note from feature WHERE id IN ({});".format(
+                    ", ".join("?" * len(block))
+                ),
+                block,
+            )
+            for (feature_id, dismissed, note) in cursor:
+                updates[feature_id] = {"dismissed": dismissed == 1, "note": note}
+    finally:
+        cursor.close()
+        conn.close()
+    update_session_pages(session_dir, updates)
+    return json_path
+
+
+def create_database_engine(db_path):
+    """
+    Return SQLAlchemy engine for ingesting into session database at
+    db_path, with INGEST_PRAGMAS set on each connection. Call
+    restore_database_settings once the engine is disposed if the
+    database is kept.
+    """
+    engine = create_engine("sqlite:///{}".format(db_path))
+
+    @event.listens_for(engine, "connect")
+    def set_ingest_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in INGEST_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
+def restore_database_settings(db_path):
+    """
+    Checkpoint WAL of database at db_path ingested with INGEST_PRAGMAS
+    and switch it back to SQLite's default rollback journal. The other
+    pragmas only apply to the connections that set them, so later
+    connections get SQLite's durable defaults.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        conn.close()
+
+
+def create_indexes(session):
+    """Create INGEST_INDEXES once ingest is complete"""
+    start_time = time.time()
+    for index in INGEST_INDEXES:
+        session.execute(text(index))
+    session.commit()
+    logging.info("Created indexes in %.2f seconds", time.time() - start_time)
+
+
+def remove_database(db_path):
+    """Delete database at db_path along with its WAL files"""
+    for path in (db_path, db_path + "-wal", db_path + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
 
-    # Write dictionary as JSON to file
-    with open(json_path, "w", encoding="utf-8", errors="ignore") as outfile:
-        return json.dump(session_info, outfile, ensure_ascii=False, indent=2)
 
-    # Close sqlite connection
-    cursor.close()
-    conn.close()
+def file_digest(path):
+    """Return SHA-256 hex digest of file at path"""
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def input_fingerprint(src, args, ssn_mode):
+    """
+    Return dict identifying the source and settings of a processing
+    run, used to check that a resumed run has the same inputs.
+
+    The source is identified by source_identity, from the sizes and
+    modification times of the disk image or of every file in the
+    directory rather than their contents, so that fingerprinting is
+    cheap.
+    """
+    regex_digest = None
+    if args.regex:
+        regex_digest = file_digest(args.regex)
+    be_reports = None
+    if args.be_reports:
+        be_reports = os.path.abspath(args.be_reports)
+    previous_session = None
+    if args.previous_session:
+        previous_session = file_digest(args.previous_session)
+    return dict(
+        source=src,
+        source_identity=source_identity(src),
+        disk_image=args.diskimage,
+        ssn_mode=ssn_mode,
+        regex=regex_digest,
+        stoplists=stoplist_digests(args.stoplists),
+        include_exif=args.include_exif,
+        include_network=args.include_network,
+        be_reports=be_reports,
+        previous_session=previous_session,
+        rescan_hashes=args.rescan_hashes,
+    )
+
+
+def stoplist_digests(stoplist_dir):
+    """Return dict of names to SHA-256 digests of stoplists in stoplist_dir"""
+    digests = dict()
+    if stoplist_dir:
+        for f in sorted(os.listdir(stoplist_dir)):
+            if f.endswith(".txt"):
+                digests[f] = file_digest(os.path.join(stoplist_dir, f))
+    return digests
+
+
+def stoplists_digest(stoplist_dir):
+    """
+    Return SHA-256 digest identifying names and contents of stoplists
+    in stoplist_dir, recorded in session table, or None if there are
+    none.
+    """
+    digests = stoplist_digests(stoplist_dir)
+    if not digests:
+        return None
+    return hashlib.sha256(
+        json.dumps(digests, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def rollback_incomplete_stages(session, manifest):
+    """
+    Delete rows written to database by stages of a resumed run that
+    did not complete, so that they can be repeated from their last
+    checkpoint.
+    """
+    if not manifest.is_complete("files"):
+        manifest.reset("files")
+        session.query(Feature).delete()
+        session.query(File).delete()
+    elif not manifest.is_complete("bulk_extractor"):
+        manifest.reset("bulk_extractor")
+        session.query(Feature).delete()
+    elif not manifest.is_complete("features"):
+        session.query(Feature).filter(Feature.id > manifest.feature_id).delete()
+    session.commit()
 
 
 def _configure_logging(bulk_reviewer_dir):
@@ -866,6 +2821,49 @@ def _configure_logging(bulk_reviewer_dir):
     root_logger.addHandler(handler)
 
 
+def serve_session(json_path, dest, name):
+    """
+    Serve queries and reviewer changes for session output at
+    json_path, using .brv database in dest reloaded from the session
+    output when it has changed.
+    """
+    db_path = os.path.join(dest, name + ".brv")
+    logging.info(
+        "Running script in server mode. JSON file: %s. Database: %s.",
+        json_path,
+        db_path,
+    )
+    if not os.path.isfile(json_path):
+        print_to_stderr_and_exit("Session file {} not found.".format(json_path))
+    try:
+        if not (
+            os.path.exists(db_path)
+            and os.path.getmtime(db_path) >= os.path.getmtime(json_path)
+        ):
+            if not os.path.exists(dest):
+                os.makedirs(dest)
+            start_time = time.time()
+            json_to_brv(json_path, db_path)
+            logging.info(
+                "Loaded session into database in %.2f seconds", time.time() - start_time
+            )
+    except Exception as e:
+        logging.error("Error loading session %s into database: %s", json_path, e)
+        remove_database(db_path)
+        print_to_stderr_and_exit("Error loading session.")
+
+    def save(changed_features, changed_files):
+        save_session_output(db_path, json_path, changed_features, changed_files)
+        # Session output is now as new as database
+        now = time.time()
+        os.utime(db_path, (now, now))
+        logging.info("Saved changes to %s", json_path)
+        return json_path
+
+    SessionServer(db_path, save).serve()
+    logging.info("Server stopped")
+
+
 def _make_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--quiet", help="", action="store_true")
@@ -905,7 +2903,7 @@ def _make_parser():
     )
     parser.add_argument(
         "--export",
-        help="Use script in export mode (export files based on JSON input)",
+        help="Use script in export mode (export files based on JSON or .brv input)",
         action="store_true",
     )
     parser.add_argument(
@@ -935,6 +2933,142 @@ def _make_parser():
         help="Generate tar exclude file. Used in tandem with --export flag",
         action="store_true",
     )
+    parser.add_argument(
+        "--export_threads",
+        help="Number of threads copying files from directories. \
+              Used in tandem with --export flag",
+        action="store",
+        type=int,
+        default=DEFAULT_COPY_THREADS,
+    )
+    parser.add_argument(
+        "--dfxml",
+        help="DFXML with byte runs of files to carve from disk image \
+              (default: dfxml.xml in reports directory next to JSON). \
+              Used in tandem with --export flag",
+        action="store",
+    )
+    parser.add_argument(
+        "--archive",
+        help="Write exported files to tar or zip archive at destination instead \
+              of directory (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz or .zip). \
+              Used in tandem with --export flag",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--manifest",
+        help="Hash exported files as they are copied or carved and write MD5 \
+              and SHA-256 manifests and a fixity report with the export. \
+              Used in tandem with --export flag",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--link",
+        help="Export files from directories as hardlinks or copy-on-write \
+              reflinks when destination is on the same filesystem as source, \
+              copying files that can't be linked. Hardlinks share data with \
+              source files, so changes to exported files change the source. \
+              Used in tandem with --export flag",
+        action="store",
+        choices=LINK_MODES,
+    )
+    parser.add_argument(
+        "--serve",
+        help="Use script in server mode (serve queries and changes to JSON input \
+              as JSON-RPC over stdin/stdout)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch_size",
+        help="Number of rows written to database per transaction during ingest",
+        action="store",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+    )
+    parser.add_argument(
+        "--stream_dfxml",
+        help="Parse fiwalk output as it is produced instead of reading dfxml.xml",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--keep_dfxml",
+        help="Write dfxml.xml to reports directory when using --stream_dfxml",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--concurrent",
+        help="Run bulk_extractor while file metadata is read into the database",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--tail_features",
+        help="Read feature files to database while bulk_extractor is running",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--previous_session",
+        help="Scan only files new or changed since previous session (JSON file)",
+        action="store",
+    )
+    parser.add_argument(
+        "--rescan_hashes",
+        help="Record SHA-256 of files and compare with previous session",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no_report_cache",
+        help="Don't reuse or cache bulk_extractor reports of scans with the \
+              same source and bulk_extractor options",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--report_cache_hash",
+        help="Identify source by SHA-256 of its contents as well as size and \
+              modified date when reusing cached bulk_extractor reports and \
+              disk image file tables",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--no_dfxml_cache",
+        help="Don't reuse or cache file tables and byte runs read from DFXML of \
+              disk images processed before (requires NumPy)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resume",
+        help="Resume interrupted run, skipping completed stages",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--annotated_reports",
+        help="Write annotated feature files for disk images to reports directory",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--jobs",
+        help="Number of worker processes used to parse feature files",
+        action="store",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--keep_db",
+        help="Keep .brv database in reports directory for use with --export \
+              (refused once review changes are saved to session JSON)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sharded",
+        help="Write session as manifest, files list and pages of features",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--page_size",
+        help="Number of features per page of sharded session output",
+        action="store",
+        type=int,
+        default=DEFAULT_PAGE_SIZE,
+    )
     parser.add_argument("source", help="Path to source directory or disk image")
     parser.add_argument("destination", help="Path to directory to write output files")
     parser.add_argument("filename", help="Filename for output file (no extension)")
@@ -950,9 +3084,16 @@ def main():
     # Save references to filepaths for source and outputs
     src = os.path.abspath(args.source)
     dest = os.path.abspath(args.destination)
-    temp_dir = tempfile.mkdtemp()
-    db_path = os.path.join(temp_dir, args.filename + ".brv")
     reports_path = os.path.join(dest, args.filename + "_reports")
+    db_path = os.path.join(reports_path, args.filename + ".brv")
+    manifest_path = os.path.join(reports_path, "run_manifest.json")
+    json_path = os.path.join(dest, args.filename + ".json")
+    session_dir = os.path.join(dest, args.filename + "_session")
+    output_path = (
+        os.path.join(session_dir, SESSION_MANIFEST_FILENAME)
+        if args.sharded
+        else json_path
+    )
     dfxml_path = os.path.join(reports_path, "dfxml.xml")
     annotated_feature_path = os.path.join(reports_path, "bulk_extractor_annotated")
     user_home_dir = os.path.abspath(os.path.expanduser("~"))
@@ -986,43 +3127,101 @@ def main():
             args.restore_dates,
             args.unallocated,
             args.tar,
+            args.export_threads,
+            os.path.abspath(args.dfxml) if args.dfxml else None,
+            args.archive,
+            args.manifest,
+            args.link,
         )
         file_export.export_files()
         return
 
+    # If script run in server mode, serve session and return
+    if args.serve:
+        serve_session(src, dest, args.filename)
+        return
+
     # Otherwise, log starting message and continue
     logging.info(
         "Running script in processing mode. Name: %s. Source: %s.", args.filename, src
     )
 
+    # Load previous session to rescan source against
+    previous_session = None
+    if args.previous_session:
+        if args.diskimage or args.be_reports:
+            print_to_stderr_and_exit(
+                "Rescan against previous session only supported for directories."
+            )
+        try:
+            with open(args.previous_session, "r", encoding="utf-8") as f:
+                previous_session = json.load(f)
+        except Exception as e:
+            logging.error(
+                "Error reading previous session %s: %s", args.previous_session, e
+            )
+            print_to_stderr_and_exit("Error reading previous session JSON file.")
+
     # Create output directories
     for out_dir in dest, reports_path, bulk_extractor_path:
         if not os.path.isdir(out_dir):
             os.makedirs(out_dir)
 
-    # Create database and session
-    engine = create_engine("sqlite:///{}".format(db_path))
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
     # Set ssn mode - default to 1 if not provided
     if args.ssn in (0, 2):
         ssn_mode = args.ssn
     else:
         ssn_mode = 1
 
+    # Load manifest of previous run if resuming with the same inputs,
+    # otherwise start a new run
+    manifest = RunManifest(manifest_path, input_fingerprint(src, args, ssn_mode))
+    if args.resume and manifest.load():
+        if manifest.is_complete("json") and os.path.exists(output_path):
+            logging.info("Run already complete")
+            sys.stdout.buffer.write(output_path.encode("utf-8"))
+            return
+        if not os.path.exists(db_path):
+            logging.warning("Database of run to resume not found: %s", db_path)
+            manifest = RunManifest(manifest_path, manifest.inputs)
+    if manifest.resumed:
+        logging.info("Resuming run. Completed stages: %s", ", ".join(manifest.stages))
+        # Byte run index can't be rebuilt if DFXML was only streamed
+        if args.diskimage and not manifest.is_complete("features"):
+            if not os.path.exists(dfxml_path):
+                manifest.reset("files")
+    else:
+        if args.resume:
+            logging.warning("No run to resume found. Starting new run.")
+        remove_database(db_path)
+        manifest.save()
+        # Provided reports stand in for bulk_extractor stage
+        if args.be_reports:
+            manifest.complete("bulk_extractor")
+
+    # Create database and session
+    engine = create_database_engine(db_path)
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
     # Save BR session info to db
-    br_session = BRSession(
-        name=args.filename,
-        source_path=src,
-        disk_image=args.diskimage,
-        named_entity_extraction=args.named_entity_extraction,
-        regex_file=args.regex,
-        ssn_mode=ssn_mode,
-    )
-    session.add(br_session)
-    session.commit()
+    if manifest.resumed:
+        rollback_incomplete_stages(session, manifest)
+    else:
+        br_session = BRSession(
+            name=args.filename,
+            source_path=src,
+            disk_image=args.diskimage,
+            named_entity_extraction=args.named_entity_extraction,
+            regex_file=args.regex,
+            ssn_mode=ssn_mode,
+            include_exif=args.include_exif,
+            include_network=args.include_network,
+            stoplists=stoplists_digest(args.stoplists),
+        )
+        session.add(br_session)
+        session.commit()
 
     # Store br_session_id
     try:
@@ -1034,22 +3233,185 @@ def main():
         logging.error("JSON file with same name already exists. Quitting")
         print_to_stderr_and_exit("JSON file with same name already exists.")
 
+    # Directory rescan - Write file info to db, carry over reviewer
+    # notes for unchanged files and stage new and changed files for
+    # bulk_extractor to scan instead of the whole source
+    scan_src = src
+    staging_dir = os.path.join(reports_path, "rescan_staging")
+    unchanged_files = None
+    if previous_session is not None:
+        if not manifest.is_complete("files"):
+            logging.info("Writing source file metadata to database")
+            write_filesystem_metadata_to_db(
+                session, br_session_id, src, args.batch_size, args.rescan_hashes
+            )
+        unchanged_files = rescan_unchanged_files(
+            session, br_session_id, previous_session, args.rescan_hashes
+        )
+        scan_src = os.path.join(staging_dir, os.path.basename(src))
+        if not manifest.is_complete("files"):
+            carry_over_file_notes(
+                session, br_session_id, previous_session, unchanged_files
+            )
+            changed_files = [
+                filepath
+                for filepath in FileIndex(session, br_session_id).ids
+                if filepath not in unchanged_files
+            ]
+            logging.info(
+                "Staging %d new or changed files for bulk_extractor",
+                len(changed_files),
+            )
+            stage_changed_files(src, staging_dir, changed_files)
+            manifest.complete("files")
+            if not changed_files:
+                logging.info("No new or changed files to scan")
+                manifest.complete("bulk_extractor")
+
+    # Clear output of interrupted bulk_extractor run before rerunning it
+    run_bulk_extractor_stage = not (
+        args.be_reports or manifest.is_complete("bulk_extractor")
+    )
+    if manifest.resumed and run_bulk_extractor_stage:
+        shutil.rmtree(bulk_extractor_path)
+        os.makedirs(bulk_extractor_path)
+
+    # Start bulk_extractor in the background to run while file
+    # metadata is read, if requested and reports aren't already provided
+    stoplist_dir = ""
+    if args.stoplists:
+        stoplist_dir = os.path.abspath(args.stoplists)
+
+    # Reuse reports of an earlier scan of the same source with the same
+    # bulk_extractor options if cached. Rescans only scan changed files.
+    report_cache = None
+    use_report_cache = previous_session is None and not args.no_report_cache
+    if run_bulk_extractor_stage and use_report_cache:
+        report_cache = ReportCache(
+            os.path.join(bulk_reviewer_dir, REPORT_CACHE_DIRNAME),
+            report_cache_key(src, args, ssn_mode, stoplist_dir),
+        )
+        try:
+            if report_cache.restore(bulk_extractor_path):
+                logging.info(
+                    "Reusing cached bulk_extractor reports %s", report_cache.entry_path
+                )
+                manifest.complete("bulk_extractor")
+                run_bulk_extractor_stage = False
+                report_cache = None
+        except OSError as e:
+            logging.warning("Unable to reuse cached bulk_extractor reports: %s", e)
+            shutil.rmtree(bulk_extractor_path)
+            os.makedirs(bulk_extractor_path)
+
+    bulk_extractor_proc = None
+    if (args.concurrent or args.tail_features) and run_bulk_extractor_stage:
+        logging.info("Starting bulk_extractor")
+        bulk_extractor_proc = start_bulk_extractor(
+            scan_src, bulk_extractor_path, stoplist_dir, ssn_mode, args
+        )
+        if bulk_extractor_proc is None:
+            print_to_stderr_and_exit("Error running bulk_extractor.")
+
     # Disk image - Write file info to db
+    rundb = None
     if args.diskimage:
+        if numpy is not None:
+            rundb = ByteRunIndex()
+
+        # Read file table and byte run index from cache if image was
+        # processed before with the same version of fiwalk
+        dfxml_cache = None
+        cached_rundb = None
+        use_dfxml_cache = numpy is not None and not args.no_dfxml_cache
+        if use_dfxml_cache and not manifest.is_complete("files"):
+            dfxml_cache = DfxmlCache(
+                os.path.join(bulk_reviewer_dir, DFXML_CACHE_DIRNAME),
+                dfxml_cache_key(src, args),
+            )
+            try:
+                cached_rundb = dfxml_cache.load(
+                    session, br_session_id, dfxml_path, args.batch_size
+                )
+            except (OSError, ValueError, struct.error) as e:
+                logging.warning(
+                    "Unable to read cached file table %s: %s", dfxml_cache.entry_path, e
+                )
+                session.query(File).delete()
+                session.commit()
 
-        # Create dfxml
-        logging.info("Creating DFXML")
-        dfxml_success = create_dfxml(src, dfxml_path)
-        if dfxml_success is False:
-            print_to_stderr_and_exit("fiwalk unable to create DFXML.")
+        # Rebuild byte run index from DFXML file if file info was
+        # already written to db by resumed run
+        if manifest.is_complete("files"):
+            if not manifest.is_complete("features"):
+                logging.info("Reading byte runs from DFXML")
+                try:
+                    if rundb is None:
+                        rundb = byterundb2()
+                        rundb.read_xmlfile(dfxml_path)
+                    else:
+                        link_dfxml_to_db(session, br_session_id, dfxml_path, rundb)
+                except Exception as e:
+                    logging.error("Error parsing DFXML file %s: %s", dfxml_path, e)
+                    print_to_stderr_and_exit("Error parsing DFXML file.")
+
+        elif cached_rundb is not None:
+            logging.info("Read file table from cache %s", dfxml_cache.entry_path)
+            rundb = cached_rundb
+            dfxml_cache = None
+            manifest.complete("dfxml")
+            manifest.complete("files")
+
+        # Stream fiwalk output directly to db, building byte run index
+        # in the same pass if NumPy is available. The DFXML is only
+        # written to disk if requested or needed to build the index.
+        elif args.stream_dfxml:
+            tee_path = None
+            if args.keep_dfxml or rundb is None:
+                tee_path = dfxml_path
+            logging.info("Streaming DFXML from fiwalk to database")
+            try:
+                with FiwalkStream(src, tee_path) as dfxml_stream:
+                    parse_dfxml_to_db(
+                        session, br_session_id, dfxml_stream, args.batch_size, rundb
+                    )
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.error("Error creating DFXML with fiwalk: %s", e)
+                print_to_stderr_and_exit("fiwalk unable to create DFXML.")
+            except Exception as e:
+                logging.error("Error parsing DFXML from fiwalk: %s", e)
+                print_to_stderr_and_exit("Error parsing DFXML file.")
+            if tee_path:
+                manifest.complete("dfxml")
+            manifest.complete("files")
 
-        # Parse dfxml to db
-        logging.info("Parsing DFXML to database")
-        try:
-            parse_dfxml_to_db(session, br_session_id, dfxml_path)
-        except Exception as e:
-            logging.error("Error parsing DFXML file %s: %s", dfxml_path, e)
-            print_to_stderr_and_exit("Error parsing DFXML file.")
+        # Otherwise create dfxml file and parse it to db
+        else:
+            if not manifest.is_complete("dfxml"):
+                logging.info("Creating DFXML")
+                dfxml_success = create_dfxml(src, dfxml_path)
+                if dfxml_success is False:
+                    print_to_stderr_and_exit("fiwalk unable to create DFXML.")
+                manifest.complete("dfxml")
+
+            logging.info("Parsing DFXML to database")
+            try:
+                parse_dfxml_to_db(
+                    session, br_session_id, dfxml_path, args.batch_size, rundb
+                )
+            except Exception as e:
+                logging.error("Error parsing DFXML file %s: %s", dfxml_path, e)
+                print_to_stderr_and_exit("Error parsing DFXML file.")
+            manifest.complete("files")
+
+        # Fall back to pure Python byte run index without NumPy
+        if rundb is None:
+            try:
+                rundb = byterundb2()
+                rundb.read_xmlfile(dfxml_path)
+            except Exception as e:
+                logging.error("Error parsing DFXML file %s: %s", dfxml_path, e)
+                print_to_stderr_and_exit("Error parsing DFXML file.")
 
         # Write error message and quit if no files found
         num_files = session.query(func.count(File.id)).scalar()
@@ -1061,57 +3423,169 @@ def main():
                 "No files found. File system may be unsupported by fiwalk."
             )
 
+        # Cache file table and byte run index for later sessions on image
+        if dfxml_cache is not None:
+            try:
+                if dfxml_cache.store(session, br_session_id, rundb, dfxml_path):
+                    logging.info("Cached file table %s", dfxml_cache.entry_path)
+                else:
+                    logging.info(
+                        "Not caching file table: already cached, DFXML not kept "
+                        "or not on the same filesystem as %s",
+                        dfxml_cache.cache_dir,
+                    )
+            except OSError as e:
+                logging.warning("Unable to cache file table: %s", e)
+
     # Directory - Write file info to db
-    else:
+    elif not manifest.is_complete("files"):
         logging.info("Writing source file metadata to database")
-        write_filesystem_metadata_to_db(session, br_session_id, src)
-
-    # Run bulk_extractor if reports aren't already provided
-    if not args.be_reports:
+        write_filesystem_metadata_to_db(
+            session, br_session_id, src, args.batch_size, args.rescan_hashes
+        )
+        manifest.complete("files")
+
+    # Read feature files while bulk_extractor is still running if
+    # requested. Annotated feature files are only written afterwards.
+    tail_proc = None
+    if args.tail_features and bulk_extractor_proc is not None:
+        if args.diskimage and args.annotated_reports:
+            logging.warning(
+                "Not reading feature files during scan with --annotated_reports"
+            )
+        else:
+            tail_proc = bulk_extractor_proc
+
+    # Run bulk_extractor, or wait for it to finish if already started,
+    # if reports aren't already provided
+    if tail_proc is not None:
+        logging.info("Reading feature files to database during bulk_extractor scan")
+    elif bulk_extractor_proc is not None:
+        logging.info("Waiting for bulk_extractor to finish")
+        bulk_extractor_success = wait_for_bulk_extractor(bulk_extractor_proc)
+        if bulk_extractor_success is False:
+            print_to_stderr_and_exit("Error running bulk_extractor.")
+        manifest.complete("bulk_extractor")
+    elif run_bulk_extractor_stage:
         logging.info("Running bulk_extractor")
-        stoplist_dir = ""
-        if args.stoplists:
-            stoplist_dir = os.path.abspath(args.stoplists)
         bulk_extractor_success = run_bulk_extractor(
-            src, bulk_extractor_path, stoplist_dir, ssn_mode, args
+            scan_src, bulk_extractor_path, stoplist_dir, ssn_mode, args
         )
         if bulk_extractor_success is False:
             print_to_stderr_and_exit("Error running bulk_extractor.")
+        manifest.complete("bulk_extractor")
 
-    if args.diskimage:
-        # Disk image source: Annotate feature files and read into database
-        logging.info("Annotating feature files")
-        annotate_feature_files(bulk_extractor_path, annotated_feature_path, dfxml_path)
+    # Skip feature ingest if completed by resumed run
+    if manifest.is_complete("features"):
+        logging.info("Skipping completed feature ingest")
+
+    elif args.diskimage:
+        # Disk image source: Associate features to files and write to database
         logging.info("Reading feature files to database")
-        read_features_to_db(annotated_feature_path, br_session_id, session, args)
+        if not args.annotated_reports:
+            annotated_feature_path = None
+        ingest_disk_image_features(
+            bulk_extractor_path,
+            rundb,
+            br_session_id,
+            session,
+            args,
+            annotated_feature_path,
+            tail_proc,
+            manifest,
+        )
 
     else:
         # Directory source: read feature files into database
         logging.info("Reading feature files to database")
-        read_features_to_db(bulk_extractor_path, br_session_id, session, args)
+        staged_src = None
+        if previous_session is not None:
+            staged_src = scan_src
+        read_features_to_db(
+            bulk_extractor_path,
+            br_session_id,
+            session,
+            args,
+            tail_proc,
+            manifest,
+            staged_src,
+        )
+
+        # Directory rescan - Carry over features of unchanged files
+        if previous_session is not None:
+            logging.info("Carrying over features of unchanged files")
+            carry_over_features(
+                session,
+                br_session_id,
+                previous_session,
+                unchanged_files,
+                args.batch_size,
+            )
+
+    # Check that bulk_extractor finished successfully if read during scan
+    if tail_proc is not None:
+        bulk_extractor_success = wait_for_bulk_extractor(tail_proc)
+        if bulk_extractor_success is False:
+            print_to_stderr_and_exit("Error running bulk_extractor.")
+        manifest.complete("bulk_extractor")
+    manifest.complete("features")
+
+    # Cache reports of completed scan for reuse by later runs
+    if report_cache is not None:
+        try:
+            if report_cache.store(bulk_extractor_path):
+                logging.info(
+                    "Cached bulk_extractor reports %s", report_cache.entry_path
+                )
+            else:
+                logging.info(
+                    "Not caching bulk_extractor reports: already cached or not "
+                    "on the same filesystem as %s",
+                    report_cache.cache_dir,
+                )
+        except OSError as e:
+            logging.warning("Unable to cache bulk_extractor reports: %s", e)
+
+    # Index tables for queries once ingest is complete
+    create_indexes(session)
 
     # TODO : Get named entities (directories only)
 
     # Create JSON output
-    json_path = os.path.join(dest, args.filename + ".json")
     try:
-        brv_to_json(db_path, json_path)
-        logging.info("Created JSON file %s", json_path)
+        if args.sharded:
+            brv_to_pages(db_path, session_dir, args.page_size)
+        else:
+            brv_to_json(db_path, json_path)
+        logging.info("Created JSON file %s", output_path)
         # print path to stdout as utf-8 (supports utf-8 chars/emojis)
-        sys.stdout.buffer.write(json_path.encode("utf-8"))
+        sys.stdout.buffer.write(output_path.encode("utf-8"))
     except Exception as e:
-        logging.error("Error creating JSON file %s: %s", json_path, e)
+        logging.error("Error creating JSON file %s: %s", output_path, e)
         print_to_stderr_and_exit("Error creating JSON file.")
-
-    # Delete temp_dir with .brv file
-    try:
-        shutil.rmtree(temp_dir)
-        logging.info("Deleted tempdir")
-    except Exception:
-        logging.warning("Unable to delete tempdir %s", temp_dir)
+    manifest.complete("json")
+
+    # Delete .brv file unless kept, and staged files
+    session.close()
+    engine.dispose()
+    if args.keep_db:
+        restore_database_settings(db_path)
+        # Session output is as new as database until changed in review
+        now = time.time()
+        os.utime(db_path, (now, now))
+        logging.info("Kept database %s", db_path)
+    else:
+        try:
+            remove_database(db_path)
+            logging.info("Deleted database")
+        except Exception:
+            logging.warning("Unable to delete database %s", db_path)
+    if os.path.exists(staging_dir):
+        shutil.rmtree(staging_dir, ignore_errors=True)
 
     logging.info("Complete")
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
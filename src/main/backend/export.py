@@ -11,16 +11,135 @@ Licensed under GNU General Public License 3
 https://www.gnu.org/licenses/gpl-3.0.en.html
 """
 
+import bisect
+import collections
+import csv
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import errno
+import hashlib
+import io
 import json
 import logging
 import os
 import shutil
+import sqlite3
+import stat
 import subprocess
 import sys
+import tarfile
+import tempfile
+import time
+from urllib.request import pathname2url
+import zipfile
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where reflinks aren't supported
+    fcntl = None
+
+import Objects
 from utils import print_to_stderr_and_exit, time_to_int
 
+# File to export: filepath relative to source, file info from session
+# and destination path
+ExportItem = collections.namedtuple("ExportItem", ["filepath", "file_info", "dest"])
+# Location of file data in disk image: file size, MD5 recorded in DFXML
+# and byte runs as (file_offset, img_offset, length, fill) tuples,
+# where fill is the byte repeated in runs without data, else None
+CarveInfo = collections.namedtuple("CarveInfo", ["filesize", "byte_runs", "md5"])
+# Digests of exported file and digests recorded for it during the scan
+# (MD5 from DFXML for disk images, SHA-256 for hashed directory scans)
+FixityRecord = collections.namedtuple(
+    "FixityRecord",
+    [
+        "filepath",
+        "export_path",
+        "size",
+        "md5",
+        "sha256",
+        "recorded_md5",
+        "recorded_sha256",
+    ],
+)
+
+# Default number of threads copying files from directories, and number
+# of copies queued per thread
+DEFAULT_COPY_THREADS = 4
+COPY_QUEUE_FACTOR = 4
+# Ways of exporting files from directories without copying their data:
+# hardlinks, which share data and metadata with the source file, and
+# copy-on-write reflinks, which share data until either file changes
+LINK_MODES = ("hardlink", "reflink")
+# ioctl cloning a whole file on Linux filesystems with reflinks
+# (Btrfs, XFS, OCFS2 and others)
+FICLONE = 0x40049409
+# Bytes read from disk image per positioned read when carving
+CARVE_CHUNK_SIZE = 1024 * 1024
+# Data runs of carved files at most COALESCE_GAP bytes apart in the
+# image are read together, in spans of up to COALESCE_MAX_SPAN bytes
+COALESCE_GAP = 64 * 1024
+COALESCE_MAX_SPAN = 8 * 1024 * 1024
+# Signatures at start of disk image container formats that can't be
+# read directly, such as EWF (E01), AFF and VMDK. Files are carved
+# from images in these formats with icat.
+IMAGE_CONTAINER_SIGNATURES = (
+    b"EVF\x09\x0d\x0a\xff\x00",
+    b"LVF\x09\x0d\x0a\xff\x00",
+    b"EVF2\x0d\x0a\x81\x00",
+    b"AFF10\x0d\x0a",
+    b"PK\x03\x04",
+    b"KDMV",
+    b"QFI\xfb",
+    b"conectix",
+    b"vhdxfile",
+)
+# Archive formats by extension of archive path: tarfile stream mode,
+# or "zip" for zip archives
+ARCHIVE_FORMATS = (
+    (".tar.gz", "w|gz"),
+    (".tgz", "w|gz"),
+    (".tar.bz2", "w|bz2"),
+    (".tar.xz", "w|xz"),
+    (".tar", "w|"),
+    (".zip", "zip"),
+)
+# Bytes buffered at a time when streaming files into archives
+ARCHIVE_BUFFER_SIZE = 1024 * 1024
+README_FILENAME = "_BulkReviewer_README.txt"
+# Earliest time representable in zip archives (1980-01-01)
+ZIP_MIN_TIME = 315532800
+# Manifests of exported files in md5sum/sha256sum format, as in BagIt
+# bags, and report comparing digests to those recorded during the scan
+MANIFEST_FILENAMES = (
+    ("md5", "manifest-md5.txt"),
+    ("sha256", "manifest-sha256.txt"),
+)
+FIXITY_REPORT_FILENAME = "_BulkReviewer_fixity.csv"
+FIXITY_REPORT_COLUMNS = (
+    "filepath",
+    "export_path",
+    "size",
+    "md5",
+    "sha256",
+    "recorded_md5",
+    "recorded_sha256",
+    "status",
+)
+# Bytes read at a time when copying files through userspace to hash them
+HASH_CHUNK_SIZE = 1024 * 1024
+# Header of SQLite database files, such as .brv session databases
+SQLITE_HEADER = b"SQLite format 3\x00"
+# Filepaths of files with undismissed features, in order of their
+# first undismissed feature
+PII_FILEPATHS_QUERY = """\
+    SELECT fl.filepath FROM file fl
+    JOIN (SELECT file, MIN(id) AS first_id FROM feature \
+        WHERE dismissed = 0 GROUP BY file) f ON f.file = fl.id
+    GROUP BY fl.filepath ORDER BY MIN(f.first_id);
+    """
+
 
 class FileExport:
     """Class representing Bulk Reviewer export.
@@ -36,10 +155,16 @@ class FileExport:
         restore_dates=False,
         export_unallocated=False,
         tar_list=False,
+        threads=DEFAULT_COPY_THREADS,
+        dfxml_path=None,
+        archive=False,
+        manifest=False,
+        link_mode=None,
         session_dict=dict(),
         files_with_pii=list(),
         files_without_pii=list(),
         files_not_copied=list(),
+        files_by_path=dict(),
     ):
         self.json_path = json_path
         self.destination = destination
@@ -49,26 +174,27 @@ class FileExport:
         self.restore_dates = restore_dates
         self.export_unallocated = export_unallocated
         self.tar_list = tar_list
+        self.threads = max(1, threads)
+        self.dfxml_path = dfxml_path
+        self.archive = archive
+        self.manifest = manifest
+        self.link_mode = link_mode
         self.session_dict = session_dict
         self.files_with_pii = files_with_pii
         self.files_without_pii = files_without_pii
         self.files_not_copied = files_not_copied
+        self.files_by_path = files_by_path
+        self.dirs_created = set()
+        self.fixity = []
 
     def export_files(self):
         """Handle file export.
         """
-        self._load_from_json()
-
-        features = self.session_dict["features"]
-        for f in features:
-            if f["dismissed"] is False:
-                if f["filepath"] not in self.files_with_pii:
-                    self.files_with_pii.append(f["filepath"])
-
-        files = self.session_dict["files"]
-        for f in files:
-            if f["filepath"] not in self.files_with_pii:
-                self.files_without_pii.append(f["filepath"])
+        if is_database(self.json_path):
+            self._load_from_database()
+        else:
+            self._load_from_json()
+            self._sort_files(self._pii_filepaths_from_features())
 
         # If tar option selected, create tar exclude file and exit
         if self.tar_list:
@@ -77,6 +203,12 @@ class FileExport:
                 self._create_tar_exclude_file()
             return
 
+        # If archive option selected, write files to archive at destination
+        if self.archive:
+            self._export_archive()
+            self._report_status()
+            return
+
         if self.disk_image:
             if self.private:
                 self._export_files_private_diskimage()
@@ -88,6 +220,8 @@ class FileExport:
             else:
                 self._export_files_cleared_directory()
 
+        if self.manifest:
+            self._write_manifests()
         self._write_readme()
         self._report_status()
 
@@ -98,6 +232,67 @@ class FileExport:
         with open(self.json_path, "r", encoding="utf-8", errors="ignore") as f:
             self.session_dict = json.load(f)
 
+    def _load_from_database(self):
+        """Save session info and files from Bulk Reviewer .brv database
+        to session_dict and sort files into files_with_pii and
+        files_without_pii.
+
+        Filepaths with undismissed features are read with a single
+        query, so features' text is never read. The database is opened
+        read-only.
+
+        Exits if session output next to the database was saved after
+        it, as the reviewer's dismissals and notes in the session
+        output are then missing from the database.
+        """
+        self._clear_data()
+        conn = sqlite3.connect(
+            "file:{}?mode=ro".format(pathname2url(os.path.abspath(self.json_path))),
+            uri=True,
+        )
+        conn.row_factory = sqlite3.Row
+        try:
+            self.session_dict = dict(conn.execute("SELECT * from session;").fetchone())
+            self.session_dict["disk_image"] = self.session_dict["disk_image"] == 1
+            self._check_database_current()
+            pii_filepaths = [row[0] for row in conn.execute(PII_FILEPATHS_QUERY)]
+            files = []
+            for row in conn.execute("SELECT * from file ORDER BY id;"):
+                file_info = dict(row)
+                file_info["allocated"] = file_info["allocated"] == 1
+                file_info["verified"] = file_info["verified"] == 1
+                files.append(file_info)
+        finally:
+            conn.close()
+        self.session_dict["files"] = files
+        self._sort_files(pii_filepaths)
+
+    def _check_database_current(self):
+        """Exit if session output written next to .brv database, by
+        --keep_db or server mode, is newer than the database.
+        """
+        db_dir = os.path.dirname(os.path.abspath(self.json_path))
+        name = self.session_dict.get("name", "")
+        candidates = []
+        for session_dir in (db_dir, os.path.dirname(db_dir)):
+            candidates.append(os.path.join(session_dir, "{}.json".format(name)))
+            candidates.append(
+                os.path.join(session_dir, "{}_session".format(name), "session.json")
+            )
+        db_mtime = os.path.getmtime(self.json_path)
+        for path in candidates:
+            if os.path.isfile(path) and os.path.getmtime(path) > db_mtime:
+                logging.error(
+                    "Session output %s was saved after database %s. Changes made "
+                    "in review are not in the database.",
+                    path,
+                    self.json_path,
+                )
+                print_to_stderr_and_exit(
+                    "Database is older than session file {}. "
+                    "Export from the session file instead.".format(path)
+                )
+
     def _clear_data(self):
         """Flush existing data.
         """
@@ -105,6 +300,61 @@ class FileExport:
         self.files_with_pii = list()
         self.files_without_pii = list()
         self.files_not_copied = list()
+        self.files_by_path = dict()
+        self.dirs_created = set()
+        self.fixity = []
+
+    def _pii_filepaths_from_features(self):
+        """Return filepaths with undismissed features in session_dict,
+        in order of their first undismissed feature.
+        """
+        pii_filepaths = dict()
+        for f in self.session_dict["features"]:
+            if f["dismissed"] is False:
+                pii_filepaths.setdefault(f["filepath"], None)
+        return list(pii_filepaths)
+
+    def _sort_files(self, pii_filepaths):
+        """Sort filepaths into files_with_pii and files_without_pii.
+
+        Files are indexed by filepath and checked against a set of
+        pii_filepaths in one pass, so sorting is linear in the number
+        of files.
+        """
+        self.files_with_pii = list(pii_filepaths)
+        pii_filepaths = set(pii_filepaths)
+        for f in self.session_dict["files"]:
+            self.files_by_path.setdefault(f["filepath"], f)
+            if f["filepath"] not in pii_filepaths:
+                self.files_without_pii.append(f["filepath"])
+
+    def _export_plan(self, filepaths):
+        """Return list of ExportItems for filepaths, in order.
+
+        Unallocated files from disk images are left out unless
+        export_unallocated is True. Private files exported flat get
+        their ID prepended to their filename.
+        """
+        plan = []
+        for f in filepaths:
+            file_info = self.files_by_path.get(f)
+            if file_info is None:
+                logging.error("File information not found for file %s", f)
+                self.files_not_copied.append(f)
+                continue
+            # Skip unallocated files unless args.unallocated is True
+            if self.disk_image and self.export_unallocated is not True:
+                if file_info["allocated"] is False:
+                    continue
+            # Build path for destination file
+            if self.private and self.flat:
+                # Append ID to filename to prevent filepath collisions
+                file_basename = str(file_info["id"]) + "_" + os.path.basename(f)
+                file_dest = os.path.join(self.destination, file_basename)
+            else:
+                file_dest = os.path.join(self.destination, f)
+            plan.append(ExportItem(f, file_info, file_dest))
+        return plan
 
     def _create_tar_exclude_file(self):
         """Create TAR exclude file and exit with code 0.
@@ -133,121 +383,429 @@ class FileExport:
     def _export_files_private_diskimage(self):
         """Export private files from disk image.
         """
-        files = self.session_dict["files"]
-        for f in self.files_with_pii:
-            # Get file information
-            filtered_files = [x for x in files if x["filepath"] == f]
-            file_info = filtered_files[0]
-            # Build path for destination file
-            if self.flat:
-                # Append ID to filename to prevent filepath collisions
-                file_basename = str(file_info["id"]) + "_" + os.path.basename(f)
-                file_dest = os.path.join(self.destination, file_basename)
-            else:
-                file_dest = os.path.join(self.destination, f)
-            # Skip unallocated files unless args.unallocated is True
-            if self.export_unallocated is not True:
-                if file_info["allocated"] is False:
-                    continue
-            # Create intermediate dirs if necessary
-            os.makedirs(os.path.dirname(file_dest), exist_ok=True)
-            # Carve file from disk image
-            carve_success = self._carve_file(
-                f,
-                int(file_info["fs_offset"]),
-                self.session_dict["source_path"],
-                int(file_info["inode"]),
-                file_dest,
-            )
-            if carve_success is False:
-                self.files_not_copied.append(file_dest)
-            # Set modified date to modified or created value from DFXML
-            if self.restore_dates:
-                self._restore_modified_date(
-                    file_dest, file_info["date_modified"], file_info["date_created"]
-                )
+        self._carve_files(self._export_plan(self.files_with_pii))
         logging.info("Files with PII copied to %s", self.destination)
 
     def _export_files_cleared_diskimage(self):
         """Export cleared files from disk image.
         """
-        files = self.session_dict["files"]
-        for f in self.files_without_pii:
-            # Build path for destination file
-            file_dest = os.path.join(self.destination, f)
-            # Get file information
-            filtered_files = [x for x in files if x["filepath"] == f]
-            file_info = filtered_files[0]
-            # Skip unallocated files unless args.unallocated is True
-            if self.export_unallocated is not True:
-                if file_info["allocated"] is False:
-                    continue
-            # Create intermediate dirs if necessary
-            os.makedirs(os.path.dirname(file_dest), exist_ok=True)
-            # Carve file from disk image
+        self._carve_files(self._export_plan(self.files_without_pii))
+        logging.info("Files without PII copied to %s", self.destination)
+
+    def _export_archive(self):
+        """Export cleared or private files into tar or zip archive at
+        destination.
+
+        Files are copied or carved straight into the archive, in the
+        same order as exports to directories, in chunks of
+        ARCHIVE_BUFFER_SIZE bytes. The README is added to the archive.
+
+        Files that can't be opened are skipped. If reading a file fails
+        once its header is written, the archive is deleted and the
+        export exits, as the archive would be corrupt.
+        """
+        if self.private:
+            plan = self._export_plan(self.files_with_pii)
+        else:
+            plan = self._export_plan(self.files_without_pii)
+        carver = None
+        failed = []
+        try:
+            archive = ArchiveWriter(self.destination)
+        except (OSError, ValueError) as e:
+            logging.error("Unable to create archive %s: %s", self.destination, e)
+            print_to_stderr_and_exit(f"Unable to create archive {self.destination}")
+        try:
+            if self.disk_image:
+                carver = self._open_carver(plan)
+                for (index, item) in order_carve_jobs(plan, carver):
+                    if not self._carve_item_to_archive(carver, archive, item):
+                        failed.append((index, item.dest))
+            else:
+                jobs = order_copy_jobs(plan, self.session_dict["source_path"])
+                for (index, item, file_src) in jobs:
+                    digests = FileDigests() if self.manifest else None
+                    try:
+                        archive.add_file(file_src, self._arcname(item), digests)
+                    except OSError as e:
+                        logging.error("Error copying file %s: %s", file_src, e)
+                        failed.append((index, file_src))
+                        continue
+                    self._record_fixity(item, digests)
+            if self.manifest:
+                for (filename, text) in self._manifest_texts():
+                    archive.add_bytes(filename, text.encode("utf-8"))
+            archive.add_bytes(README_FILENAME, self._readme_text().encode("utf-8"))
+            archive.close()
+        except (
+            ArchiveError,
+            OSError,
+            ValueError,
+            tarfile.TarError,
+            zipfile.BadZipFile,
+        ) as e:
+            logging.error("Error writing archive %s: %s", self.destination, e)
+            archive.abort()
+            print_to_stderr_and_exit(f"Error writing archive {self.destination}")
+        finally:
+            if carver is not None:
+                carver.close()
+        self.files_not_copied.extend(path for (index, path) in sorted(failed))
+        logging.info("Files written to archive %s", self.destination)
+
+    def _carve_item_to_archive(self, carver, archive, item):
+        """Carve file from disk image into archive, from byte runs if
+        possible and otherwise with icat.
+
+        Return True is successful, False if not.
+        """
+        (f, file_info, file_dest) = item
+        digests = FileDigests() if self.manifest else None
+        carve_info = self._dfxml_carve_info(carver, file_info)
+        mtime = time.time()
+        if self.restore_dates:
+            mtime = self._date_to_int(
+                file_info["date_modified"], file_info["date_created"]
+            ) or mtime
+        if carve_info is not None and carver.can_carve(carve_info):
+            chunks = carver.iter_chunks(carve_info)
+            if digests is not None:
+                chunks = digests.hashed(chunks)
+            archive.add_chunks(self._arcname(item), chunks, carve_info.filesize, mtime)
+            logging.debug("File %s carved from disk image", f)
+            self._record_fixity(item, digests, carve_info)
+            return True
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tmp_path = os.path.join(tmpdir, "carved")
             carve_success = self._carve_file(
                 f,
                 int(file_info["fs_offset"]),
                 self.session_dict["source_path"],
                 int(file_info["inode"]),
-                file_dest,
+                tmp_path,
+                digests,
             )
-            if carve_success is False:
-                self.files_not_copied.append(file_dest)
-            # Set modified date to modified or created value from DFXML
-            if self.restore_dates:
-                self._restore_modified_date(
-                    file_dest, file_info["date_modified"], file_info["date_created"]
+            if carve_success is False or not os.path.exists(tmp_path):
+                return False
+            with open(tmp_path, "rb") as carved:
+                archive.add_chunks(
+                    self._arcname(item),
+                    iter(lambda: carved.read(ARCHIVE_BUFFER_SIZE), b""),
+                    os.fstat(carved.fileno()).st_size,
+                    mtime,
                 )
-        logging.info("Files without PII copied to %s", self.destination)
+        self._record_fixity(item, digests, carve_info)
+        return True
+
+    def _arcname(self, item):
+        """Return path of exported file within archive."""
+        return os.path.relpath(item.dest, self.destination)
+
+    def _carve_files(self, plan):
+        """Carve files in plan from disk image.
+
+        Files are carved in-process from their byte runs in the DFXML
+        with one open image handle. Files that can't be carved this
+        way (compressed or resident files, images in container
+        formats, or no DFXML available) are carved with icat.
+
+        Files are carved in the order given by order_carve_jobs, so
+        the image is read front to back. Failed files are reported in
+        plan order.
+        """
+        carver = self._open_carver(plan)
+        failed = []
+        try:
+            for (index, item) in order_carve_jobs(plan, carver):
+                (f, file_info, file_dest) = item
+                # Create intermediate dirs if necessary
+                self._make_parent_dir(file_dest)
+                # Carve file from disk image
+                digests = FileDigests() if self.manifest else None
+                carve_success = self._carve_item(
+                    carver, f, file_info, file_dest, digests
+                )
+                if carve_success is False:
+                    failed.append((index, file_dest))
+                else:
+                    self._record_fixity(
+                        item, digests, self._dfxml_carve_info(carver, file_info)
+                    )
+                # Set modified date to modified or created value from DFXML
+                if self.restore_dates:
+                    self._restore_modified_date(
+                        file_dest, file_info["date_modified"], file_info["date_created"]
+                    )
+        finally:
+            if carver is not None:
+                logging.info(
+                    "Carved %d files with %d reads of disk image",
+                    carver.files_carved,
+                    carver.reads,
+                )
+                carver.close()
+        self.files_not_copied.extend(file_dest for (index, file_dest) in sorted(failed))
+
+    def _open_carver(self, plan):
+        """Return DiskImageCarver for files in plan, or None if files
+        must be carved with icat.
+        """
+        disk_image = self.session_dict["source_path"]
+        dfxml_path = self.dfxml_path or self._default_dfxml_path()
+        if not plan:
+            return None
+        if not os.path.isfile(dfxml_path):
+            logging.info("DFXML not found at %s, carving files with icat", dfxml_path)
+            return None
+        try:
+            if not image_is_raw(disk_image):
+                logging.info("Disk image %s is not raw, carving with icat", disk_image)
+                return None
+            start_time = time.time()
+            carve_index = read_carve_index(
+                dfxml_path, set(carve_key(item.file_info) for item in plan)
+            )
+            logging.info(
+                "Read byte runs of %d files from %s in %.2f seconds",
+                len(carve_index),
+                dfxml_path,
+                time.time() - start_time,
+            )
+            return DiskImageCarver(disk_image, carve_index)
+        except Exception as e:
+            logging.warning(
+                "Unable to carve from byte runs, carving files with icat: %s", e
+            )
+            return None
+
+    def _default_dfxml_path(self):
+        """Return path to DFXML in reports directory written next to
+        JSON, or next to .brv database kept in reports directory.
+        """
+        session_dir = os.path.dirname(os.path.abspath(self.json_path))
+        reports_dfxml = os.path.join(
+            session_dir,
+            "{}_reports".format(self.session_dict.get("name", "")),
+            "dfxml.xml",
+        )
+        if not os.path.exists(reports_dfxml) and is_database(self.json_path):
+            return os.path.join(session_dir, "dfxml.xml")
+        return reports_dfxml
+
+    def _carve_item(self, carver, f, file_info, file_dest, digests=None):
+        """Carve file from disk image, from byte runs if possible and
+        otherwise with icat. If digests is provided, data is hashed as
+        it is written.
+
+        Return True is successful, False if not.
+        """
+        carve_info = self._dfxml_carve_info(carver, file_info)
+        if carve_info is not None:
+            try:
+                carver.carve(carve_info, file_dest, digests)
+                logging.debug("File %s carved from disk image", f)
+                return True
+            except (OSError, ValueError) as e:
+                logging.warning(
+                    "Error carving file %s from byte runs, using icat: %s", f, e
+                )
+                if digests is not None:
+                    digests.reset()
+        return self._carve_file(
+            f,
+            int(file_info["fs_offset"]),
+            self.session_dict["source_path"],
+            int(file_info["inode"]),
+            file_dest,
+            digests,
+        )
+
+    @staticmethod
+    def _dfxml_carve_info(carver, file_info):
+        """Return CarveInfo of file from DFXML, or None if not known."""
+        if carver is None:
+            return None
+        return carver.carve_index.get(carve_key(file_info))
 
     def _export_files_private_directory(self):
         """Export private files from directory.
         """
-        files = self.session_dict["files"]
-        for f in self.files_with_pii:
-            # Get file information
-            filtered_files = [x for x in files if x["filepath"] == f]
-            file_info = filtered_files[0]
-            # Build path for source file
-            file_src = os.path.join(self.session_dict["source_path"], f)
-            # Build path for destination file
-            if self.flat:
-                # Append ID to filename to prevent filepath collisions
-                file_basename = str(file_info["id"]) + "_" + os.path.basename(f)
-                file_dest = os.path.join(self.destination, file_basename)
-            else:
-                file_dest = os.path.join(self.destination, f)
-            os.makedirs(os.path.dirname(file_dest), exist_ok=True)
-            # Copy file
-            try:
-                shutil.copy2(file_src, file_dest)
-            except OSError as e:
-                logging.error("Error copying file %s: %s", file_src, e)
-                self.files_not_copied.append(file_src)
+        self._copy_files(self._export_plan(self.files_with_pii))
         logging.info("Files with PII copied to %s", self.destination)
 
     def _export_files_cleared_directory(self):
         """Export cleared files from directory.
         """
-        for f in self.files_without_pii:
-            # Build paths for source and dest file
-            file_src = os.path.join(self.session_dict["source_path"], f)
-            file_dest = os.path.join(self.destination, f)
-            # Copy file, creating dirs if necessary
-            os.makedirs(os.path.dirname(file_dest), exist_ok=True)
+        self._copy_files(self._export_plan(self.files_without_pii))
+        logging.info("Cleared files copied to %s", self.destination)
+
+    def _copy_files(self, plan):
+        """Copy files in plan from source directory using a pool of
+        threads.
+
+        Files are copied in the order given by order_copy_jobs. At
+        most threads * COPY_QUEUE_FACTOR copies are queued at once.
+        files_not_copied lists failed files in plan order, the same
+        order as copying one at a time.
+        """
+        pending = collections.deque()
+        failed = []
+        linked = []
+        jobs = order_copy_jobs(plan, self.session_dict["source_path"])
+        link_mode = self._usable_link_mode()
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for (index, item, file_src) in jobs:
+                # Create intermediate dirs if necessary
+                self._make_parent_dir(item.dest)
+                digests = FileDigests() if self.manifest else None
+                if link_mode is not None:
+                    future = executor.submit(
+                        link_file, file_src, item.dest, link_mode, digests
+                    )
+                else:
+                    future = executor.submit(copy_file, file_src, item.dest, digests)
+                pending.append((index, item, file_src, digests, future))
+                if len(pending) >= self.threads * COPY_QUEUE_FACTOR:
+                    self._check_copy(failed, linked, *pending.popleft())
+            while pending:
+                self._check_copy(failed, linked, *pending.popleft())
+        self.files_not_copied.extend(file_src for (index, file_src) in sorted(failed))
+        if link_mode is not None:
+            logging.info(
+                "Exported %d of %d files as %ss", len(linked), len(plan), link_mode
+            )
+
+    def _check_copy(self, failed, linked, index, item, file_src, digests, future):
+        try:
+            if future.result() is True:
+                linked.append(index)
+        except OSError as e:
+            logging.error("Error copying file %s: %s", file_src, e)
+            failed.append((index, file_src))
+            return
+        self._record_fixity(item, digests)
+
+    def _usable_link_mode(self):
+        """Return link_mode if source directory and destination are on
+        the same device, otherwise None.
+        """
+        if self.link_mode is None:
+            return None
+        os.makedirs(self.destination, exist_ok=True)
+        source_dev = os.stat(self.session_dict["source_path"]).st_dev
+        if source_dev != os.stat(self.destination).st_dev:
+            logging.info(
+                "Destination %s is not on the same filesystem as source, "
+                "copying files instead of using %ss",
+                self.destination,
+                self.link_mode,
+            )
+            return None
+        return self.link_mode
+
+    def _record_fixity(self, item, digests, carve_info=None):
+        """Record digests of exported file with those recorded for it
+        during the scan, if digests were computed.
+        """
+        if digests is None:
+            return
+        recorded_md5 = None
+        if carve_info is not None and carve_info.md5:
+            recorded_md5 = carve_info.md5.lower()
+        recorded_sha256 = item.file_info.get("sha256") or None
+        record = FixityRecord(
+            item.filepath,
+            os.path.relpath(item.dest, self.destination),
+            digests.size,
+            digests.md5.hexdigest(),
+            digests.sha256.hexdigest(),
+            recorded_md5,
+            recorded_sha256.lower() if recorded_sha256 else None,
+        )
+        if fixity_status(record) == "mismatch":
+            logging.warning(
+                "Digest of exported file %s does not match digest recorded "
+                "during scan",
+                item.filepath,
+            )
+        self.fixity.append(record)
+
+    def _write_manifests(self):
+        """Write manifests and fixity report in output directory."""
+        for (filename, text) in self._manifest_texts():
+            out_file = os.path.join(self.destination, filename)
             try:
-                shutil.copy2(file_src, file_dest)
+                with open(out_file, "w", newline="") as f:
+                    f.write(text)
+                logging.info("Created manifest file %s", out_file)
             except OSError as e:
-                logging.error("Error copying file %s: %s", file_src, e)
-                self.files_not_copied.append(file_src)
-        logging.info("Cleared files copied to %s", self.destination)
+                logging.warning(
+                    "Unable to create manifest file %s. Details: %s", out_file, e
+                )
+
+    def _manifest_texts(self):
+        """Return list of (filename, text) of manifests and fixity
+        report for exported files.
+
+        Manifests list files in the format of md5sum and sha256sum, so
+        they can be checked from the export directory with their -c
+        options. As in BagIt manifests, CR, LF and % characters in
+        paths are percent-encoded.
+        """
+        records = sorted(self.fixity, key=lambda record: record.export_path)
+        texts = []
+        for (algorithm, filename) in MANIFEST_FILENAMES:
+            lines = [
+                "{}  {}\n".format(
+                    getattr(record, algorithm), manifest_path(record.export_path)
+                )
+                for record in records
+            ]
+            texts.append((filename, "".join(lines)))
+        report = io.StringIO()
+        writer = csv.writer(report)
+        writer.writerow(FIXITY_REPORT_COLUMNS)
+        for record in records:
+            writer.writerow(
+                [
+                    record.filepath,
+                    record.export_path,
+                    record.size,
+                    record.md5,
+                    record.sha256,
+                    record.recorded_md5 or "",
+                    record.recorded_sha256 or "",
+                    fixity_status(record),
+                ]
+            )
+        texts.append((FIXITY_REPORT_FILENAME, report.getvalue()))
+        return texts
+
+    def _make_parent_dir(self, path):
+        """Create parent directory of path if not already created."""
+        parent = os.path.dirname(path)
+        if parent not in self.dirs_created:
+            os.makedirs(parent, exist_ok=True)
+            self.dirs_created.add(parent)
 
     def _write_readme(self):
         """Write README file in output directory for file export.
+        """
+        out_file = os.path.join(self.destination, README_FILENAME)
+        try:
+            with open(out_file, "w") as f:
+                f.write(self._readme_text())
+            logging.info("Created export README file %s", out_file)
+
+        except Exception as e:
+            logging.warning(
+                "Unable to create export README file %s. Details: %s", out_file, e
+            )
+
+    def _readme_text(self):
+        """Return text of README file for file export.
         Include metadata about the session and export.
         """
-        out_file = os.path.join(self.destination, "_BulkReviewer_README.txt")
         time_of_export = str(datetime.now())[:19]
         source_type = "Directory"
         if self.session_dict["disk_image"] is True:
@@ -263,38 +821,43 @@ the beginning of the filename on export. These IDs can be matched to original \
 filepaths and corresponding features using the Bulk Reviewer CSV export.
         """
 
-        try:
-            with open(out_file, "w") as f:
-                # Write metadata
-                f.write("Files exported from Bulk Reviewer")
-                f.write("\n================================")
-                f.write("\nType: {}".format(export_type))
-                f.write("\nDate: {}".format(time_of_export))
-                f.write("\nSource: {}".format(self.session_dict["source_path"]))
-                f.write("\nSource type: {}".format(source_type))
-                # Include disk image file export options
-                if source_type == "Disk image":
-                    dates = str(self.restore_dates)
-                    unalloc = str(self.export_unallocated)
-                    f.write("\nModified dates restored: {}".format(dates))
-                    f.write("\nUnallocated files included: {}".format(unalloc))
-
-                # For cleared export, write list of excluded files
-                if not self.private:
-                    f.write("\n\nFiles excluded from export for containing PII:")
-                    for pii_file in self.files_with_pii:
-                        f.write("\n{}".format(pii_file))
-
-                # Add section explaining flat outputs
-                if self.flat:
-                    f.write(flat_faq)
+        # Write metadata
+        text = ["Files exported from Bulk Reviewer"]
+        text.append("\n================================")
+        text.append("\nType: {}".format(export_type))
+        text.append("\nDate: {}".format(time_of_export))
+        text.append("\nSource: {}".format(self.session_dict["source_path"]))
+        text.append("\nSource type: {}".format(source_type))
+        # Include disk image file export options
+        if source_type == "Disk image":
+            dates = str(self.restore_dates)
+            unalloc = str(self.export_unallocated)
+            text.append("\nModified dates restored: {}".format(dates))
+            text.append("\nUnallocated files included: {}".format(unalloc))
 
-            logging.info("Created export README file %s", out_file)
+        # For cleared export, write list of excluded files
+        if not self.private:
+            text.append("\n\nFiles excluded from export for containing PII:")
+            for pii_file in self.files_with_pii:
+                text.append("\n{}".format(pii_file))
 
-        except Exception as e:
-            logging.warning(
-                "Unable to create export README file %s. Details: %s", out_file, e
+        # Summarize fixity of exported files
+        if self.manifest:
+            statuses = collections.Counter(
+                fixity_status(record) for record in self.fixity
             )
+            manifests = [filename for (algorithm, filename) in MANIFEST_FILENAMES]
+            text.append("\n\nFixity:")
+            text.append("\nFiles hashed: {}".format(len(self.fixity)))
+            text.append("\nDigests matching scan: {}".format(statuses["verified"]))
+            text.append("\nDigests not matching scan: {}".format(statuses["mismatch"]))
+            text.append("\nManifests: {}".format(", ".join(manifests)))
+            text.append("\nFixity report: {}".format(FIXITY_REPORT_FILENAME))
+
+        # Add section explaining flat outputs
+        if self.flat:
+            text.append(flat_faq)
+        return "".join(text)
 
     def _report_status(self):
         """Report status of export back to user by printing to stdout.
@@ -304,14 +867,15 @@ filepaths and corresponding features using the Bulk Reviewer CSV export.
         """
         #
         logging.info("Export complete")
+        target = "archive" if self.archive else "directory"
         if not self.files_not_copied:
             if self.private:
                 print(
-                    "Private files successfully exported to directory", self.destination
+                    "Private files successfully exported to", target, self.destination
                 )
             else:
                 print(
-                    "Cleared files successfully exported to directory", self.destination
+                    "Cleared files successfully exported to", target, self.destination
                 )
             return
 
@@ -319,30 +883,37 @@ filepaths and corresponding features using the Bulk Reviewer CSV export.
         if self.private:
             print(
                 """
-                Private files exported to directory {}.
+                Private files exported to {} {}.
                 The following files encountered errors: {}.
                 See Bulk Reviewer log for details.
                 """.format(
-                    self.destination, ", ".join([x for x in self.files_not_copied])
+                    target,
+                    self.destination,
+                    ", ".join([x for x in self.files_not_copied]),
                 )
             )
         else:
             print(
                 """
-                Cleared files exported to directory %s.
-                The following files encountered errors: %s.
+                Cleared files exported to {} {}.
+                The following files encountered errors: {}.
                 See Bulk Reviewer log for details.
                 """.format(
-                    self.destination, ", ".join(self.files_not_copied)
+                    target, self.destination, ", ".join(self.files_not_copied)
                 )
             )
 
     @staticmethod
-    def _carve_file(filepath, fs_offset, disk_image, inode, file_dest):
-        """Carve file from disk image using icat.
+    def _carve_file(filepath, fs_offset, disk_image, inode, file_dest, digests=None):
+        """Carve file from disk image using icat. If digests is
+        provided, icat output is hashed as it is written.
 
         Return True is successful, False if not.
         """
+        if digests is not None:
+            return FileExport._carve_file_hashed(
+                filepath, fs_offset, disk_image, inode, file_dest, digests
+            )
         icat_cmd = 'icat -o {0} "{1}" {2} > "{3}"'.format(
             fs_offset, disk_image, inode, file_dest
         )
@@ -354,17 +925,52 @@ filepaths and corresponding features using the Bulk Reviewer CSV export.
             logging.error("Error exporting file %s: %s", filepath, e)
             return False
 
+    @staticmethod
+    def _carve_file_hashed(filepath, fs_offset, disk_image, inode, file_dest, digests):
+        """Carve file from disk image using icat, hashing its output.
+
+        Return True is successful, False if not.
+        """
+        icat_cmd = ["icat", "-o", str(fs_offset), disk_image, str(inode)]
+        try:
+            with open(file_dest, "wb") as out:
+                with subprocess.Popen(icat_cmd, stdout=subprocess.PIPE) as icat:
+                    for chunk in iter(lambda: icat.stdout.read(HASH_CHUNK_SIZE), b""):
+                        digests.update(chunk)
+                        out.write(chunk)
+            if icat.returncode != 0:
+                logging.error(
+                    "Error exporting file %s: icat exited with status %d",
+                    filepath,
+                    icat.returncode,
+                )
+                os.remove(file_dest)
+                return False
+            logging.debug("File %s exported from disk image", filepath)
+            return True
+        except OSError as e:
+            logging.error("Error exporting file %s: %s", filepath, e)
+            return False
+
+    @staticmethod
+    def _date_to_int(date_modified, date_created):
+        """Return date modified if exists, otherwise date created, as
+        integer Unix time, or None if neither is recorded.
+        """
+        if len(date_modified) > 0:
+            return time_to_int(date_modified[:19])
+        elif len(date_created) > 0:
+            return time_to_int(date_created[:19])
+        return None
+
     @staticmethod
     def _restore_modified_date(file_dest, date_modified, date_created):
         """Rewrite last modified date of file.
 
         Use date modified if exists, otherwise use date created.
         """
-        if len(date_modified) > 0:
-            int_time = time_to_int(date_modified[:19])
-        elif len(date_created) > 0:
-            int_time = time_to_int(date_created[:19])
-        else:
+        int_time = FileExport._date_to_int(date_modified, date_created)
+        if int_time is None:
             logging.warning("No date to restore from recorded for file %s", file_dest)
             return
 
@@ -374,3 +980,534 @@ filepaths and corresponding features using the Bulk Reviewer CSV export.
             logging.warning(
                 "Error modifying modified date for %s. Error: %s", file_dest, e
             )
+
+
+def copy_file(src, dst, digests=None):
+    """Copy file src to dst with its metadata, as shutil.copy2 does.
+
+    Without digests, shutil.copy2 copies data in the kernel on
+    platforms where that is safe. If digests is provided, data is
+    copied through userspace and hashed on the way.
+    """
+    if digests is None:
+        return shutil.copy2(src, dst)
+    with open(src, "rb") as fsrc:
+        with open(dst, "wb") as fdst:
+            chunks = iter(lambda: fsrc.read(HASH_CHUNK_SIZE), b"")
+            for chunk in digests.hashed(chunks):
+                fdst.write(chunk)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def link_file(src, dst, link_mode, digests=None):
+    """Export file src to dst as a hardlink or reflink, as given by
+    link_mode, falling back to copy_file if src can't be linked.
+
+    Reflinks get the metadata of src, as with copy_file. Hardlinks
+    share it. If digests is provided, dst is read to hash it.
+
+    Return True if dst was linked, False if it was copied.
+    """
+    try:
+        if link_mode == "hardlink":
+            _hardlink(src, dst)
+        else:
+            _reflink(src, dst)
+            shutil.copystat(src, dst)
+    except OSError as e:
+        logging.debug("Unable to %s %s, copying instead: %s", link_mode, src, e)
+        copy_file(src, dst, digests)
+        return False
+    if digests is not None:
+        with open(dst, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digests.update(chunk)
+    return True
+
+
+def _hardlink(src, dst):
+    """Hardlink dst to src, replacing any existing file at dst."""
+    try:
+        os.link(src, dst)
+    except FileExistsError:
+        os.unlink(dst)
+        os.link(src, dst)
+
+
+def _reflink(src, dst):
+    """Clone data of regular file src to dst with FICLONE."""
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, "Reflinks not supported on this platform")
+    with open(src, "rb") as fsrc:
+        if not stat.S_ISREG(os.fstat(fsrc.fileno()).st_mode):
+            raise OSError(errno.EINVAL, "Not a regular file", src)
+        with open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+class DiskImageCarver:
+    """Carves files from a raw disk image with positioned reads of
+    their byte runs, using one open image handle.
+
+    carve_index maps carve keys of files to CarveInfo, or to None for
+    files that can't be carved from byte runs.
+    """
+
+    def __init__(self, image_path, carve_index):
+        self.image_path = image_path
+        self.carve_index = carve_index
+        self.fd = os.open(image_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+        # Size of block devices isn't reported by stat
+        self.image_size = os.lseek(self.fd, 0, os.SEEK_END)
+        self.span_starts = []
+        self.span_ends = []
+        self.buffer = b""
+        self.buffer_offset = 0
+        self.reads = 0
+        self.files_carved = 0
+
+    def plan_reads(self, carve_infos):
+        """Coalesce data runs of files in carve_infos into spans of
+        the image read in one go.
+
+        Runs at most COALESCE_GAP bytes apart are joined into spans of
+        up to COALESCE_MAX_SPAN bytes. Longer runs are read directly.
+        """
+        extents = []
+        for carve_info in carve_infos:
+            for (file_offset, img_offset, length, fill) in carve_info.byte_runs:
+                length = min(length, carve_info.filesize - file_offset)
+                if fill is None and 0 < length < COALESCE_MAX_SPAN:
+                    extents.append((img_offset, img_offset + length))
+        extents.sort()
+        spans = []
+        for (start, end) in extents:
+            if (
+                spans
+                and start - spans[-1][1] <= COALESCE_GAP
+                and max(end, spans[-1][1]) - spans[-1][0] <= COALESCE_MAX_SPAN
+            ):
+                spans[-1][1] = max(end, spans[-1][1])
+            else:
+                spans.append([start, end])
+        self.span_starts = [start for (start, end) in spans]
+        self.span_ends = [end for (start, end) in spans]
+
+    def can_carve(self, carve_info):
+        """Return True if byte runs of carve_info lie within the image,
+        up to the size of the file.
+        """
+        filesize = carve_info.filesize
+        return all(
+            fill is not None
+            or img_offset + min(length, filesize - file_offset) <= self.image_size
+            for (file_offset, img_offset, length, fill) in carve_info.byte_runs
+            if file_offset < filesize
+        )
+
+    def carve(self, carve_info, file_dest, digests=None):
+        """Write file described by carve_info to file_dest, hashing
+        its data with digests if provided.
+
+        Raise ValueError if byte runs reach past the end of the image.
+        """
+        if not self.can_carve(carve_info):
+            raise ValueError("Byte runs extend past end of {}".format(self.image_path))
+        chunks = self.iter_chunks(carve_info)
+        if digests is not None:
+            chunks = digests.hashed(chunks)
+        with open(file_dest, "wb") as out:
+            for chunk in chunks:
+                out.write(chunk)
+
+    def iter_chunks(self, carve_info):
+        """Yield data of file described by carve_info in chunks of up
+        to CARVE_CHUNK_SIZE bytes.
+        """
+        filesize = carve_info.filesize
+        for (file_offset, img_offset, length, fill) in carve_info.byte_runs:
+            length = min(length, filesize - file_offset)
+            if length <= 0:
+                break
+            if fill is not None:
+                fill_chunk = fill * min(length, CARVE_CHUNK_SIZE)
+                for done in range(0, length, CARVE_CHUNK_SIZE):
+                    yield fill_chunk[: length - done]
+                continue
+            done = 0
+            while done < length:
+                size = min(CARVE_CHUNK_SIZE, length - done)
+                data = self._read(img_offset + done, size)
+                if len(data) != size:
+                    raise OSError(
+                        "Short read at offset {} of {}".format(
+                            img_offset + done, self.image_path
+                        )
+                    )
+                yield data
+                done += size
+        self.files_carved += 1
+
+    def _read(self, offset, size):
+        """Return size bytes of image at offset, from the buffered span
+        holding them if there is one.
+        """
+        start = offset - self.buffer_offset
+        if 0 <= start and start + size <= len(self.buffer):
+            return self.buffer[start : start + size]
+        i = bisect.bisect_right(self.span_starts, offset) - 1
+        self.reads += 1
+        if i >= 0 and offset + size <= self.span_ends[i]:
+            span_start = self.span_starts[i]
+            self.buffer = memoryview(
+                self._pread(self.span_ends[i] - span_start, span_start)
+            )
+            self.buffer_offset = span_start
+            start = offset - span_start
+            if start + size <= len(self.buffer):
+                return self.buffer[start : start + size]
+        return self._pread(size, offset)
+
+    def _pread(self, size, offset):
+        """Return up to size bytes of image at offset, with os.pread
+        or, where it isn't available (Windows), a seek and reads.
+        """
+        if hasattr(os, "pread"):
+            return os.pread(self.fd, size, offset)
+        os.lseek(self.fd, offset, os.SEEK_SET)
+        parts = []
+        while size > 0:
+            data = os.read(self.fd, size)
+            if not data:
+                break
+            parts.append(data)
+            size -= len(data)
+        return b"".join(parts)
+
+    def close(self):
+        self.buffer = b""
+        os.close(self.fd)
+
+
+def order_carve_jobs(plan, carver=None):
+    """Return list of (index, ExportItem) for items in plan, ordered
+    to read the disk image sequentially.
+
+    Files carved from byte runs come first, ordered by offset of their
+    first data run in the image, and their reads are planned with
+    carver.plan_reads. Files carved with icat follow, ordered by
+    partition and inode.
+    """
+    carved = []
+    other = []
+    for (index, item) in enumerate(plan):
+        carve_info = None
+        if carver is not None:
+            carve_info = carver.carve_index.get(carve_key(item.file_info))
+        if carve_info is not None:
+            offsets = [run[1] for run in carve_info.byte_runs if run[3] is None]
+            carved.append((offsets[0] if offsets else -1, index, item, carve_info))
+        else:
+            other.append((_inode_order(item.file_info), index, item))
+    carved.sort(key=lambda job: job[:2])
+    other.sort(key=lambda job: job[:2])
+    if carver is not None:
+        carver.plan_reads([job[3] for job in carved])
+    return [(job[1], job[2]) for job in carved] + [(job[1], job[2]) for job in other]
+
+
+def order_copy_jobs(plan, source_path):
+    """Return list of (index, ExportItem, source filepath) for items
+    in plan, ordered by device and inode of source files.
+
+    Files that can't be stat'd come last, in plan order.
+    """
+    jobs = []
+    for (index, item) in enumerate(plan):
+        file_src = os.path.join(source_path, item.filepath)
+        try:
+            st = os.stat(file_src)
+            order = (0, st.st_dev, st.st_ino)
+        except OSError:
+            order = (1, 0, 0)
+        jobs.append((order, index, item, file_src))
+    jobs.sort(key=lambda job: job[:2])
+    return [job[1:] for job in jobs]
+
+
+def _inode_order(file_info):
+    try:
+        return (int(file_info["fs_offset"] or 0), int(file_info["inode"] or 0))
+    except ValueError:
+        return (0, 0)
+
+
+def is_database(path):
+    """Return True if file at path is a SQLite database."""
+    with open(path, "rb") as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def carve_key(file_info):
+    """Return key matching file in session to its DFXML fileobject."""
+    return (file_info["filepath"], str(file_info["inode"]), str(file_info["fs_offset"]))
+
+
+def read_carve_index(dfxml_path, keys=None):
+    """Return dict of carve keys to CarveInfo for regular files in
+    DFXML, or to None for files that can't be carved from byte runs.
+
+    If keys is provided, only files with those keys are included.
+    """
+    carve_index = {}
+    for (event, obj) in Objects.iterparse(dfxml_path):
+        if not isinstance(obj, Objects.FileObject):
+            continue
+        if obj.name_type and obj.name_type != "r":
+            continue
+        fs_offset = ""
+        if obj.volume_object:
+            fs_offset = obj.volume_object.partition_offset
+        key = (obj.filename, str(obj.inode or ""), str(fs_offset))
+        if keys is not None and key not in keys:
+            continue
+        carve_index[key] = dfxml_carve_info(obj)
+    return carve_index
+
+
+def dfxml_carve_info(obj):
+    """Return CarveInfo for DFXML fileobject, or None if its data
+    can't be read from its byte runs.
+
+    Compressed and resident data, runs without image offsets and byte
+    runs that don't cover the whole file are not supported.
+    """
+    if obj.compressed or obj.filesize is None:
+        return None
+    byte_runs = []
+    file_offset = 0
+    for run in obj.data_brs or []:
+        if run.type is not None or run.uncompressed_len is not None:
+            return None
+        if run.len is None:
+            return None
+        if run.file_offset is not None:
+            if run.file_offset != file_offset:
+                return None
+        if run.fill is None and run.img_offset is None:
+            return None
+        byte_runs.append((file_offset, run.img_offset, run.len, run.fill))
+        file_offset += run.len
+    if file_offset < obj.filesize:
+        return None
+    return CarveInfo(obj.filesize, tuple(byte_runs), obj.md5)
+
+
+def image_is_raw(image_path):
+    """Return True unless disk image starts with the signature of a
+    container format.
+    """
+    with open(image_path, "rb") as f:
+        start = f.read(16)
+    return not start.startswith(IMAGE_CONTAINER_SIGNATURES)
+
+
+class ArchiveError(Exception):
+    """Error writing a file to an archive after its header was written,
+    leaving the archive corrupt.
+    """
+
+
+class ArchiveWriter:
+    """Writes files to a tar or zip archive as a stream.
+
+    Format and compression are chosen from the extension of the
+    archive path (see ARCHIVE_FORMATS). Tar archives are written with
+    tarfile's stream modes and zip archives are deflated, reading and
+    writing ARCHIVE_BUFFER_SIZE bytes at a time.
+
+    Files are opened and stat'ed before their header is written, so
+    OSError from add_file leaves the archive intact. Errors once a
+    header is written raise ArchiveError.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tar = None
+        self.zip = None
+        mode = archive_mode(path)
+        if mode is None:
+            raise ValueError(
+                "Archive path must end in one of {}".format(
+                    ", ".join(extension for (extension, mode) in ARCHIVE_FORMATS)
+                )
+            )
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if mode == "zip":
+            self.zip = zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+        else:
+            self.tar = tarfile.open(
+                path,
+                mode,
+                bufsize=ARCHIVE_BUFFER_SIZE,
+                copybufsize=ARCHIVE_BUFFER_SIZE,
+            )
+
+    def add_file(self, src, arcname, digests=None):
+        """Add file at src to archive as arcname, with its metadata,
+        hashing its data with digests if provided.
+        """
+        with open(src, "rb") as f:
+            if self.tar is not None:
+                info = self.tar.gettarinfo(arcname=arcname, fileobj=f)
+            else:
+                info = zipfile.ZipInfo.from_file(src, arcname)
+                info.compress_type = zipfile.ZIP_DEFLATED
+            reader = f if digests is None else HashingReader(f, digests)
+            self._write_member(arcname, info, reader)
+
+    def add_chunks(self, arcname, chunks, size, mtime, mode=0o644):
+        """Add file of size bytes made of chunks to archive as arcname."""
+        if self.tar is not None:
+            info = tarfile.TarInfo(arcname)
+            info.size = size
+            info.mtime = int(mtime)
+            info.mode = mode
+        else:
+            date_time = time.localtime(max(mtime, ZIP_MIN_TIME))[:6]
+            info = zipfile.ZipInfo(arcname, date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = (stat.S_IFREG | mode) << 16
+        self._write_member(arcname, info, ChunkReader(chunks))
+
+    def _write_member(self, arcname, info, reader):
+        """Write header info and data read from reader to archive."""
+        try:
+            if self.tar is not None:
+                self.tar.addfile(info, reader)
+            else:
+                with self.zip.open(info, "w", force_zip64=True) as out:
+                    shutil.copyfileobj(reader, out, ARCHIVE_BUFFER_SIZE)
+        except (OSError, tarfile.TarError, zipfile.BadZipFile) as e:
+            raise ArchiveError(
+                "Error writing {} to archive: {}".format(arcname, e)
+            ) from e
+
+    def add_bytes(self, arcname, data):
+        """Add file containing data to archive as arcname."""
+        self.add_chunks(arcname, [data], len(data), time.time())
+
+    def close(self):
+        if self.tar is not None:
+            self.tar.close()
+        else:
+            self.zip.close()
+
+    def abort(self):
+        """Close and delete incomplete archive."""
+        try:
+            if self.tar is not None:
+                self.tar.fileobj.close()
+            else:
+                (fp, self.zip.fp) = (self.zip.fp, None)
+                fp.close()
+        except OSError:
+            pass
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ChunkReader:
+    """Read-only file-like object over an iterable of bytes chunks."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = b"".join(parts)
+        if size < 0:
+            self.buffer = b""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def archive_mode(path):
+    """Return tarfile stream mode or "zip" for archive path, or None
+    if its extension isn't one of ARCHIVE_FORMATS.
+    """
+    for (extension, mode) in ARCHIVE_FORMATS:
+        if path.lower().endswith(extension):
+            return mode
+    return None
+
+
+class FileDigests:
+    """MD5 and SHA-256 digests and size of data of one file."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.md5 = hashlib.md5()
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        self.sha256.update(data)
+        self.size += len(data)
+
+    def hashed(self, chunks):
+        """Yield chunks, hashing each on the way."""
+        for chunk in chunks:
+            self.update(chunk)
+            yield chunk
+
+
+class HashingReader:
+    """Read-only file-like object hashing data read from fileobj."""
+
+    def __init__(self, fileobj, digests):
+        self.fileobj = fileobj
+        self.digests = digests
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digests.update(data)
+        return data
+
+
+def fixity_status(record):
+    """Return "mismatch" if digests of FixityRecord differ from those
+    recorded during the scan, "verified" if they match, or
+    "unverified" if no digest was recorded.
+    """
+    recorded = [
+        (record.md5, record.recorded_md5),
+        (record.sha256, record.recorded_sha256),
+    ]
+    recorded = [(digest, expected) for (digest, expected) in recorded if expected]
+    if not recorded:
+        return "unverified"
+    if any(digest != expected for (digest, expected) in recorded):
+        return "mismatch"
+    return "verified"
+
+
+def manifest_path(path):
+    """Return path as written in manifests, with CR, LF and %
+    percent-encoded and separators as forward slashes.
+    """
+    path = path.replace(os.sep, "/")
+    return path.replace("%", "%25").replace("\r", "%0D").replace("\n", "%0A")
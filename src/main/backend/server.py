@@ -0,0 +1,472 @@
+#!/usr/bin/env python3
+
+"""
+Bulk Reviewer
+---
+Session query server module
+
+Licensed under GNU General Public License 3
+https://www.gnu.org/licenses/gpl-3.0.en.html
+"""
+
+import inspect
+import json
+import logging
+import sqlite3
+import sys
+import time
+
+# JSON-RPC 2.0 error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+# Default and maximum number of rows returned per query
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 10000
+
+# Columns rows can be sorted by
+FILE_SORT_COLUMNS = {
+    "id": "fl.id",
+    "filename": "fl.filename",
+    "filepath": "fl.filepath",
+    "date_modified": "fl.date_modified",
+    "date_created": "fl.date_created",
+    "size": "fl.size",
+    "allocated": "fl.allocated",
+    "verified": "fl.verified",
+    "feature_count": "feature_count",
+}
+FEATURE_SORT_COLUMNS = {
+    "id": "f.id",
+    "feature_type": "f.feature_type",
+    "feature": "f.feature",
+    "offset": "f.offset",
+    "note": "f.note",
+    "dismissed": "f.dismissed",
+    "file": "f.file",
+    "filepath": "fl.filepath",
+}
+SESSION_BOOLEAN_COLUMNS = (
+    "disk_image",
+    "named_entity_extraction",
+    "include_exif",
+    "include_network",
+)
+FILE_BOOLEAN_COLUMNS = ("allocated", "verified")
+FEATURE_BOOLEAN_COLUMNS = ("dismissed",)
+
+FILES_QUERY = """\
+    SELECT fl.*, COALESCE(c.feature_count, 0) as feature_count \
+    from file fl
+    LEFT JOIN temp.file_feature_count c ON c.file = fl.id"""
+FEATURES_QUERY = """\
+    SELECT f.id, f.feature_type, f.forensic_path, \
+        f.offset, f.feature, f.context, f.note, \
+        f.dismissed, f.file, fl.filepath
+    from feature f JOIN file fl ON f.file = fl.id"""
+# Indexes used by filtered queries
+SERVER_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_feature_file ON feature (file)",
+    "CREATE INDEX IF NOT EXISTS ix_feature_type ON feature (feature_type)",
+)
+
+
+class RPCError(Exception):
+    """Error returned to client as JSON-RPC error object"""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class SessionServer:
+    """Class serving queries and reviewer changes over a Bulk Reviewer
+    session database.
+
+    Requests and responses are JSON-RPC 2.0 objects, one per line, read
+    from infile and written to outfile. Reviewer changes are written to
+    the database as they are made. If save is provided, it is called
+    with the sets of ids of changed features and files when a client
+    requests "save" and when the server shuts down with unsaved
+    changes, and its return value is returned to the client.
+    """
+
+    def __init__(self, db_path, save=None):
+        self.db_path = db_path
+        self.save_callback = save
+        self.changed_features = set()
+        self.changed_files = set()
+        self.running = False
+        self.methods = {
+            "session": self.session,
+            "feature_types": self.feature_types,
+            "files": self.files,
+            "features": self.features,
+            "dismiss": self.dismiss,
+            "note": self.note,
+            "verify": self.verify,
+            "save": self.save,
+            "shutdown": self.shutdown,
+        }
+        self.conn = sqlite3.connect(db_path)
+        cursor = self.conn.cursor()
+        for index in SERVER_INDEXES:
+            cursor.execute(index)
+        # Feature counts don't change during review, so count them once
+        cursor.execute(
+            """\
+            CREATE TEMP TABLE file_feature_count AS \
+            SELECT file, COUNT(*) as feature_count from feature GROUP BY file;
+            """
+        )
+        cursor.execute(
+            "CREATE INDEX temp.ix_file_feature_count ON file_feature_count (file)"
+        )
+        self.conn.commit()
+        cursor.close()
+
+    def serve(self, infile=None, outfile=None):
+        """Handle requests from infile until shutdown or end of input"""
+        infile = infile or sys.stdin.buffer
+        outfile = outfile or sys.stdout.buffer
+        self.running = True
+        try:
+            for line in infile:
+                if not line.strip():
+                    continue
+                response = self.handle_line(line)
+                if response is not None:
+                    outfile.write(
+                        json.dumps(response, ensure_ascii=False).encode("utf-8")
+                        + b"\n"
+                    )
+                    outfile.flush()
+                if not self.running:
+                    break
+        finally:
+            if self.changed_features or self.changed_files:
+                self.save()
+            self.conn.close()
+
+    def handle_line(self, line):
+        """Return response to JSON-RPC request line, or None for notifications"""
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return _error_response(None, PARSE_ERROR, "Parse error: {}".format(e))
+        if not isinstance(request, dict):
+            return _error_response(None, INVALID_REQUEST, "Invalid request")
+        return self.handle(request)
+
+    def handle(self, request):
+        """Return response to JSON-RPC request, or None for notifications"""
+        request_id = request.get("id")
+        name = request.get("method")
+        params = request.get("params", {})
+        try:
+            if not isinstance(name, str):
+                raise RPCError(INVALID_REQUEST, "Invalid request")
+            method = self.methods.get(name)
+            if method is None:
+                raise RPCError(METHOD_NOT_FOUND, "Method not found: {}".format(name))
+            _check_params(method, params)
+            start_time = time.time()
+            result = method(**params)
+            logging.debug("Handled %s in %.4f seconds", name, time.time() - start_time)
+        except RPCError as e:
+            response = _error_response(request_id, e.code, e.message)
+        except Exception as e:
+            logging.error("Error handling request %s: %s", request, e)
+            response = _error_response(request_id, INTERNAL_ERROR, str(e))
+        else:
+            response = {"jsonrpc": "2.0", "id": request_id, "result": result}
+        # Notifications get no response, even on errors
+        if "id" not in request:
+            return None
+        return response
+
+    def session(self):
+        """Return session info with counts of files and features"""
+        cursor = self.conn.execute("SELECT * from session;")
+        session_info = _row_dict(cursor, cursor.fetchone(), SESSION_BOOLEAN_COLUMNS)
+        session_info["file_count"] = self._scalar("SELECT COUNT(*) from file;")
+        session_info["feature_count"] = self._scalar("SELECT COUNT(*) from feature;")
+        session_info["dismissed_count"] = self._scalar(
+            "SELECT COUNT(*) from feature WHERE dismissed = 1;"
+        )
+        return session_info
+
+    def feature_types(self):
+        """Return feature types with counts of features and dismissed features"""
+        cursor = self.conn.execute(
+            """\
+            SELECT feature_type, COUNT(*), COALESCE(SUM(dismissed), 0) \
+            from feature GROUP BY feature_type ORDER BY MIN(id);
+            """
+        )
+        return [
+            {"feature_type": feature_type, "count": count, "dismissed": dismissed}
+            for (feature_type, count, dismissed) in cursor
+        ]
+
+    def files(
+        self,
+        offset=0,
+        limit=DEFAULT_LIMIT,
+        sort="id",
+        order="asc",
+        search=None,
+        has_features=None,
+        allocated=None,
+        verified=None,
+    ):
+        """Return total count and page of files matching filters"""
+        conditions = []
+        values = []
+        if search:
+            conditions.append("fl.filepath LIKE ? ESCAPE '\\'")
+            values.append(_like_pattern(search))
+        if has_features is not None:
+            conditions.append(
+                "COALESCE(c.feature_count, 0) {} 0".format(">" if has_features else "=")
+            )
+        for (column, value) in (("allocated", allocated), ("verified", verified)):
+            if value is not None:
+                conditions.append("fl.{} = ?".format(column))
+                values.append(bool(value))
+        return self._page(
+            FILES_QUERY,
+            conditions,
+            values,
+            FILE_SORT_COLUMNS,
+            ("fl.id",),
+            sort,
+            order,
+            offset,
+            limit,
+            FILE_BOOLEAN_COLUMNS,
+        )
+
+    def features(
+        self,
+        offset=0,
+        limit=DEFAULT_LIMIT,
+        sort="id",
+        order="asc",
+        feature_type=None,
+        file=None,
+        dismissed=None,
+        search=None,
+    ):
+        """Return total count and page of features matching filters"""
+        conditions = []
+        values = []
+        if feature_type is not None:
+            feature_types = (
+                [feature_type] if isinstance(feature_type, str) else list(feature_type)
+            )
+            conditions.append(
+                "f.feature_type IN ({})".format(", ".join("?" * len(feature_types)))
+            )
+            values.extend(feature_types)
+        if file is not None:
+            conditions.append("f.file = ?")
+            values.append(_int_param("file", file))
+        if dismissed is not None:
+            conditions.append("f.dismissed = ?")
+            values.append(bool(dismissed))
+        if search:
+            conditions.append(
+                "(f.feature LIKE ? ESCAPE '\\' OR f.context LIKE ? ESCAPE '\\')"
+            )
+            values.extend([_like_pattern(search)] * 2)
+        return self._page(
+            FEATURES_QUERY,
+            conditions,
+            values,
+            FEATURE_SORT_COLUMNS,
+            ("f.id",),
+            sort,
+            order,
+            offset,
+            limit,
+            FEATURE_BOOLEAN_COLUMNS,
+        )
+
+    def dismiss(self, ids, dismissed=True):
+        """Set dismissed status of features with ids"""
+        return self._update("feature", ids, "dismissed", bool(dismissed))
+
+    def note(self, ids, note=None):
+        """Set note of features with ids. A null note deletes notes."""
+        if note is not None and not isinstance(note, str):
+            raise RPCError(INVALID_PARAMS, "Note must be a string or null")
+        return self._update("feature", ids, "note", note)
+
+    def verify(self, ids, verified=True):
+        """Set verified status of files with ids"""
+        return self._update("file", ids, "verified", bool(verified))
+
+    def save(self):
+        """Write changes made since last save to session output"""
+        if self.save_callback is None:
+            return None
+        result = self.save_callback(self.changed_features, self.changed_files)
+        self.changed_features = set()
+        self.changed_files = set()
+        return result
+
+    def shutdown(self):
+        """Stop serving after responding to this request"""
+        self.running = False
+        return True
+
+    def _page(
+        self,
+        query,
+        conditions,
+        values,
+        sort_columns,
+        tiebreak,
+        sort,
+        order,
+        offset,
+        limit,
+        boolean_columns,
+    ):
+        if sort not in sort_columns:
+            raise RPCError(INVALID_PARAMS, "Cannot sort by {}".format(sort))
+        if order not in ("asc", "desc"):
+            raise RPCError(INVALID_PARAMS, "Order must be asc or desc")
+        offset = _int_param("offset", offset)
+        limit = _int_param("limit", limit)
+        if offset < 0 or not 0 < limit <= MAX_LIMIT:
+            raise RPCError(
+                INVALID_PARAMS,
+                "Offset must be >= 0 and limit between 1 and {}".format(MAX_LIMIT),
+            )
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        total = self._scalar("SELECT COUNT(*) FROM ({});".format(query), values)
+        order_by = [sort_columns[sort] + " " + order.upper()]
+        order_by.extend(column + " " + order.upper() for column in tiebreak)
+        cursor = self.conn.execute(
+            "{} ORDER BY {} LIMIT ? OFFSET ?;".format(query, ", ".join(order_by)),
+            values + [limit, offset],
+        )
+        items = [_row_dict(cursor, row, boolean_columns) for row in cursor]
+        return {"total": total, "offset": offset, "items": items}
+
+    def _update(self, table, ids, column, value):
+        if isinstance(ids, int):
+            ids = [ids]
+        ids = [_int_param("ids", i) for i in ids]
+        cursor = self.conn.cursor()
+        cursor.executemany(
+            "UPDATE {} SET {} = ? WHERE id = ?;".format(table, column),
+            [(value, i) for i in ids],
+        )
+        updated = cursor.rowcount
+        self.conn.commit()
+        cursor.close()
+        changed = self.changed_features if table == "feature" else self.changed_files
+        changed.update(ids)
+        return {"updated": updated}
+
+    def _scalar(self, query, values=()):
+        return self.conn.execute(query, values).fetchone()[0]
+
+
+def _check_params(method, params):
+    """
+    Raise RPCError if params aren't an object of parameters of method
+    with values allowed by PARAM_CHECKS. Null is allowed for
+    parameters that default to null.
+    """
+    if not isinstance(params, dict):
+        raise RPCError(INVALID_PARAMS, "Params must be an object")
+    signature = inspect.signature(method)
+    try:
+        signature.bind(**params)
+    except TypeError as e:
+        raise RPCError(INVALID_PARAMS, str(e))
+    for (name, value) in params.items():
+        if value is None and signature.parameters[name].default is None:
+            continue
+        (check, description) = PARAM_CHECKS[name]
+        if not check(value):
+            raise RPCError(INVALID_PARAMS, "{} must be {}".format(name, description))
+
+
+def _is_int(value):
+    return type(value) == int
+
+
+def _is_bool(value):
+    return type(value) == bool
+
+
+def _is_str(value):
+    return isinstance(value, str)
+
+
+def _is_str_or_list(value):
+    return _is_str(value) or (
+        isinstance(value, list) and all(_is_str(v) for v in value)
+    )
+
+
+def _is_int_or_list(value):
+    return _is_int(value) or (
+        isinstance(value, list) and all(_is_int(v) for v in value)
+    )
+
+
+# Checks of method parameters by name, with description of values allowed
+PARAM_CHECKS = {
+    "offset": (_is_int, "an integer"),
+    "limit": (_is_int, "an integer"),
+    "sort": (_is_str, "a string"),
+    "order": (_is_str, "a string"),
+    "search": (_is_str, "a string"),
+    "note": (_is_str, "a string or null"),
+    "has_features": (_is_bool, "a boolean"),
+    "allocated": (_is_bool, "a boolean"),
+    "verified": (_is_bool, "a boolean"),
+    "dismissed": (_is_bool, "a boolean"),
+    "file": (_is_int, "an integer"),
+    "feature_type": (_is_str_or_list, "a string or list of strings"),
+    "ids": (_is_int_or_list, "an integer or list of integers"),
+}
+
+
+def _row_dict(cursor, row, boolean_columns):
+    d = {}
+    for (column, value) in zip(cursor.description, row):
+        if column[0] in boolean_columns:
+            value = value == 1
+        d[column[0]] = value
+    return d
+
+
+def _like_pattern(search):
+    escaped = search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return "%" + escaped + "%"
+
+
+def _int_param(name, value):
+    if type(value) != int:
+        raise RPCError(INVALID_PARAMS, "{} must be an integer".format(name))
+    return value
+
+
+def _error_response(request_id, code, message):
+    return {
+        "jsonrpc": "2.0",
+        "id": request_id,
+        "error": {"code": code, "message": message},
+    }
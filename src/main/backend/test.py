@@ -1,15 +1,44 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
 import os
 import shutil
 import subprocess
+import tarfile
 import tempfile
 import unittest
 
 from os.path import join as j
 
-from export import FileExport
+import fiwalk
+from sqlalchemy.orm import sessionmaker
+
+from br_processor import (
+    Base,
+    BatchWriter,
+    BRSession,
+    ByteRunIndex,
+    Feature,
+    File,
+    FeatureFileTail,
+    RunManifest,
+    _make_parser,
+    byterundb2,
+    create_database_engine,
+    dfxml_file_rows,
+    json_to_brv,
+    read_features_to_db,
+    rollback_incomplete_stages,
+    write_filesystem_metadata_to_db,
+)
+from export import (
+    COALESCE_GAP,
+    CarveInfo,
+    DiskImageCarver,
+    FileExport,
+    read_carve_index,
+)
 
 # from utils import time_to_int
 
@@ -18,6 +47,162 @@ def is_non_zero_file(fpath):
     return os.path.isfile(fpath) and os.path.getsize(fpath) > 0
 
 
+# Fileobjects with each combination of allocation tags, mapped to
+# whether dfxml.fileobject.allocated() reports them allocated
+ALLOCATION_TAG_CASES = (
+    ("<alloc>1</alloc>", True),
+    ("<alloc>0</alloc>", True),
+    ("<unalloc>1</unalloc>", False),
+    ("<unalloc>0</unalloc>", True),
+    ("<alloc>0</alloc><unalloc>1</unalloc>", False),
+    ("<alloc>1</alloc><unalloc>1</unalloc>", True),
+    ("<unalloc>1</unalloc><alloc>0</alloc>", False),
+    ("<alloc>0</alloc><unalloc>0</unalloc>", True),
+    ("<ALLOC>1</ALLOC><unalloc>1</unalloc>", True),
+    (
+        "<alloc_inode>1</alloc_inode><alloc_name>1</alloc_name>"
+        "<unalloc>1</unalloc>",
+        True,
+    ),
+    ("", True),
+)
+
+
+def write_allocation_dfxml(path):
+    """Write DFXML file with a fileobject for each of ALLOCATION_TAG_CASES.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(
+            "<?xml version='1.0' encoding='UTF-8'?>\n"
+            "<dfxml xmloutputversion='1.0' xmlns='http://www.forensicswiki.org/wiki/"
+            "Category:Digital_Forensics_XML'>\n"
+            "<volume offset='32256'><partition_offset>32256</partition_offset>\n"
+        )
+        for (i, (tags, allocated)) in enumerate(ALLOCATION_TAG_CASES):
+            f.write(
+                "<fileobject><filename>file{0}</filename><name_type>r</name_type>"
+                "<filesize>512</filesize>{1}<inode>{0}</inode><byte_runs>"
+                "<byte_run file_offset='0' img_offset='{2}' len='512'/>"
+                "</byte_runs></fileobject>\n".format(i, tags, 4096 * (i + 1))
+            )
+        f.write("</volume>\n</dfxml>\n")
+
+
+# Fileobjects with byte runs read by read_carve_index, mapped to
+# whether they can be carved from their byte runs
+CARVE_DFXML_CASES = (
+    (
+        "<filesize>2000</filesize><byte_runs>"
+        "<byte_run file_offset='0' img_offset='1024' len='1000'/>"
+        "<byte_run file_offset='1000' fill='0' len='500'/>"
+        "<byte_run file_offset='1500' img_offset='8192' len='600'/>"
+        "</byte_runs>",
+        True,
+    ),
+    (
+        "<filesize>512</filesize><byte_runs>"
+        "<byte_run file_offset='0' len='512'/></byte_runs>",
+        False,
+    ),
+    (
+        "<filesize>1024</filesize><byte_runs>"
+        "<byte_run file_offset='0' img_offset='0' len='512'/></byte_runs>",
+        False,
+    ),
+    ("<filesize>0</filesize>", True),
+)
+
+
+def write_image(path, size):
+    """Write raw disk image of size bytes with a repeating byte
+    pattern and return its data.
+    """
+    data = bytes(range(256)) * (size // 256)
+    with open(path, "wb") as f:
+        f.write(data)
+    return data
+
+
+# Allocation tags and (img_offset, len) byte runs of fileobjects with
+# adjacent, overlapping and separated runs, allocated and unallocated
+BYTE_RUN_FILES = (
+    ("<alloc>1</alloc>", ((1000, 2000), (4000, 500))),
+    ("<alloc>1</alloc>", ((1500, 500), (4000, 1000))),
+    ("<alloc>1</alloc>", ((3000, 1000),)),
+    ("<unalloc>1</unalloc>", ((6000, 1000), (900, 200))),
+    ("<alloc>1</alloc>", ((6500, 100),)),
+    ("<unalloc>1</unalloc>", ((6500, 100), (8000, 100))),
+)
+
+
+def write_byte_run_dfxml(path):
+    """Write DFXML file with a fileobject for each of BYTE_RUN_FILES.
+    """
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(
+            "<?xml version='1.0' encoding='UTF-8'?>\n"
+            "<dfxml xmloutputversion='1.0'>\n"
+            "<volume offset='0'><partition_offset>0</partition_offset>\n"
+        )
+        for (i, (tags, runs)) in enumerate(BYTE_RUN_FILES):
+            f.write(
+                "<fileobject><filename>file{0}</filename><name_type>r</name_type>"
+                "<filesize>{1}</filesize>{2}<inode>{3}</inode><byte_runs>".format(
+                    i, sum(length for (offset, length) in runs), tags, i + 1
+                )
+            )
+            file_offset = 0
+            for (img_offset, length) in runs:
+                f.write(
+                    "<byte_run file_offset='{}' img_offset='{}' len='{}'/>".format(
+                        file_offset, img_offset, length
+                    )
+                )
+                file_offset += length
+            f.write("</byte_runs></fileobject>\n")
+        f.write("</volume>\n</dfxml>\n")
+
+
+def write_feature_files(feature_dir, source_dir, count):
+    """Write bulk_extractor feature files with count features in each
+    of the files in test_data source_directory.
+    """
+    os.makedirs(feature_dir)
+    for (name, feature) in (("pii.txt", "123-45-{:04d}"), ("email.txt", "a{}@b.com")):
+        with open(j(feature_dir, name), "w", encoding="utf-8") as f:
+            f.write("# BANNER FILE NOT PROVIDED (-b option)\n")
+            for i in range(count):
+                for filepath in ("file1_ssn.txt", "subdir/file3_email.txt"):
+                    f.write(
+                        "{}/{}\t{}\tcontext {}\n".format(
+                            source_dir, filepath, feature.format(i), i
+                        )
+                    )
+
+
+class RunInterrupted(Exception):
+    """Raised by InterruptedManifest to stop a run."""
+
+
+class InterruptedManifest(RunManifest):
+    """RunManifest that stops a run after features are committed to
+    the database but before they are checkpointed, once checkpoints
+    checkpoints have been recorded.
+    """
+
+    def __init__(self, path, inputs, checkpoints):
+        super(InterruptedManifest, self).__init__(path, inputs)
+        self.checkpoints = checkpoints
+
+    def commit_features(self, feature_file, offset, feature_id):
+        if self.checkpoints == 0:
+            raise RunInterrupted()
+        self.checkpoints -= 1
+        super(InterruptedManifest, self).commit_features(
+            feature_file, offset, feature_id
+        )
+
+
 def write_updated_json(infile, outfile, source_path):
     """Write new Bulk Reviewer JSON file with updated source_path.
     """
@@ -64,6 +249,319 @@ class SelfCleaningTestCase(unittest.TestCase):
         super(SelfCleaningTestCase, self).tearDown()
 
 
+class BrProcessorTest(SelfCleaningTestCase):
+    """Unit tests for br_processor.
+    """
+
+    source_dir = os.path.abspath(
+        j(os.path.dirname(__file__), "..", "test_data", "source_directory")
+    )
+
+    def _open_session(self, name):
+        """Return engine and session of new database with files of
+        source_dir, and the id of its BRSession.
+        """
+        engine = create_database_engine(j(self.tmpdir, name + ".sqlite"))
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        br_session = BRSession(name=name, source_path=self.source_dir)
+        session.add(br_session)
+        session.commit()
+        write_filesystem_metadata_to_db(session, br_session.id, self.source_dir)
+        return (engine, session, br_session.id)
+
+    @staticmethod
+    def _feature_rows(session):
+        """Return all rows of Feature table in id order."""
+        return [
+            (f.id, f.feature_type, f.forensic_path, f.feature, f.context, f.file)
+            for f in session.query(Feature).order_by(Feature.id)
+        ]
+
+    def test_feature_file_tail_long_line(self):
+        """Test FeatureFileTail reads lines longer than max_bytes.
+        """
+        path = j(self.tmpdir, "email.txt")
+        long_line = b"0\t" + b"a" * 100 + b"\tcontext\n"
+        with open(path, "wb") as f:
+            f.write(b"0\tshort\tcontext\n" + long_line + b"1\tpartial")
+        tail = FeatureFileTail(path)
+        lines = []
+        for batch in iter(lambda: tail.read_lines(max_bytes=16), []):
+            lines.extend(batch)
+        # Long line is read, partial last line left while polling
+        self.assertEqual(lines, [b"0\tshort\tcontext\n", long_line])
+        # Final pass reads remainder
+        self.assertEqual(tail.read_lines(True, max_bytes=16), [b"1\tpartial"])
+        self.assertEqual(tail.read_lines(True, max_bytes=16), [])
+
+    def test_dfxml_allocation_tags(self):
+        """Test allocation of fileobjects read in one pass matches dfxml.
+        """
+        dfxml_path = j(self.tmpdir, "dfxml.xml")
+        write_allocation_dfxml(dfxml_path)
+        rundb = ByteRunIndex()
+        rows = [row for (row, fileno) in dfxml_file_rows(dfxml_path, 1, rundb)]
+        sax_rundb = ByteRunIndex()
+        with open(dfxml_path, "rb") as f:
+            fiwalk.fiwalk_using_sax(xmlfile=f, callback=sax_rundb.process)
+        self.assertEqual(rundb.fileinfo, sax_rundb.fileinfo)
+        expected = [
+            ("file{}" if allocated else "*file{}").format(i).encode("utf-8")
+            for (i, (tags, allocated)) in enumerate(ALLOCATION_TAG_CASES)
+        ]
+        self.assertEqual([fname for (fname, md5) in rundb.fileinfo], expected)
+        # Verify partition offset of volume read for rows
+        self.assertEqual({row["fs_offset"] for row in rows}, {32256})
+
+    def test_batch_writer_invalid_row(self):
+        """Test rows of a batch with an invalid row are written one at a
+        time and their ids reported.
+        """
+        (engine, session, br_session_id) = self._open_session("batch")
+        inserted = []
+        writer = BatchWriter(
+            session,
+            File.__table__,
+            3,
+            lambda key, file_id: inserted.append((key, file_id)),
+        )
+        # Integer primary key can't be set to text
+        for (key, file_id) in (("a", None), ("b", "invalid"), ("c", None)):
+            writer.add(dict(id=file_id, filepath=key, session=br_session_id), key)
+        for key in ("d", "e"):
+            writer.add(dict(id=None, filepath=key, session=br_session_id), key)
+        writer.close()
+        self.assertEqual((writer.written, writer.failed), (4, 1))
+        self.assertEqual([key for (key, file_id) in inserted], ["a", "c", "d", "e"])
+        # Verify reported ids are those of the rows written
+        files = session.query(File.filepath, File.id).filter(
+            File.filepath.in_(["a", "b", "c", "d", "e"])
+        )
+        self.assertEqual(sorted(inserted), sorted(tuple(row) for row in files))
+        session.close()
+        engine.dispose()
+
+    def test_read_features_parallel(self):
+        """Test features read by worker processes match serial reading.
+        """
+        feature_dir = j(self.tmpdir, "bulk_extractor")
+        write_feature_files(feature_dir, self.source_dir, 50)
+        feature_rows = []
+        for jobs in ("1", "2"):
+            (engine, session, br_session_id) = self._open_session("jobs" + jobs)
+            args = _make_parser().parse_args(
+                ["--jobs", jobs, self.source_dir, self.tmpdir, "jobs" + jobs]
+            )
+            # Small chunks so that each feature file spans several
+            read_features_to_db(
+                feature_dir, br_session_id, session, args, chunk_size=256
+            )
+            feature_rows.append(self._feature_rows(session))
+            session.close()
+            engine.dispose()
+        self.assertEqual(len(feature_rows[0]), 200)
+        self.assertEqual(feature_rows[0], feature_rows[1])
+
+    def test_resume_read_features(self):
+        """Test resumed feature reading matches an uninterrupted run.
+        """
+        feature_dir = j(self.tmpdir, "bulk_extractor")
+        write_feature_files(feature_dir, self.source_dir, 50)
+        args = _make_parser().parse_args([self.source_dir, self.tmpdir, "resume"])
+        inputs = dict(source=self.source_dir)
+        # Uninterrupted run
+        (engine, session, br_session_id) = self._open_session("full")
+        manifest = RunManifest(j(self.tmpdir, "full.json"), inputs)
+        read_features_to_db(
+            feature_dir, br_session_id, session, args, None, manifest, chunk_size=256
+        )
+        expected = self._feature_rows(session)
+        session.close()
+        engine.dispose()
+        # Run interrupted after features past its last checkpoint were
+        # committed
+        (engine, session, br_session_id) = self._open_session("resume")
+        manifest_path = j(self.tmpdir, "resume.json")
+        manifest = InterruptedManifest(manifest_path, inputs, 3)
+        manifest.complete("files")
+        manifest.complete("bulk_extractor")
+        with self.assertRaises(RunInterrupted):
+            read_features_to_db(
+                feature_dir,
+                br_session_id,
+                session,
+                args,
+                None,
+                manifest,
+                chunk_size=256,
+            )
+        manifest = RunManifest(manifest_path, inputs)
+        self.assertTrue(manifest.load())
+        self.assertEqual(len(manifest.feature_offsets), 1)
+        rows = self._feature_rows(session)
+        checkpointed = [row for row in rows if row[0] <= manifest.feature_id]
+        self.assertEqual(rows[: len(checkpointed)], checkpointed)
+        self.assertGreater(len(rows), len(checkpointed))
+        # Verify only rows after checkpoint deleted
+        rollback_incomplete_stages(session, manifest)
+        self.assertEqual(self._feature_rows(session), checkpointed)
+        # Verify resumed run reads remaining features
+        read_features_to_db(
+            feature_dir, br_session_id, session, args, None, manifest, chunk_size=256
+        )
+        self.assertEqual(self._feature_rows(session), expected)
+        session.close()
+        engine.dispose()
+
+    def test_byte_run_index_search(self):
+        """Test ByteRunIndex finds the same files as byterundb2.
+        """
+        dfxml_path = j(self.tmpdir, "dfxml.xml")
+        write_byte_run_dfxml(dfxml_path)
+        rundb = byterundb2()
+        rundb.read_xmlfile(dfxml_path)
+        sax_index = ByteRunIndex()
+        sax_index.read_xmlfile(dfxml_path)
+        index = ByteRunIndex()
+        for (row, fileno) in dfxml_file_rows(dfxml_path, 1, index):
+            index.set_file_id(fileno, int(row["inode"]))
+        # Search run starts and ends, gaps and overlaps
+        offsets = {0, 10000}
+        for (tags, runs) in BYTE_RUN_FILES:
+            for (img_offset, length) in runs:
+                for offset in (img_offset, img_offset + length):
+                    offsets.update((offset - 1, offset, offset + 1))
+        offsets.update((950, 1050, 2500, 4700, 6200, 6550, 6700))
+        paths = [str(offset).encode("utf-8") for offset in sorted(offsets)]
+        expected = rundb.search_paths(paths)
+        for found in (sax_index.search_paths(paths), index.search_paths(paths)):
+            self.assertEqual(
+                [None if r is None else r[0] for r in found],
+                [None if r is None else r[0] for r in expected],
+            )
+        # Verify allocated files found before unallocated files
+        found = dict(zip(paths, index.search_paths(paths)))
+        self.assertEqual(found[b"6550"], ((b"file4", b""), 5))
+        self.assertEqual(found[b"6200"], ((b"*file3", b""), 4))
+        self.assertEqual(found[b"950"], ((b"*file3", b""), 4))
+        self.assertEqual(found[b"1050"], ((b"file0", b""), 1))
+        # Like byterundb2, only the run starting nearest below an offset
+        # is checked, so offsets past a run nested in another aren't found
+        self.assertIsNone(found[b"2500"])
+        self.assertIsNone(found[b"6700"])
+
+
+class ExportCarverTest(SelfCleaningTestCase):
+    """Unit tests for carving files from disk images in export.
+    """
+
+    def test_dfxml_carve_info(self):
+        """Test carve info read from DFXML byte runs and files carved.
+        """
+        image = write_image(j(self.tmpdir, "image.dd"), 16384)
+        dfxml_path = j(self.tmpdir, "dfxml.xml")
+        with open(dfxml_path, "w", encoding="utf-8") as f:
+            f.write(
+                "<?xml version='1.0' encoding='UTF-8'?>\n"
+                "<dfxml xmloutputversion='1.0'>\n"
+                "<volume offset='0'><partition_offset>0</partition_offset>\n"
+            )
+            for (i, (runs, carvable)) in enumerate(CARVE_DFXML_CASES):
+                f.write(
+                    "<fileobject><filename>file{0}</filename>"
+                    "<name_type>r</name_type><inode>{1}</inode>{2}"
+                    "</fileobject>\n".format(i, i + 1, runs)
+                )
+            f.write("</volume>\n</dfxml>\n")
+        carve_index = read_carve_index(dfxml_path)
+        keys = [
+            ("file{}".format(i), str(i + 1), "0")
+            for i in range(len(CARVE_DFXML_CASES))
+        ]
+        self.assertEqual(sorted(carve_index), sorted(keys))
+        self.assertEqual(
+            [carve_index[key] is not None for key in keys],
+            [carvable for (runs, carvable) in CARVE_DFXML_CASES],
+        )
+        # Verify fill run written and last run truncated to filesize
+        carver = DiskImageCarver(j(self.tmpdir, "image.dd"), carve_index)
+        try:
+            file_dest = j(self.tmpdir, "file0")
+            carver.carve(carve_index[keys[0]], file_dest)
+            file_dest_empty = j(self.tmpdir, "file3")
+            carver.carve(carve_index[keys[3]], file_dest_empty)
+        finally:
+            carver.close()
+        with open(file_dest, "rb") as f:
+            data = f.read()
+        self.assertEqual(data, image[1024:2024] + b"\x00" * 500 + image[8192:8692])
+        self.assertEqual(os.path.getsize(file_dest_empty), 0)
+
+    def test_carve_past_end_of_image(self):
+        """Test byte runs past the end of the image aren't carved.
+        """
+        image_path = j(self.tmpdir, "image.dd")
+        image = write_image(image_path, 4096)
+        past_end = CarveInfo(512, ((0, 3840, 512, None),), None)
+        # Runs past the end of the file or filled aren't read
+        truncated = CarveInfo(256, ((0, 3840, 512, None), (512, 8192, 512, None)), None)
+        filled = CarveInfo(
+            1024, ((0, 3584, 512, None), (512, None, 512, b"\x00")), None
+        )
+        carver = DiskImageCarver(image_path, {})
+        try:
+            self.assertFalse(carver.can_carve(past_end))
+            with self.assertRaises(ValueError):
+                carver.carve(past_end, j(self.tmpdir, "past_end"))
+            self.assertTrue(carver.can_carve(truncated))
+            self.assertEqual(b"".join(carver.iter_chunks(truncated)), image[3840:])
+            self.assertTrue(carver.can_carve(filled))
+            self.assertEqual(
+                b"".join(carver.iter_chunks(filled)), image[3584:] + b"\x00" * 512
+            )
+        finally:
+            carver.close()
+
+    def test_carve_coalesced_reads(self):
+        """Test runs close together are read in one span and others
+        directly.
+        """
+        image_path = j(self.tmpdir, "image.dd")
+        image = write_image(image_path, 4 * COALESCE_GAP)
+        far = 3 * COALESCE_GAP
+        carve_infos = [
+            CarveInfo(600, ((0, 1024, 500, None), (500, 4096, 500, None)), None),
+            CarveInfo(100, ((0, 2048, 100, None),), None),
+            CarveInfo(512, ((0, far, 512, None),), None),
+        ]
+        expected = [
+            image[1024:1524] + image[4096:4196],
+            image[2048:2148],
+            image[far : far + 512],
+        ]
+        # Without planned spans every run is read directly
+        carver = DiskImageCarver(image_path, {})
+        try:
+            chunks = [b"".join(carver.iter_chunks(info)) for info in carve_infos]
+            self.assertEqual(chunks, expected)
+            self.assertEqual(carver.reads, 4)
+        finally:
+            carver.close()
+        # Planned spans join runs up to COALESCE_GAP apart
+        carver = DiskImageCarver(image_path, {})
+        try:
+            carver.plan_reads(carve_infos)
+            self.assertEqual(carver.span_starts, [1024, far])
+            self.assertEqual(carver.span_ends, [4196, far + 512])
+            chunks = [b"".join(carver.iter_chunks(info)) for info in carve_infos]
+            self.assertEqual(chunks, expected)
+            self.assertEqual(carver.reads, 2)
+            self.assertEqual(carver.files_carved, 3)
+        finally:
+            carver.close()
+
+
 class TestIntegrationProcessor(SelfCleaningTestCase):
     """Main Bulk Reviewer backend integration tests.
     """
@@ -108,8 +606,164 @@ class TestIntegrationProcessor(SelfCleaningTestCase):
             self.assertEqual(len(test_dict["files"]), len(sample_dict["files"]))
             self.assertEqual(len(test_dict["features"]), len(sample_dict["features"]))
 
+    def test_directory_cached_reports(self):
+        """Test reuse of cached bulk_extractor reports for directory.
+        """
+        br_processor_path = os.path.abspath(
+            j(os.path.dirname(__file__), "br_processor.py")
+        )
+        source_dir = j(self.test_data_dir, "source_directory")
+        out_dir = j(self.tmpdir, "out")
+        cmd = ["python", br_processor_path, source_dir, out_dir, "test"]
+        subprocess.check_output(cmd)
+        # Rerun with only ingest options changed
+        cmd = [
+            "python",
+            br_processor_path,
+            "--include_exif",
+            source_dir,
+            out_dir,
+            "test2",
+        ]
+        subprocess.check_output(cmd)
+        # Verify reports of both runs are linked to the same cached reports
+        for f in ("report.xml", "email.txt"):
+            self.assertTrue(
+                os.path.samefile(
+                    j(out_dir, "test_reports", "bulk_extractor", f),
+                    j(out_dir, "test2_reports", "bulk_extractor", f),
+                )
+            )
+        # Verify features read from cached reports
+        with open(j(out_dir, "test.json"), "r", encoding="utf-8") as f:
+            first_dict = json.load(f)
+        with open(j(out_dir, "test2.json"), "r", encoding="utf-8") as f:
+            second_dict = json.load(f)
+        self.assertEqual(len(first_dict["features"]), len(second_dict["features"]))
+
+    def test_directory_rescan(self):
+        """Test rescan of unchanged directory against previous session.
+        """
+        br_processor_path = os.path.abspath(
+            j(os.path.dirname(__file__), "br_processor.py")
+        )
+        source_dir = j(self.test_data_dir, "source_directory")
+        out_dir = j(self.tmpdir, "out")
+        cmd = ["python", br_processor_path, source_dir, out_dir, "test"]
+        subprocess.check_output(cmd)
+        # Dismiss and annotate features in previous session
+        previous_path = j(out_dir, "test.json")
+        with open(previous_path, "r", encoding="utf-8") as f:
+            previous_dict = json.load(f)
+        for feature in previous_dict["features"]:
+            feature["dismissed"] = True
+            feature["note"] = "reviewed"
+        with open(previous_path, "w", encoding="utf-8") as f:
+            json.dump(previous_dict, f)
+        cmd = [
+            "python",
+            br_processor_path,
+            "--previous_session",
+            previous_path,
+            source_dir,
+            out_dir,
+            "rescan",
+        ]
+        result = subprocess.check_output(cmd)
+        json_path = j(out_dir, "rescan.json")
+        self.assertEqual(result.decode("utf-8"), json_path)
+        self.assertFalse(os.path.exists(j(out_dir, "rescan_reports", "rescan_staging")))
+        # Verify features carried over with reviewer dismissals and notes
+        with open(json_path, "r", encoding="utf-8") as test:
+            test_dict = json.load(test)
+        self.assertEqual(len(test_dict["files"]), len(previous_dict["files"]))
+        self.assertEqual(len(test_dict["features"]), len(previous_dict["features"]))
+        for feature in test_dict["features"]:
+            self.assertTrue(feature["dismissed"])
+            self.assertEqual(feature["note"], "reviewed")
+        # Verify all files rescanned if scan settings differ
+        cmd[-1] = "rescan2"
+        cmd.insert(2, "--include_network")
+        subprocess.check_output(cmd)
+        with open(j(out_dir, "rescan2.json"), "r", encoding="utf-8") as test:
+            test_dict = json.load(test)
+        self.assertTrue(test_dict["include_network"])
+        self.assertEqual(len(test_dict["features"]), len(previous_dict["features"]))
+        for feature in test_dict["features"]:
+            self.assertFalse(feature["dismissed"])
+
+    def test_directory_sharded(self):
+        """Test sharded session output for directory.
+        """
+        br_processor_path = os.path.abspath(
+            j(os.path.dirname(__file__), "br_processor.py")
+        )
+        source_dir = j(self.test_data_dir, "source_directory")
+        out_dir = j(self.tmpdir, "out")
+        cmd = [
+            "python",
+            br_processor_path,
+            "--sharded",
+            "--page_size",
+            "2",
+            source_dir,
+            out_dir,
+            "test",
+        ]
+        result = subprocess.check_output(cmd)
+        # Verify stdout
+        session_dir = j(out_dir, "test_session")
+        manifest_path = j(session_dir, "session.json")
+        self.assertEqual(result.decode("utf-8"), manifest_path)
+        # Verify files and pages of features match sample
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        with open(j(session_dir, manifest["files_path"]), "r", encoding="utf-8") as f:
+            files = json.load(f)["files"]
+        features = []
+        for page in manifest["pages"]:
+            self.assertLessEqual(page["count"], 2)
+            with open(j(session_dir, page["path"]), "r", encoding="utf-8") as f:
+                page_features = json.load(f)["features"]
+            self.assertEqual(len(page_features), page["count"])
+            for feature in page_features:
+                self.assertEqual(feature["feature_type"], page["feature_type"])
+            features.extend(page_features)
+        sample_path = j(self.test_data_dir, "directory.json")
+        with open(sample_path, "r", encoding="utf-8") as sample:
+            sample_dict = json.load(sample)
+        self.assertEqual(len(files), len(sample_dict["files"]))
+        self.assertEqual(len(features), len(sample_dict["features"]))
+        self.assertEqual(sum(manifest["feature_counts"].values()), len(features))
+
+    def test_diskimage_cached_file_table(self):
+        """Test reuse of cached file table for disk image.
+        """
+        br_processor_path = os.path.abspath(
+            j(os.path.dirname(__file__), "br_processor.py")
+        )
+        source_disk = j(self.test_data_dir, "source_diskimage", "practical.floppy.dd")
+        out_dir = j(self.tmpdir, "out")
+        for name in ("test", "test2"):
+            cmd = ["python", br_processor_path, "-d", source_disk, out_dir, name]
+            subprocess.check_output(cmd)
+        # Verify DFXML of second run linked from cache
+        self.assertTrue(
+            os.path.samefile(
+                j(out_dir, "test_reports", "dfxml.xml"),
+                j(out_dir, "test2_reports", "dfxml.xml"),
+            )
+        )
+        # Verify same files and features found in both runs
+        with open(j(out_dir, "test.json"), "r", encoding="utf-8") as f:
+            first_dict = json.load(f)
+        with open(j(out_dir, "test2.json"), "r", encoding="utf-8") as f:
+            second_dict = json.load(f)
+        self.assertEqual(first_dict["files"], second_dict["files"])
+        self.assertEqual(first_dict["features"], second_dict["features"])
+
     def test_diskimage_default(self):
-        """Test default settings for directory.
+        """Test default settings for disk image.
         """
         br_processor_path = os.path.abspath(
             j(os.path.dirname(__file__), "br_processor.py")
@@ -125,7 +779,6 @@ class TestIntegrationProcessor(SelfCleaningTestCase):
         output_dirs = [
             j(out_dir, "test_reports"),
             j(out_dir, "test_reports", "bulk_extractor"),
-            j(out_dir, "test_reports", "bulk_extractor_annotated"),
         ]
         for d in output_dirs:
             self.assertTrue(os.path.isdir(d))
@@ -134,6 +787,43 @@ class TestIntegrationProcessor(SelfCleaningTestCase):
             j(out_dir, "test_reports", "dfxml.xml"),
             j(out_dir, "test_reports", "bulk_extractor", "report.xml"),
             j(out_dir, "test_reports", "bulk_extractor", "email.txt"),
+        ]
+        for f in output_files:
+            self.assertTrue(is_non_zero_file(f))
+        # Verify annotated feature files not written by default
+        self.assertFalse(
+            os.path.isdir(j(out_dir, "test_reports", "bulk_extractor_annotated"))
+        )
+        # Verify contents of JSON match sample
+        with open(json_path, "r", encoding="utf-8") as test:
+            sample_path = j(self.test_data_dir, "diskimage.json")
+            with open(sample_path, "r", encoding="utf-8") as sample:
+                test_dict = json.load(test)
+                sample_dict = json.load(sample)
+            # Compare file and feature counts against sample
+            self.assertEqual(len(test_dict["files"]), len(sample_dict["files"]))
+            self.assertEqual(len(test_dict["features"]), len(sample_dict["features"]))
+
+    def test_diskimage_annotated_reports(self):
+        """Test disk image with annotated feature files.
+        """
+        br_processor_path = os.path.abspath(
+            j(os.path.dirname(__file__), "br_processor.py")
+        )
+        source_disk = j(self.test_data_dir, "source_diskimage", "practical.floppy.dd")
+        out_dir = j(self.tmpdir, "out")
+        cmd = [
+            "python",
+            br_processor_path,
+            "-d",
+            "--annotated_reports",
+            source_disk,
+            out_dir,
+            "test",
+        ]
+        subprocess.check_output(cmd)
+        # Verify annotated feature files written
+        output_files = [
             j(
                 out_dir,
                 "test_reports",
@@ -150,17 +840,135 @@ class TestIntegrationProcessor(SelfCleaningTestCase):
         ]
         for f in output_files:
             self.assertTrue(is_non_zero_file(f))
+        # Verify feature count matches sample
+        json_path = j(out_dir, "test.json")
+        with open(json_path, "r", encoding="utf-8") as test:
+            sample_path = j(self.test_data_dir, "diskimage.json")
+            with open(sample_path, "r", encoding="utf-8") as sample:
+                test_dict = json.load(test)
+                sample_dict = json.load(sample)
+            self.assertEqual(len(test_dict["features"]), len(sample_dict["features"]))
+
+    def test_diskimage_stream_dfxml(self):
+        """Test disk image with fiwalk output parsed as a stream.
+        """
+        br_processor_path = os.path.abspath(
+            j(os.path.dirname(__file__), "br_processor.py")
+        )
+        source_disk = j(self.test_data_dir, "source_diskimage", "practical.floppy.dd")
+        out_dir = j(self.tmpdir, "out")
+        cmd = [
+            "python",
+            br_processor_path,
+            "-d",
+            "--stream_dfxml",
+            source_disk,
+            out_dir,
+            "test",
+        ]
+        subprocess.check_output(cmd)
+        # Verify DFXML not written unless requested
+        self.assertFalse(os.path.exists(j(out_dir, "test_reports", "dfxml.xml")))
         # Verify contents of JSON match sample
+        json_path = j(out_dir, "test.json")
         with open(json_path, "r", encoding="utf-8") as test:
             sample_path = j(self.test_data_dir, "diskimage.json")
             with open(sample_path, "r", encoding="utf-8") as sample:
                 test_dict = json.load(test)
                 sample_dict = json.load(sample)
-            # Compare file and feature counts against sample
             self.assertEqual(len(test_dict["files"]), len(sample_dict["files"]))
             self.assertEqual(len(test_dict["features"]), len(sample_dict["features"]))
 
 
+class TestIntegrationServer(SelfCleaningTestCase):
+    """Session server integration tests.
+    """
+
+    test_data_dir = os.path.abspath(j(os.path.dirname(__file__), "..", "test_data"))
+
+    def test_serve_session(self):
+        """Test queries and changes served for session JSON.
+        """
+        br_processor_path = os.path.abspath(
+            j(os.path.dirname(__file__), "br_processor.py")
+        )
+        json_path = j(self.tmpdir, "directory.json")
+        shutil.copyfile(j(self.test_data_dir, "directory.json"), json_path)
+        requests = [
+            {"jsonrpc": "2.0", "id": 1, "method": "session"},
+            {
+                "jsonrpc": "2.0",
+                "id": 2,
+                "method": "features",
+                "params": {"limit": 1, "sort": "id", "order": "desc"},
+            },
+            {"jsonrpc": "2.0", "id": 3, "method": "dismiss", "params": {"ids": [1]}},
+            {
+                "jsonrpc": "2.0",
+                "id": 4,
+                "method": "note",
+                "params": {"ids": [2], "note": "reviewed"},
+            },
+            {
+                "jsonrpc": "2.0",
+                "id": 5,
+                "method": "features",
+                "params": {"dismissed": False},
+            },
+            {"jsonrpc": "2.0", "id": 6, "method": "unknown"},
+            {
+                "jsonrpc": "2.0",
+                "id": 7,
+                "method": "features",
+                "params": {"unknown": 1},
+            },
+            {
+                "jsonrpc": "2.0",
+                "id": 8,
+                "method": "dismiss",
+                "params": {"ids": ["1"]},
+            },
+            {"jsonrpc": "2.0", "id": 9, "method": []},
+            {"jsonrpc": "2.0", "method": "unknown"},
+            {"jsonrpc": "2.0", "method": "dismiss", "params": {"ids": ["1"]}},
+            {"jsonrpc": "2.0", "id": 10, "method": "shutdown"},
+        ]
+        cmd = [
+            "python",
+            br_processor_path,
+            "--serve",
+            json_path,
+            j(self.tmpdir, "db"),
+            "directory",
+        ]
+        result = subprocess.run(
+            cmd,
+            input="".join(json.dumps(r) + "\n" for r in requests).encode("utf-8"),
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        responses = [json.loads(line) for line in result.stdout.splitlines()]
+        # Verify notifications get no response, even on errors
+        self.assertEqual([r["id"] for r in responses], list(range(1, 11)))
+        self.assertEqual(responses[0]["result"]["feature_count"], 2)
+        self.assertEqual(responses[1]["result"]["total"], 2)
+        self.assertEqual(responses[1]["result"]["items"][0]["id"], 2)
+        self.assertEqual(responses[2]["result"], {"updated": 1})
+        self.assertEqual(responses[4]["result"]["total"], 1)
+        self.assertEqual(responses[4]["result"]["items"][0]["note"], "reviewed")
+        self.assertEqual(responses[5]["error"]["code"], -32601)
+        # Verify unknown params and params of wrong type are invalid
+        self.assertEqual(responses[6]["error"]["code"], -32602)
+        self.assertEqual(responses[7]["error"]["code"], -32602)
+        # Verify method that isn't a string is an invalid request
+        self.assertEqual(responses[8]["error"]["code"], -32600)
+        # Verify changes saved to session JSON on shutdown
+        with open(json_path, "r", encoding="utf-8") as f:
+            features = json.load(f)["features"]
+        self.assertTrue(features[0]["dismissed"])
+        self.assertEqual(features[1]["note"], "reviewed")
+
+
 class TestIntegrationExportDirectory(SelfCleaningTestCase):
     """Directory export integration tests.
     """
@@ -194,6 +1002,86 @@ class TestIntegrationExportDirectory(SelfCleaningTestCase):
         # Verify README file written
         self.assertTrue(is_non_zero_file(j(out_dir, "_BulkReviewer_README.txt")))
 
+    def test_export_directory_cleared_database(self):
+        """Test export of cleared files from directory session database.
+        """
+        new_json = self._setup_directory_test()
+        db_path = j(self.tmpdir, "directory.brv")
+        json_to_brv(new_json, db_path)
+        out_dir = j(self.tmpdir, "out")
+        file_export = FileExport(db_path, out_dir)
+        file_export.export_files()
+        # Verify cleared files were copied
+        cleared = ["file2_nothing.txt", "subdir/file4_nothing.txt"]
+        for f in cleared:
+            self.assertTrue(is_non_zero_file(j(out_dir, f)))
+        # Verify private files were not copied
+        private = ["file1_ssn.txt", "subdir/file3_email.txt"]
+        for f in private:
+            self.assertFalse(is_non_zero_file(j(out_dir, f)))
+        self.assertEqual(file_export.files_with_pii, private)
+
+    def test_export_directory_stale_database(self):
+        """Test export refuses database older than session JSON.
+        """
+        new_json = self._setup_directory_test()
+        db_path = j(self.tmpdir, "directory.brv")
+        json_to_brv(new_json, db_path)
+        # Simulate changes saved to JSON after database was written
+        later = os.path.getmtime(db_path) + 10
+        os.utime(new_json, (later, later))
+        out_dir = j(self.tmpdir, "out")
+        file_export = FileExport(db_path, out_dir)
+        with self.assertRaises(SystemExit):
+            file_export.export_files()
+        self.assertFalse(os.path.exists(out_dir))
+
+    def test_export_directory_cleared_archive(self):
+        """Test export of cleared files from directory to tar archive.
+        """
+        new_json = self._setup_directory_test()
+        archive_path = j(self.tmpdir, "out.tar.gz")
+        file_export = FileExport(new_json, archive_path, archive=True)
+        file_export.export_files()
+        with tarfile.open(archive_path) as tar:
+            names = tar.getnames()
+            # Verify cleared files were added with their contents
+            cleared = ["file2_nothing.txt", "subdir/file4_nothing.txt"]
+            for f in cleared:
+                self.assertIn(f, names)
+                with open(j(self.test_data_dir, "source_directory", f), "rb") as src:
+                    self.assertEqual(tar.extractfile(f).read(), src.read())
+            # Verify private files were not added
+            private = ["file1_ssn.txt", "subdir/file3_email.txt"]
+            for f in private:
+                self.assertNotIn(f, names)
+            # Verify README file added
+            self.assertIn("_BulkReviewer_README.txt", names)
+
+    def test_export_directory_cleared_manifest(self):
+        """Test export of cleared files from directory with manifests.
+        """
+        new_json = self._setup_directory_test()
+        out_dir = j(self.tmpdir, "out")
+        file_export = FileExport(new_json, out_dir, manifest=True)
+        file_export.export_files()
+        # Verify manifests list digests of cleared files
+        cleared = ["file2_nothing.txt", "subdir/file4_nothing.txt"]
+        for (algorithm, manifest) in (
+            ("md5", "manifest-md5.txt"),
+            ("sha256", "manifest-sha256.txt"),
+        ):
+            with open(j(out_dir, manifest)) as f:
+                lines = f.read().splitlines()
+            expected = []
+            for f in cleared:
+                with open(j(self.test_data_dir, "source_directory", f), "rb") as src:
+                    digest = hashlib.new(algorithm, src.read()).hexdigest()
+                expected.append("{}  {}".format(digest, f))
+            self.assertEqual(lines, expected)
+        # Verify fixity report written
+        self.assertTrue(is_non_zero_file(j(out_dir, "_BulkReviewer_fixity.csv")))
+
     def test_export_directory_private(self):
         """Test export of private files from directory.
         """
@@ -212,6 +1100,27 @@ class TestIntegrationExportDirectory(SelfCleaningTestCase):
         # Verify README file written
         self.assertTrue(is_non_zero_file(j(out_dir, "_BulkReviewer_README.txt")))
 
+    def test_export_directory_cleared_hardlink(self):
+        """Test export of cleared files from directory as hardlinks.
+        """
+        source_dir = j(self.tmpdir, "source_directory")
+        shutil.copytree(j(self.test_data_dir, "source_directory"), source_dir)
+        new_json = j(self.tmpdir, "directory.json")
+        json_path = j(self.test_data_dir, "directory.json")
+        write_updated_json(json_path, new_json, source_dir)
+        out_dir = j(self.tmpdir, "out")
+        file_export = FileExport(new_json, out_dir, link_mode="hardlink")
+        file_export.export_files()
+        # Verify cleared files were linked to source files
+        cleared = ["file2_nothing.txt", "subdir/file4_nothing.txt"]
+        for f in cleared:
+            self.assertTrue(os.path.samefile(j(source_dir, f), j(out_dir, f)))
+        # Verify private files were not exported
+        private = ["file1_ssn.txt", "subdir/file3_email.txt"]
+        for f in private:
+            self.assertFalse(is_non_zero_file(j(out_dir, f)))
+        self.assertEqual(file_export.files_not_copied, [])
+
     def test_export_directory_private_flat(self):
         """Test flat export of private files from directory.
         """
@@ -28,5 +28,7 @@ def time_to_int(str_time):
     """Convert datetime in format YYYY-MM-DDTHH:MM:SS
     to integer representing Unix time.
     """
-    dt = time.mktime(datetime.strptime(str_time, "%Y-%m-%dT%H:%M:%S").timetuple())
+    dt = time.mktime(
+        datetime.datetime.strptime(str_time, "%Y-%m-%dT%H:%M:%S").timetuple()
+    )
     return int(dt)